@@ -0,0 +1,238 @@
+# This will benchmark how the pipeline scales with the size of the data, on synthetic MIMIC-III shaped inputs (see
+# synthetic_data.py), so it can run anywhere - no credentialed data needed
+# For every scale (number of patients) a dataset is generated into <workdir>/subjects_<N>/data (reused while its
+# settings match) and the stages run in a fresh process, so each scale gets its own peak memory:
+#   cleanse_diagnoses -> cleanse_notes -> save_training_files -> split_inputs -> train_bot (a short fastText run)
+#   and, with --cnn, a short run of the CNN script
+# Each stage is measured with instrumentation.RunMetrics. The report gives the time and memory curve of every stage
+# over the scales, with the scaling exponent between neighbouring scales - log(time ratio) / log(size ratio) is ~1 for
+# a stage that scales linearly, and a stage whose exponent goes over --superlinear is flagged
+import argparse
+import glob
+import json
+import logging
+import math
+import os
+import subprocess
+import sys
+
+import pandas as pd
+
+# Set Logging -- basic configuration
+logging.basicConfig(format='%(asctime)s -- %(levelname)s: %(message)s',
+                    level=logging.NOTSET,
+                    datefmt='%Y-%m-%d %H:%M:%S')
+my_logger = logging.getLogger('classifier_project')
+
+dataset_filename = 'dataset.json'
+stages_filename = 'scaling_stages.json'
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+# This method will generate the dataset of one scale, unless the one already in scale_dir has the same settings
+# The generator runs in its own process - the peak RSS of a process carries over into the processes it starts, so this
+# one has to stay small for the per scale peaks to mean anything
+def prepare_dataset(scale_dir, subjects: int, seed: int, notes_per_admit: float) -> dict:
+    settings = {'subjects': subjects, 'seed': seed, 'notes_per_admit': notes_per_admit}
+    dataset_filepath = os.path.join(scale_dir, dataset_filename)
+    if os.path.isfile(dataset_filepath):
+        with open(dataset_filepath, 'r', encoding='utf8') as f:
+            dataset = json.load(f)
+        if dataset['settings'] == settings:
+            my_logger.info("  reusing the dataset in " + scale_dir)
+            return dataset
+
+    # the scale's own directory, a dataset with other settings is replaced
+    my_logger.info("  generating " + str(subjects) + " patients into " + scale_dir)
+    os.makedirs(scale_dir, exist_ok=True)
+    subprocess.run([sys.executable, os.path.join(script_dir, 'synthetic_data.py'), '--subjects', str(subjects),
+                    '--seed', str(seed), '--notes-per-admit', str(notes_per_admit), '--output-dir',
+                    os.path.join(scale_dir, 'data'), '--summary', dataset_filepath + '.counts', '--force'], check=True)
+    with open(dataset_filepath + '.counts', 'r', encoding='utf8') as f:
+        dataset = {'settings': settings, 'counts': json.load(f)}
+    os.remove(dataset_filepath + '.counts')
+
+    with open(dataset_filepath, 'w', encoding='utf8') as f:
+        json.dump(dataset, f, indent=2)
+
+    return dataset
+
+
+# This method will run the stages of one scale, in the scale's directory (the working directory of this process)
+# Caches are rebuilt so every stage does its real work. The stage records are saved to scaling_stages.json
+def run_scale(args) -> None:
+    import fasttext
+
+    from clean_data import (cleanse_diagnoses, cleanse_notes, diag_file, noteevents_file, save_training_files,
+                            split_inputs, training_variants)
+    from instrumentation import RunMetrics, file_bytes, line_count
+
+    with open(dataset_filename, 'r', encoding='utf8') as f:
+        counts = json.load(f)['counts']
+    os.makedirs('./cleansed_data', exist_ok=True)
+    os.makedirs('./models', exist_ok=True)
+
+    run_metrics = RunMetrics('scaling', './metrics', args.profile)
+    training_files = ['./cleansed_data/' + variant + '.txt' for variant in training_variants]
+
+    # what the interpreter and imports take, before any data is loaded
+    with run_metrics.stage('startup'):
+        pass
+
+    with run_metrics.stage('cleanse_diagnoses', rows=counts['diagnoses'],
+                           bytes_read=file_bytes('./data/' + diag_file)):
+        unique_subject_list, unique_admit_list, diagnoses_df = cleanse_diagnoses(rebuild_cache=True)
+
+    with run_metrics.stage('cleanse_notes', rows=counts['notes'], bytes_read=file_bytes('./data/' + noteevents_file)):
+        notes_df = cleanse_notes(unique_subject_list, unique_admit_list, workers=args.workers,
+                                 rebuild_cache=True)
+
+    with run_metrics.stage('save_training_files', rows=len(unique_admit_list)) as record:
+        save_training_files(notes_df, diagnoses_df, unique_admit_list)
+        record['bytes_written'] = file_bytes(*training_files)
+    del notes_df, diagnoses_df
+
+    with run_metrics.stage('split_inputs', rows=sum(line_count(filepath) for filepath in training_files),
+                           bytes_read=file_bytes(*training_files)):
+        split_inputs()
+
+    train_filepath = './cleansed_data/rolled_common_input.train'
+    with run_metrics.stage('train_bot', rows=line_count(train_filepath) * args.train_epochs,
+                           bytes_read=file_bytes(train_filepath)):
+        fasttext.train_supervised(input=train_filepath, dim=args.train_dim, epoch=args.train_epochs, lr=.05,
+                                  minCount=5, loss='ova', thread=args.workers or os.cpu_count() or 1, verbose=0)
+
+    records = list(run_metrics.records)
+    if args.cnn:
+        # the CNN script measures its own stages, its records are added here under a cnn_ prefix
+        command = [sys.executable, os.path.join(script_dir, 'train_common_rolled_BINARY_CNN.py'), '--epochs',
+                   str(args.train_epochs), '--rebuild-cache', '--metrics-dir', './metrics/cnn']
+        with open('./cnn.log', 'w', encoding='utf8') as log_file:
+            result = subprocess.run(command, stdout=log_file, stderr=subprocess.STDOUT)
+        if result.returncode != 0:
+            my_logger.error("  the CNN run failed (exit code " + str(result.returncode) + "), see " +
+                            os.path.abspath('./cnn.log'))
+        else:
+            with open(max(glob.glob('./metrics/cnn/*.json')), 'r', encoding='utf8') as f:
+                records = records + [dict(record, stage='cnn_' + record['stage']) for record in json.load(f)]
+
+    run_metrics.write()
+    with open(stages_filename, 'w', encoding='utf8') as f:
+        json.dump(records, f, indent=2)
+
+
+# This method will add the scaling exponents to the stage records of every scale
+# The time exponent compares wall time against the stage's rows (patients when the stage has no row count). The memory
+# exponent compares the peak RSS above the startup RSS against the patients - the peak is the process peak so far, so
+# the first stage whose memory exponent jumps is the one to look at. Tiny timings / memory growths are too noisy for
+# an exponent, they're left empty
+def scaling_curves(records: list, min_seconds=.2, min_rss_mb=5) -> pd.DataFrame:
+    curves = pd.DataFrame(records)
+    startup = curves[curves['stage'] == 'startup'].set_index('subjects')['peak_rss_mb']
+    curves = curves[curves['stage'] != 'startup'].copy()
+    # the CNN stages run in a process of their own, the startup of this one says nothing about them
+    curves['rss_over_startup_mb'] = (curves['peak_rss_mb'] - curves['subjects'].map(startup)).round(1).where(
+        ~curves['stage'].str.startswith('cnn_'))
+    curves['size'] = curves['rows'].fillna(curves['subjects']).astype(float)
+    # stages stay in the order they ran
+    curves = curves.sort_values('subjects', kind='stable')
+
+    def exponent(values, sizes, floor):
+        ratios = []
+        for (value_before, value), (size_before, size) in zip(zip(values, values[1:]), zip(sizes, sizes[1:])):
+            noisy = not min(value_before, value) >= floor or size <= size_before
+            ratios.append(None if noisy else round(math.log(value / value_before) / math.log(size / size_before), 2))
+        return [None] + ratios
+
+    curves['time_exponent'] = None
+    curves['memory_exponent'] = None
+    for _, stage_curve in curves.groupby('stage', sort=False):
+        curves.loc[stage_curve.index, 'time_exponent'] = exponent(
+            stage_curve['wall_seconds'].tolist(), stage_curve['size'].tolist(), min_seconds)
+        curves.loc[stage_curve.index, 'memory_exponent'] = exponent(
+            stage_curve['rss_over_startup_mb'].tolist(), stage_curve['subjects'].astype(float).tolist(), min_rss_mb)
+
+    return curves.drop(columns=['size'])
+
+
+# Main method - python will automatically run this
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark how the pipeline stages scale, on synthetic data')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 2000, 4000, 8000],
+                        help='numbers of patients to run at (MIMIC-III has about 46000, the CNN needs a few thousand)')
+    parser.add_argument('--workdir', default='./benchmarks/scaling',
+                        help='directory the datasets, outputs and report are written to')
+    parser.add_argument('--notes-per-admit', type=float, default=35.0,
+                        help='mean notes per admit besides the discharge summary')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic data')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='note normalization processes / fastText threads (default: all cores)')
+    parser.add_argument('--train-epochs', type=int, default=2, help='epochs of the short training runs')
+    parser.add_argument('--train-dim', type=int, default=50, help='dims of the short BOT training run')
+    parser.add_argument('--cnn', action='store_true', help='also time a short run of the CNN script')
+    parser.add_argument('--superlinear', type=float, default=1.2,
+                        help='flag a stage whose time / memory exponent goes over this')
+    parser.add_argument('--profile', nargs='+', default=[],
+                        help="run these stages under cProfile ('all' for every stage), at every scale")
+    parser.add_argument('--run-scale', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Child mode - the stages of one scale, in the scale directory
+    if args.run_scale:
+        run_scale(args)
+        sys.exit(0)
+
+    all_records = []
+    for subjects in sorted(set(args.scales)):
+        scale_dir = os.path.join(args.workdir, 'subjects_' + str(subjects))
+        my_logger.info("Scale: " + str(subjects) + " patients ...")
+        dataset = prepare_dataset(scale_dir, subjects, args.seed, args.notes_per_admit)
+
+        child_args = sys.argv[1:] + ['--run-scale']
+        with open(os.path.join(scale_dir, 'scaling.log'), 'w', encoding='utf8') as log_file:
+            result = subprocess.run([sys.executable, os.path.abspath(__file__)] + child_args, cwd=scale_dir,
+                                    stdout=log_file, stderr=subprocess.STDOUT)
+        if result.returncode != 0:
+            my_logger.error("  FAILED (exit code " + str(result.returncode) + "), see " +
+                            os.path.join(scale_dir, 'scaling.log'))
+            continue
+
+        with open(os.path.join(scale_dir, stages_filename), 'r', encoding='utf8') as f:
+            scale_records = json.load(f)
+        if args.cnn and not any(record['stage'].startswith('cnn_') for record in scale_records):
+            my_logger.warning("  the CNN run failed at this scale, see " + os.path.join(scale_dir, 'cnn.log'))
+        all_records.extend(dict(record, subjects=subjects, admits=dataset['counts']['admits'],
+                                notes=dataset['counts']['notes']) for record in scale_records)
+
+    if not all_records:
+        my_logger.error("No scale finished, nothing to report")
+        sys.exit(1)
+
+    report = scaling_curves(all_records)
+    report_columns = ['stage', 'subjects', 'admits', 'notes', 'rows', 'wall_seconds', 'cpu_seconds', 'rows_per_second',
+                      'peak_rss_mb', 'rss_over_startup_mb', 'time_exponent', 'memory_exponent']
+    report[report_columns].to_csv(os.path.join(args.workdir, 'scaling_report.csv'), index=False)
+    with open(os.path.join(args.workdir, 'scaling_report.json'), 'w', encoding='utf8') as f:
+        json.dump(report[report_columns].to_dict(orient='records'), f, indent=2)
+
+    my_logger.info("Scaling curves (time exponent ~1 is linear):")
+    for stage_name, stage_curve in report.groupby('stage', sort=False):
+        my_logger.info("  " + stage_name)
+        for _, row in stage_curve.iterrows():
+            my_logger.info(f"    {row['subjects']:>7} patients: {row['wall_seconds']:>8.2f}s, " +
+                           (f"{row['rows_per_second']:>10.0f} rows/sec, " if pd.notna(row['rows_per_second'])
+                            else ' ' * 21) +
+                           f"peak RSS {row['peak_rss_mb']:>7.1f}MB" +
+                           (f" (+{row['rss_over_startup_mb']:.1f}MB), " if pd.notna(row['rss_over_startup_mb'])
+                            else ', ') +
+                           f"exponents time {row['time_exponent']} / memory {row['memory_exponent']}")
+
+        for _, row in stage_curve.iterrows():
+            for kind in ['time', 'memory']:
+                if pd.notna(row[kind + '_exponent']) and row[kind + '_exponent'] > args.superlinear:
+                    my_logger.warning("  " + stage_name + " " + kind + " stops scaling linearly at " +
+                                      str(row['subjects']) + " patients (exponent " + str(row[kind + '_exponent']) +
+                                      ")")
+
+    my_logger.info("Report saved into " + os.path.join(args.workdir, 'scaling_report.csv') + " and " +
+                   os.path.join(args.workdir, 'scaling_report.json'))
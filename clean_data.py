@@ -1,15 +1,31 @@
 # CTOOMBS 04/26/2022
 #   This script will cleanse input data for notes and diagnoses for the labeling task
+import argparse
+import contextlib
+import filecmp
+import functools
+import hashlib
+import heapq
+import json
 import logging
 import os
 import re
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
-from filesplit.split import Split
-import math
 from operator import itemgetter
 
+import fasttext_reader
+import notes_store
+from instrumentation import RunMetrics, file_bytes, format_peak_rss
+
 
 # Set Logging -- basic configuration
 logging.basicConfig(format='%(asctime)s -- %(levelname)s: %(message)s',
@@ -22,9 +38,37 @@ diag_file = 'DIAGNOSES_ICD.csv.gz'
 proc_file = 'D_ICD_PROCEDURES.csv.gz'
 noteevents_file = 'NOTEEVENTS.csv.gz'
 
+# Compiled once for the note normalization, see normalize_text
+punctuation_pattern = re.compile(r"[,.:;_@#?!&$*\[\]]+\ *")
+digit_table = str.maketrans('0123456789', 'dddddddddd')
+
+# The training file variants written by save_training_files, each one is <variant>.txt in cleansed_data
+training_variants = ['regular_input', 'rolled_input', 'rolled_common_input']
+# The variants the training / evaluation scripts read. With the notes store only these get train / test (or fold)
+# files, the others are only kept in the store
+trained_variants = ['rolled_common_input']
+
+# Filtered diagnoses / notes are cached here between runs, see make_cache_key
+cache_filepath = './cleansed_data/cache/'
+cache_version = 2
+
+# Every admit written to the training files is recorded here, for the incremental mode - see ingest_new_admits
+manifest_filename = 'processed_admits.json'
+
+# Sharded runs write their partial outputs under cleansed_data/shards/<K>_shards/shard_<i>/, see cleanse_shard
+shards_dirname = 'shards/'
+shard_marker_filename = 'shard.json'
+
+# Only these columns of DIAGNOSES_ICD are parsed
+diagnoses_dtypes = {'SUBJECT_ID': 'int32', 'HADM_ID': 'int32', 'ICD9_CODE': 'category'}
+
+# Only these columns of NOTEEVENTS are parsed - HADM_ID is blank for some notes, so it can't be an integer column
+notes_dtypes = {'SUBJECT_ID': 'int32', 'HADM_ID': 'float64', 'CATEGORY': 'category', 'TEXT': 'object'}
+
 
 # This method will take in a filename and populate a list of dictionaries with tweets
-def cleanse_diagnoses():
+# The filtered dataframe is cached as parquet, keyed by the contents of the input file - rebuild_cache skips the cache
+def cleanse_diagnoses(rebuild_cache=False):
     diag_filepath = './data/' + diag_file
 
     if os.path.exists(diag_filepath):
@@ -33,16 +77,30 @@ def cleanse_diagnoses():
         my_logger.error('DIAG File DOES NOT EXIST! Input files should be contained in the data directory')
         raise
 
+    cache_key = make_cache_key('diagnoses', file_digest(diag_filepath))
+    cached = None if rebuild_cache else load_cache(cache_key)
+    if cached is not None:
+        diagnoses_df, arrays = cached
+        my_logger.info('DIAG File loaded from cache -- ' + cache_key)
+        return arrays['unique_subjects'], arrays['unique_admits'], diagnoses_df
+
     # ROW_ID/SUBJECT_ID/HADM_ID/SEQ_NUM/ICD9_CODE
     my_logger.info('Cleansing DIAG file -- ' + diag_file)
 
-    diagnoses_df = pd.read_csv(diag_filepath, compression='gzip',
-                               header=0, sep=',', quotechar='"')
+    # ROW_ID / SEQ_NUM are not needed, so they are never parsed. ICD9_CODE is read as a categorical, so all of the
+    # string work below is done once per distinct code, not once per row
+    diagnoses_df = pd.read_csv(diag_filepath, compression='gzip', header=0, sep=',', quotechar='"',
+                               usecols=list(diagnoses_dtypes), dtype=diagnoses_dtypes)
 
     my_logger.info('  DIAG FILE LENGTH: ' + str(len(diagnoses_df)))
 
+    # Category codes are -1 for a missing ICD9_CODE, so every per category array gets one extra entry on the end
+    codes = diagnoses_df['ICD9_CODE'].cat.codes.to_numpy()
+    categories = diagnoses_df['ICD9_CODE'].cat.categories.astype(str)
+
     # Filter out rows that are NOT diabetic - 250 is ICD code for DIABETES
-    unique_subjects = diagnoses_df[diagnoses_df['ICD9_CODE'].str.startswith('250', na=False)]
+    is_diabetic = np.append(categories.str.startswith('250'), False)
+    unique_subjects = diagnoses_df[is_diabetic[codes]]
 
     # Get the list of unique patients and admits - This will be used by the notes filtering!
     unique_subjects_list = unique_subjects['SUBJECT_ID'].unique()
@@ -51,24 +109,46 @@ def cleanse_diagnoses():
     my_logger.info('  NUMBER OF UNIQUE PATIENTS: ' + str(len(unique_subjects_list)))
     my_logger.info('  NUMBER OF UNIQUE ADMITS: ' + str(len(unique_admits_list)))
 
-    # Filter out DIAG Dataframe to remove subjects which are not in the unique subject list
-    # Remove ROW_ID, SEQ_NUM columns as we don't need these and this takes up memory - keeping HADM_ID as it keeps
-    # Record of hospital admit
-    diagnoses_df = diagnoses_df[diagnoses_df['SUBJECT_ID'].isin(unique_subjects_list)].drop(
-        columns=['ROW_ID', 'SEQ_NUM'])
-    diagnoses_df['ICD9_CODE_ROLLED'] = diagnoses_df['ICD9_CODE'].apply(lambda x: str(x)[0:3])
+    # Rolled codes are the first three characters of the code, a missing code rolls to 'nan' as str(nan) did before
+    rolled_categories = np.append(categories.str[0:3], 'nan')
+
+    # Both code columns share one label vocabulary, so a label id means the same thing in either column
+    used_rolled = rolled_categories if (codes == -1).any() else rolled_categories[:-1]
+    label_vocabulary = pd.Index(sorted(set(categories) | set(used_rolled)))
+
+    diagnoses_df['ICD9_CODE'] = diagnoses_df['ICD9_CODE'].cat.set_categories(label_vocabulary)
+    diagnoses_df['ICD9_CODE_ROLLED'] = pd.Categorical.from_codes(
+        label_vocabulary.get_indexer(rolled_categories)[codes], categories=label_vocabulary)
+
+    # Filter out DIAG Dataframe to remove subjects which are not in the unique subject list - keeping HADM_ID as it
+    # keeps Record of hospital admit
+    diagnoses_df = diagnoses_df[diagnoses_df['SUBJECT_ID'].isin(unique_subjects_list)]
 
     my_logger.info('  FILTERED DIAG FILE LENGTH: ' + str(len(diagnoses_df)))
     my_logger.info('  NUMBER OF UNIQUE CODES: ' + str(diagnoses_df.ICD9_CODE.nunique()))
     my_logger.info('  NUMBER OF UNIQUE ROLLED CODES: ' + str(diagnoses_df.ICD9_CODE_ROLLED.nunique()))
+    my_logger.info('  DIAG MEMORY USAGE: ' + str(diagnoses_df.memory_usage(deep=True).sum() // 1024) + 'KB')
 
     my_logger.info('DIAG File Cleansed...')
 
+    save_cache(cache_key, diagnoses_df, unique_subjects=unique_subjects_list, unique_admits=unique_admits_list)
+
     return unique_subjects_list, unique_admits_list, diagnoses_df
 
 
 # This method will take in a filename and populate a list of dictionaries with tweets
-def cleanse_notes(unique_subjects: list, unique_admits: list):
+# Only the columns needed for the filter and the training files are parsed, with compact dtypes, and the row filter is
+# applied to each chunk as soon as it's read, so the TEXT of non discharge notes is dropped straight away (the csv
+# reader still has to parse the TEXT of every row of a chunk before the filter can run)
+# memory_budget_mb bounds the read working set, not the result: half of it goes to the raw chunk - chunks start at
+# chunk_size rows and are shrunk as needed - and half to the filtered chunks in flight to the workers. The normalized
+# notes that are kept are the output of this method, so they are held on top of the budget
+# The TEXT normalization of each filtered chunk is fanned out to a process pool while this process keeps reading and
+# decompressing the next chunks - chunks are collected back in their original order. workers=1 runs everything inline
+# The filtered dataframe is cached as parquet, keyed by the contents of the input file and the subjects / admits that
+# are kept - rebuild_cache skips the cache. cache_slot names the entry a new one replaces, see save_cache
+def cleanse_notes(unique_subjects: list, unique_admits: list, workers=None, chunk_size=5000, memory_budget_mb=256,
+                  rebuild_cache=False, cache_slot='notes'):
     noteevents_filepath = './data/' + noteevents_file
 
     if os.path.exists(noteevents_filepath):
@@ -77,47 +157,184 @@ def cleanse_notes(unique_subjects: list, unique_admits: list):
         my_logger.error('NOTES file DOES NOT EXIST! Input files should be contained in the data directory')
         raise
 
+    cache_key = make_cache_key(cache_slot, file_digest(noteevents_filepath), unique_subjects, unique_admits,
+                               'Discharge summary')
+    cached = None if rebuild_cache else load_cache(cache_key)
+    if cached is not None:
+        notes_df, _ = cached
+        my_logger.info('NOTES File loaded from cache -- ' + cache_key)
+        my_logger.info(" LENGTH OF NOTES DF: " + str(len(notes_df)))
+        return notes_df
+
     # ['CATEGORY', 'CGID', 'CHARTDATE', 'CHARTTIME', 'DESCRIPTION', 'HADM_ID', 'ISERROR', 'ROW_ID', 'STORETIME', 'SUBJECT_ID', 'TEXT']
     my_logger.info('Cleansing NOTES file -- ' + noteevents_file)
 
+    workers = workers or os.cpu_count() or 1
+    my_logger.info('  NORMALIZATION WORKERS: ' + str(workers) + ', CHUNK SIZE: ' + str(chunk_size) +
+                   ', MEMORY BUDGET: ' + str(memory_budget_mb) + 'MB')
+
     chunk_num = 0
+    rows_read = 0
+    rows_to_read = chunk_size
     notes_list = []
+    pending = deque()
+    pending_bytes = 0
+    budget_bytes = memory_budget_mb * 1024 * 1024 / 2
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    start = time.perf_counter()
+
+    try:
+        # Requires pandas 1.25>
+        with pd.read_csv(noteevents_filepath, compression='gzip', header=0, sep=',', quotechar='"',
+                         usecols=list(notes_dtypes), dtype=notes_dtypes, chunksize=chunk_size) as reader:
+            while True:
+                try:
+                    chunk = reader.get_chunk(rows_to_read)
+                except StopIteration:
+                    break
+
+                chunk_num = chunk_num + 1
+                rows_read = rows_read + len(chunk)
+                my_logger.info('  PROCESSING CHUNK: ' + str(chunk_num))
+
+                # Size the next chunk off of this one, so a run of very long notes can't blow the memory budget
+                bytes_per_row = chunk.memory_usage(deep=True).sum() / max(len(chunk), 1)
+                rows_to_read = max(1, min(chunk_size, int(budget_bytes / bytes_per_row)))
+
+                # Only keep reports if subject is in unique subjects and the HADM_ID is in the cleansed diagnosis dataframe
+                # ADDED: Only keep discharge summary or output file is far too large!!!
+                temp = chunk[(chunk['SUBJECT_ID'].isin(unique_subjects)) & (chunk['HADM_ID'].isin(unique_admits)) & (chunk['CATEGORY'] == 'Discharge summary')]
+                del chunk
+
+                if executor is None:
+                    notes_list.append(normalize_notes_chunk(temp))
+                    continue
+
+                temp_bytes = temp.memory_usage(deep=True).sum()
+                pending.append((executor.submit(normalize_notes_chunk, temp), temp_bytes))
+                pending_bytes = pending_bytes + temp_bytes
+                del temp
+
+                # Keep the chunks in flight bounded in number and bytes, so the reader doesn't run away from the workers
+                while len(pending) > workers * 2 or (len(pending) > 1 and pending_bytes > budget_bytes):
+                    future, future_bytes = pending.popleft()
+                    notes_list.append(future.result())
+                    pending_bytes = pending_bytes - future_bytes
+
+        while pending:
+            notes_list.append(pending.popleft()[0].result())
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
 
-    # Requires pandas 1.25>
-    with pd.read_csv(noteevents_filepath, compression='gzip', header=0, sep=',', quotechar='"',
-                     chunksize=5000) as reader:
-        for chunk in reader:
-            chunk_num = chunk_num + 1
-            my_logger.info('  PROCESSING CHUNK: ' + str(chunk_num))
+    # convert notes_list to consolidate DF
+    notes_df = pd.concat(notes_list)
+    elapsed = time.perf_counter() - start
 
-            # Only keep reports if subject is in unique subjects and the HADM_ID is in the cleansed diagnosis dataframe
-            # ADDED: Only keep discharge summary or output file is far too large!!!
-            temp = chunk[(chunk['SUBJECT_ID'].isin(unique_subjects)) & (chunk['HADM_ID'].isin(unique_admits)) & (chunk['CATEGORY'].isin(['Discharge summary']))].drop(
-                columns=['CGID', 'CHARTDATE', 'CHARTTIME', 'DESCRIPTION', 'ISERROR', 'ROW_ID', 'STORETIME'])
+    my_logger.info(" LENGTH OF NOTES DF: " + str(len(notes_df)))
+    my_logger.info(f" NOTES ROWS READ: {rows_read} in {elapsed:.1f}s ({rows_read / max(elapsed, 1e-9):.0f} rows/sec)")
+    my_logger.info(" PEAK RSS: " + format_peak_rss())
 
-            # PER PAPER CLEANSE THE LINES
-            # Remove punctuation to whitespaces except for apostrophe
-            temp['TEXT'] = temp['TEXT'].apply(lambda x: re.sub(r"[,.:;_@#?!&$*\[\]]+\ *", " ", x))
+    save_cache(cache_key, notes_df)
 
-            # Digits replaced by letter 'd'
-            temp['TEXT'] = temp['TEXT'].apply(lambda x: re.sub(r"[0-9]", "d", x))
+    return notes_df
 
-            # Convert all characters to lowercase
-            temp['TEXT'] = temp['TEXT'].apply(lambda x: x.lower())
 
-            # Remove excess whitespace
-            temp['TEXT'] = temp['TEXT'].apply(lambda x: ' '.join(x.split()))
+# This method will return the sha256 hex digest of the contents of a file, read in 1MB blocks
+def file_digest(filepath) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        while block := f.read(1024 * 1024):
+            digest.update(block)
 
-            notes_list.append(temp)
-            # my_logger.info(temp)
-            # raise
+    return digest.hexdigest()
 
-    # convert notes_list to consolidate DF
-    notes_df = pd.concat(notes_list)
 
-    my_logger.info(" LENGTH OF NOTES DF: " + str(len(notes_df)))
+# This method will build a cache key from the digest of an input file and the parameters used to filter it
+# Bump cache_version whenever the cleansing itself changes, so old cache entries are not picked up
+def make_cache_key(name, input_digest, *params) -> str:
+    digest = hashlib.sha256((str(cache_version) + input_digest).encode())
+    for param in params:
+        if isinstance(param, (list, np.ndarray)):
+            digest.update(np.asarray(param).tobytes())
+        else:
+            digest.update(str(param).encode())
 
-    return notes_df
+    return name + '_' + digest.hexdigest()[:16]
+
+
+# This method will load a cached dataframe (parquet) and its arrays (npz), returns None if there is no usable entry
+# A hit supersedes the other entries of its name, see remove_superseded_cache
+def load_cache(cache_key):
+    frame_filepath = cache_filepath + cache_key + '.parquet'
+    arrays_filepath = cache_filepath + cache_key + '.npz'
+
+    if not (os.path.isfile(frame_filepath) and os.path.isfile(arrays_filepath)):
+        return None
+
+    try:
+        frame = pd.read_parquet(frame_filepath)
+    except ImportError:
+        my_logger.warning('pyarrow is not installed, the cleansing cache is disabled')
+        return None
+
+    with np.load(arrays_filepath, allow_pickle=False) as arrays:
+        arrays = {name: arrays[name] for name in arrays.files}
+
+    remove_superseded_cache(cache_key)
+    return frame, arrays
+
+
+# This method will save a dataframe (parquet) and any arrays (npz) to the cache. Files are written under a temp name
+# and then renamed, so an interrupted run never leaves a partial entry behind. The temp names are unique to the process,
+# shards running side by side (or on several machines) may fill the same entry at once
+# The entries it supersedes are removed, so the cache holds one entry per name instead of one per input file / admit
+# list ever seen
+def save_cache(cache_key, frame, **arrays) -> None:
+    os.makedirs(cache_filepath, exist_ok=True)
+    frame_filepath = cache_filepath + cache_key + '.parquet'
+    arrays_filepath = cache_filepath + cache_key + '.npz'
+    temp_suffix = '.' + uuid.uuid4().hex + '.tmp'
+
+    try:
+        frame.to_parquet(frame_filepath + temp_suffix)
+    except ImportError:
+        my_logger.warning('pyarrow is not installed, the cleansing cache is disabled')
+        return
+
+    with open(arrays_filepath + temp_suffix, 'wb') as f:
+        np.savez(f, **arrays)
+
+    os.replace(frame_filepath + temp_suffix, frame_filepath)
+    os.replace(arrays_filepath + temp_suffix, arrays_filepath)
+    my_logger.info('Saved to cache -- ' + cache_key)
+    remove_superseded_cache(cache_key)
+
+
+# This method will remove the cache entries cache_key supersedes - the other entries of the same name (the part of the
+# key before the digest), e.g. the notes of an earlier NOTEEVENTS file or admit list
+def remove_superseded_cache(cache_key) -> None:
+    superseded_pattern = re.compile(re.escape(cache_key.rsplit('_', 1)[0]) + r'_[0-9a-f]{16}\.(parquet|npz)')
+    for filename in sorted(os.listdir(cache_filepath)):
+        if superseded_pattern.fullmatch(filename) and not filename.startswith(cache_key + '.'):
+            os.remove(cache_filepath + filename)
+            my_logger.info('  Removed superseded cache entry ' + filename)
+
+
+# PER PAPER CLEANSE THE LINES - all four steps are done in one pass over each note
+#   1. Remove punctuation to whitespaces except for apostrophe
+#   2. Digits replaced by letter 'd'
+#   3. Convert all characters to lowercase
+#   4. Remove excess whitespace
+def normalize_text(text: str) -> str:
+    text = punctuation_pattern.sub(' ', text).translate(digit_table).lower()
+    return ' '.join(text.split())
+
+
+# This method will normalize the TEXT column of a filtered notes chunk. Runs in the worker processes of cleanse_notes
+def normalize_notes_chunk(chunk):
+    chunk['TEXT'] = [normalize_text(text) for text in chunk['TEXT']]
+    return chunk
 
 
 # This method will save off the notes / diagnoses in an ingestable cleansed format
@@ -126,10 +343,170 @@ def cleanse_notes(unique_subjects: list, unique_admits: list):
 #    2. rolled_input.txt -> version of input using rolled ICD9 codes associated with clinical text
 #    3. rolled_common_input.txt -> version of input using rolled ICD9 codes, but only the top 10 common codes, not
 #          including 250, which is diabetes and common across all records
-def save_training_files(notes_df, diagnoses_df, unique_admit_list):
+# Diagnoses and notes are grouped by HADM_ID once up front, and all three files are written in one pass over the admits
+# use_store -> write the notes once to a notes store, with a label file per variant, instead of the three text files.
+#    See notes_store.py, split_inputs can read the variants straight out of the store
+# Returns the common codes, so they can be kept for later incremental runs
+def save_training_files(notes_df, diagnoses_df, unique_admit_list, cleansed_input_filepath='./cleansed_data/',
+                        use_store=False):
     my_logger.info("Saving cleansed input files ...")
 
-    cleansed_input_filepath = './cleansed_data/'
+    # The common codes need to be known before the common file can be written, these only need the diagnoses
+    common_codes = count_common_codes(diagnoses_df, unique_admit_list)
+    records = iter_training_records(notes_df, diagnoses_df, unique_admit_list, common_codes)
+
+    if use_store:
+        # don't leave text files from an earlier run behind, they would be picked up instead of the store
+        for variant in training_variants:
+            if os.path.isfile(cleansed_input_filepath + variant + '.txt'):
+                os.remove(cleansed_input_filepath + variant + '.txt')
+
+        admit_count = notes_store.write_store(cleansed_input_filepath, records, training_variants)
+        my_logger.info("  NOTES STORE WRITTEN FOR " + str(admit_count) + " ADMITS")
+    else:
+        # nor a store from an earlier --notes-store run
+        notes_store.remove_store(cleansed_input_filepath, training_variants)
+        with contextlib.ExitStack() as stack:
+            output_files = {variant: stack.enter_context(open(cleansed_input_filepath + variant + '.txt', 'w',
+                                                              encoding='utf8'))
+                            for variant in training_variants}
+
+            for _, note, labels_by_variant in records:
+                for variant, labels in labels_by_variant.items():
+                    if labels is not None:
+                        output_files[variant].write(labels + note + '\n')
+
+    # Print statistics for the common codes - will not include rolled code 250
+    my_logger.info("Statistics for top 10 common ICD9 Rolled codes occurrences")
+    my_logger.info(common_codes)
+
+    return common_codes
+
+
+# This method will yield (HADM_ID, note, {variant: labels}) for every admit, in unique_admit_list order
+# The labels for a variant are None when the admit is left out of it - the common variant skips blank HADM notes, and
+# admits with no labels in common
+def iter_training_records(notes_df, diagnoses_df, unique_admit_list, common_codes: dict):
+    diagnoses_by_admit = group_diagnoses_by_admit(diagnoses_df)
+    notes_by_admit = group_notes_by_admit(notes_df)
+
+    for item in np.asarray(unique_admit_list).tolist():
+        diagnosis = diagnoses_by_admit.get(item, [])
+        note = ''.join(' ' + text for text in notes_by_admit.get(item, []))
+
+        regular_labels = []
+        rolled_labels = []
+        common_labels = []
+        dup_dic = {}
+        for index, code, rolled in diagnosis:
+            # The original writer only drops the leading space for the row with index 1, keep that as is
+            prefix = '' if index == 1 else ' '
+            regular_labels.append(prefix + '__label__' + code)
+
+            # only insert to the rolled file if not a duplicate
+            if rolled not in dup_dic:
+                dup_dic[rolled] = 1
+                rolled_labels.append(prefix + '__label__' + rolled)
+
+            # the common file keeps duplicates, but only for the top codes
+            if rolled in common_codes:
+                common_labels.append(('' if len(common_labels) == 0 else ' ') + '__label__' + rolled)
+
+        yield item, note, {
+            'regular_input': ''.join(regular_labels),
+            'rolled_input': ''.join(rolled_labels),
+            'rolled_common_input': ''.join(common_labels) if len(note) > 0 and len(common_labels) > 0 else None,
+        }
+
+
+# This method will group the diagnoses by HADM_ID in a single pass over the dataframe
+# Each admit maps to a list of (index, ICD9_CODE, ICD9_CODE_ROLLED) in dataframe order
+def group_diagnoses_by_admit(diagnoses_df) -> dict:
+    diagnoses_by_admit = {}
+    for index, hadm_id, code, rolled in zip(diagnoses_df.index.tolist(), diagnoses_df['HADM_ID'].tolist(),
+                                            diagnoses_df['ICD9_CODE'].tolist(),
+                                            diagnoses_df['ICD9_CODE_ROLLED'].tolist()):
+        diagnoses_by_admit.setdefault(hadm_id, []).append((index, str(code), str(rolled)))
+
+    return diagnoses_by_admit
+
+
+# This method will group the note text by HADM_ID in a single pass over the dataframe, keeping dataframe order
+def group_notes_by_admit(notes_df) -> dict:
+    notes_by_admit = {}
+    for hadm_id, text in zip(notes_df['HADM_ID'].tolist(), notes_df['TEXT'].tolist()):
+        notes_by_admit.setdefault(hadm_id, []).append(str(text))
+
+    return notes_by_admit
+
+
+# This method will count the admits for each rolled ICD9 code, and return the top N most common codes
+# Rolled code 250 (diabetes, common across all records) and the V codes are not counted, and each rolled code is only
+# counted once per admit, dups jack up the common list otherwise
+def count_common_codes(diagnoses_df, unique_admit_list, top_n=10) -> dict:
+    counts = count_admit_codes(diagnoses_df, unique_admit_list)[:top_n]
+
+    return dict(zip(counts.index, counts['count'].tolist()))
+
+
+# This method will count the admits for each rolled ICD9 code, as count_common_codes, most common first
+# Each code also keeps the (admit position, row) it was first seen at - ties in the counts keep that order, and it's
+# what lets the counts of several shards be merged into the same order
+# admit_positions -> position of each admit of unique_admit_list in the full admit list, default is its own position
+def count_admit_codes(diagnoses_df, unique_admit_list, admit_positions=None) -> pd.DataFrame:
+    positions = np.arange(len(unique_admit_list)) if admit_positions is None else np.asarray(admit_positions)
+    admit_positions = pd.Series(positions, index=np.asarray(unique_admit_list))
+
+    # Order rows by admit and then by row, as the writer sees them - ties in the counts keep the order codes are
+    # first seen in
+    admit_codes = diagnoses_df[['HADM_ID', 'ICD9_CODE_ROLLED']].assign(
+        ADMIT_POSITION=diagnoses_df['HADM_ID'].map(admit_positions), ROW=diagnoses_df.index)
+    admit_codes = admit_codes.dropna(subset=['ADMIT_POSITION']).sort_values('ADMIT_POSITION', kind='stable')
+    admit_codes = admit_codes.drop_duplicates(['HADM_ID', 'ICD9_CODE_ROLLED'])
+
+    admit_codes = admit_codes.assign(CODE=admit_codes['ICD9_CODE_ROLLED'].astype(str),
+                                     ADMIT_POSITION=admit_codes['ADMIT_POSITION'].astype(np.int64))
+    admit_codes = admit_codes[(admit_codes['CODE'] != '250') & ~admit_codes['CODE'].str.contains('V', regex=False)]
+
+    counts = admit_codes.groupby('CODE', sort=False).agg(count=('HADM_ID', 'size'),
+                                                         first_position=('ADMIT_POSITION', 'first'),
+                                                         first_row=('ROW', 'first'))
+
+    return counts.sort_values('count', ascending=False, kind='stable')
+
+
+# This method will time the grouped writer against the original per admit scan writer, and check that both of them
+# produce byte identical training files. The files are written to temp directories, cleansed_data is not touched
+def compare_training_writers(notes_df, diagnoses_df, unique_admit_list):
+    my_logger.info("Comparing training file writers ...")
+
+    file_names = ['regular_input.txt', 'rolled_input.txt', 'rolled_common_input.txt']
+
+    with tempfile.TemporaryDirectory() as scan_dir, tempfile.TemporaryDirectory() as grouped_dir:
+        start = time.perf_counter()
+        save_training_files_by_scan(notes_df, diagnoses_df, unique_admit_list, scan_dir + '/')
+        scan_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        save_training_files(notes_df, diagnoses_df, unique_admit_list, grouped_dir + '/')
+        grouped_time = time.perf_counter() - start
+
+        identical = all(filecmp.cmp(os.path.join(scan_dir, name), os.path.join(grouped_dir, name), shallow=False)
+                        for name in file_names)
+
+    my_logger.info(f"  PER ADMIT SCAN WRITER: {scan_time:.2f}s")
+    my_logger.info(f"  GROUPED WRITER: {grouped_time:.2f}s")
+    my_logger.info(f"  SPEEDUP: {scan_time / max(grouped_time, 1e-9):.1f}x")
+    my_logger.info("  OUTPUT BYTE IDENTICAL: " + str(identical))
+
+    return scan_time, grouped_time, identical
+
+
+# ORIGINAL writer for the training files - scans the full notes / diagnoses frames for every admit, three times over.
+# This is kept only as the reference implementation for compare_training_writers, use save_training_files instead
+def save_training_files_by_scan(notes_df, diagnoses_df, unique_admit_list, cleansed_input_filepath='./cleansed_data/'):
+    my_logger.info("Saving cleansed input files (per admit scan) ...")
+
     cleansed_regular = cleansed_input_filepath + 'regular_input.txt'
     cleansed_rolled = cleansed_input_filepath + 'rolled_input.txt'
     cleansed_common_rolled = cleansed_input_filepath + 'rolled_common_input.txt'
@@ -229,86 +606,623 @@ def save_training_files(notes_df, diagnoses_df, unique_admit_list):
     my_logger.info("Statistics for top 10 common ICD9 Rolled codes occurrences")
     my_logger.info(common_codes)
 
+    return common_codes
+
 
 # This method will do a simple 90/10 split of the data into a train and test set. This step is required by fast text
 # as it only allows us to input text files for consumption
-def split_inputs() -> None:
+# Each file is streamed once, and every line is assigned by a seeded hash of its note text, so the split is reproducible,
+# does not depend on row order, and the same admit lands on the same side in the regular / rolled / common files
+#    stratify -> assign within each label set instead, so every label set is split test_fraction / (1 - test_fraction)
+#    folds -> write k partitions (<name>.fold0 ... <name>.fold<k-1>) instead of the .train / .test files
+#    use_store -> read the variants out of the notes store written by save_training_files(use_store=True), and only
+#                 split the trained_variants - the note text is then written out once more, not once per variant
+def split_inputs(test_fraction=.1, seed=0, stratify=False, folds=None,
+                 cleansed_input_filepath='./cleansed_data/', use_store=False) -> None:
     my_logger.info("Splitting cleansed input files ...")
 
-    # Clean up old files, if they exist
-    if os.path.isfile("./cleansed_data/manifest"):
-        os.remove("./cleansed_data/manifest")
-    if os.path.isfile("./cleansed_data/regular_input.test"):
-        os.remove("./cleansed_data/regular_input.test")
-    if os.path.isfile("./cleansed_data/regular_input.train"):
-        os.remove("./cleansed_data/regular_input.train")
-    if os.path.isfile("./cleansed_data/rolled_input.train"):
-        os.remove("./cleansed_data/rolled_input.train")
-    if os.path.isfile("./cleansed_data/rolled_input.test"):
-        os.remove("./cleansed_data/rolled_input.test")
-    if os.path.isfile("./cleansed_data/rolled_common_input.train"):
-        os.remove("./cleansed_data/rolled_common input.train")
-    if os.path.isfile("./cleansed_data/rolled_common_input.test"):
-        os.remove("./cleansed_data/rolled_common input.test")
+    # Left behind by the old filesplit based split, clean it up if it's there
+    if os.path.isfile(cleansed_input_filepath + 'manifest'):
+        os.remove(cleansed_input_filepath + 'manifest')
 
-    with open("./cleansed_data/regular_input.txt", "r") as f:
-        length_of_file = len(f.readlines())
+    # split files of variants that aren't split anymore, from an earlier text file run
+    for variant in training_variants:
+        if variant not in split_variants(use_store):
+            remove_stale_split_files(cleansed_input_filepath + variant, [])
 
-    lines_to_split = math.floor(length_of_file * .9)
+    for variant in split_variants(use_store):
+        if use_store:
+            read_lines = functools.partial(notes_store.iter_variant_lines, cleansed_input_filepath, variant)
+        else:
+            read_lines = functools.partial(open, cleansed_input_filepath + variant + '.txt', 'r', encoding='utf8')
 
-    my_logger.info("Length of regular/rolled_input.txt: " + str(length_of_file))
+        split_input_file(cleansed_input_filepath + variant, test_fraction, seed, stratify, folds, read_lines)
 
-    # create split instance
-    split = Split("./cleansed_data/regular_input.txt", "./cleansed_data")
+    my_logger.info("Input files split.")
 
-    # split file
-    split.bylinecount(lines_to_split)
 
-    # rename the files to TRAIN / TEST
-    os.rename("./cleansed_data/regular_input_1.txt", "./cleansed_data/regular_input.train")
-    os.rename("./cleansed_data/regular_input_2.txt", "./cleansed_data/regular_input.test")
+# This method will split <filepath_stem>.txt into train / test (or fold) files in one pass, see split_inputs
+# read_lines can be passed to read the lines from somewhere else, it's called once per pass over the input
+def split_input_file(filepath_stem, test_fraction=.1, seed=0, stratify=False, folds=None, read_lines=None) -> None:
+    input_filepath = filepath_stem + '.txt'
+    if read_lines is None:
+        read_lines = functools.partial(open, input_filepath, 'r', encoding='utf8')
 
-    # ROLLED CODES NEXT
-    split = Split("./cleansed_data/rolled_input.txt", "./cleansed_data")
+    if not folds and not 0 < test_fraction < 1:
+        raise ValueError('test_fraction must be between 0 and 1, got ' + str(test_fraction))
 
-    # split file
-    split.bylinecount(lines_to_split)
+    output_filepaths = split_output_filepaths(filepath_stem, folds)
+    remove_stale_split_files(filepath_stem, output_filepaths)
+    buckets = stratified_split_buckets(read_lines, test_fraction, seed, folds) if stratify else None
+    counts = [0] * len(output_filepaths)
 
-    # rename the files to TRAIN / TEST
-    os.rename("./cleansed_data/rolled_input_1.txt", "./cleansed_data/rolled_input.train")
-    os.rename("./cleansed_data/rolled_input_2.txt", "./cleansed_data/rolled_input.test")
+    with contextlib.ExitStack() as stack:
+        f = stack.enter_context(contextlib.closing(read_lines()))
+        output_files = [stack.enter_context(open(filepath, 'w', encoding='utf8')) for filepath in output_filepaths]
 
-    # since I cleansed, we need to make this a smaller amount
-    with open("./cleansed_data/rolled_common_input.txt", "r") as f:
-        length_of_file = len(f.readlines())
+        for line_num, line in enumerate(f):
+            bucket = buckets[line_num] if buckets is not None else split_bucket(line, test_fraction, seed, folds)
 
-    lines_to_split = math.floor(length_of_file * .9)
+            output_files[bucket].write(line)
+            counts[bucket] = counts[bucket] + 1
 
-    my_logger.info("Length of rolled_common_input.txt: " + str(length_of_file))
+    my_logger.info("Length of " + os.path.basename(input_filepath) + ": " + str(sum(counts)))
+    for filepath, count in zip(output_filepaths, counts):
+        my_logger.info("  " + os.path.basename(filepath) + ": " + str(count))
 
-    # ROLLED COMMON CODES NEXT
-    split = Split("./cleansed_data/rolled_common_input.txt", "./cleansed_data")
 
-    # split file
-    split.bylinecount(lines_to_split)
+# This method will return the files a split writes to - <stem>.train / <stem>.test, or one <stem>.fold<k> per fold
+def split_output_filepaths(filepath_stem, folds=None) -> list:
+    if folds:
+        if not 1 < folds < 256:
+            raise ValueError('folds must be between 2 and 255, got ' + str(folds))
+        return [filepath_stem + '.fold' + str(fold) for fold in range(folds)]
 
-    # rename the files to TRAIN / TEST
-    os.rename("./cleansed_data/rolled_common_input_1.txt", "./cleansed_data/rolled_common_input.train")
-    os.rename("./cleansed_data/rolled_common_input_2.txt", "./cleansed_data/rolled_common_input.test")
+    return [filepath_stem + '.train', filepath_stem + '.test']
+
+
+# This method will remove the split files of <filepath_stem> a split with other settings left behind - the .train /
+# .test files when splitting into folds, or the folds (of any count) otherwise - so they aren't picked up as current
+def remove_stale_split_files(filepath_stem, output_filepaths: list) -> None:
+    split_dir = os.path.dirname(filepath_stem) or '.'
+    stem_name = os.path.basename(filepath_stem)
+    split_pattern = re.compile(re.escape(stem_name) + r'\.(train|test|fold\d+)')
+
+    for filename in sorted(os.listdir(split_dir)):
+        filepath = os.path.join(split_dir, filename)
+        if split_pattern.fullmatch(filename) and os.path.isfile(filepath) and \
+                os.path.normpath(filepath) not in [os.path.normpath(output) for output in output_filepaths]:
+            os.remove(filepath)
+            my_logger.info("  Removed stale split file " + filename)
+
+
+# This method will assign one line to train (0) / test (1), or to a fold, by the hash of its note
+def split_bucket(line: str, test_fraction=.1, seed=0, folds=None) -> int:
+    if folds:
+        return record_hash(line, seed) % folds
+
+    return 1 if record_hash(line, seed) / 2 ** 64 < test_fraction else 0
+
+
+# This method will assign each line of a file to train (0) / test (1), or to a fold, within its label set
+# Only the hash and line number of each line are kept, the text itself is never held in memory
+def stratified_split_buckets(read_lines, test_fraction=.1, seed=0, folds=None) -> bytearray:
+    strata = {}
+    line_count = 0
+    with contextlib.closing(read_lines()) as f:
+        for line_num, line in enumerate(f):
+            labels, _ = fasttext_reader.split_labels(line)
+            strata.setdefault(' '.join(sorted(set(labels))), []).append((record_hash(line, seed), line_num))
+            line_count = line_num + 1
+
+    buckets = bytearray(line_count)
+    for label_set, members in strata.items():
+        members.sort()
+
+        if folds:
+            # offset the folds per label set, otherwise the small label sets all pile into fold 0
+            offset = record_hash(label_set, seed) % folds
+            for rank, (_, line_num) in enumerate(members):
+                buckets[line_num] = (rank + offset) % folds
+        else:
+            # most label sets are small, so the fractional test row is given out by hash instead of always rounded away
+            test_count = len(members) * test_fraction
+            test_count = int(test_count) + (1 if record_hash(label_set, seed) / 2 ** 64 < test_count % 1 else 0)
+            for rank, (_, line_num) in enumerate(members):
+                buckets[line_num] = 1 if rank < test_count else 0
+
+    return buckets
+
+
+# This method will return the variants that are split into train / test (or fold) files, see split_inputs
+def split_variants(use_store=False) -> list:
+    return trained_variants if use_store else training_variants
+
+
+# This method will return the files (relative to cleansed_input_filepath) that the training files are written to
+def training_output_files(use_store=False, folds=None) -> list:
+    if use_store:
+        filenames = [notes_store.notes_filename] + [variant + notes_store.labels_suffix
+                                                    for variant in training_variants]
+    else:
+        filenames = [variant + '.txt' for variant in training_variants]
+
+    return filenames + [os.path.basename(filepath) for variant in split_variants(use_store)
+                        for filepath in split_output_filepaths(variant, folds)]
+
+
+# This method will build the manifest of a finished run - the admits written, the common codes and split settings they
+# were written with, and the size of every training file (plus the admit count of the notes store) at that point
+def build_manifest(admits, common_codes: dict, split_settings: dict,
+                   cleansed_input_filepath='./cleansed_data/') -> dict:
+    filenames = training_output_files(split_settings['use_store'], split_settings['folds'])
+
+    return {
+        'admits': sorted(int(admit) for admit in admits),
+        'common_codes': common_codes,
+        'split': split_settings,
+        'file_sizes': {filename: os.path.getsize(cleansed_input_filepath + filename) for filename in filenames
+                       if os.path.isfile(cleansed_input_filepath + filename)},
+        'store_admits': len(np.load(cleansed_input_filepath + notes_store.index_filename, mmap_mode='r'))
+        if split_settings['use_store'] else None,
+    }
+
+
+# This method will load the manifest of processed admits, None if there isn't one yet
+def load_manifest(cleansed_input_filepath='./cleansed_data/'):
+    manifest_filepath = cleansed_input_filepath + manifest_filename
+    if not os.path.isfile(manifest_filepath):
+        return None
+
+    with open(manifest_filepath, 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+# This method will save the manifest, under a temp name and then renamed - it's the last thing a run writes
+def save_manifest(manifest: dict, cleansed_input_filepath='./cleansed_data/') -> None:
+    manifest_filepath = cleansed_input_filepath + manifest_filename
+    with open(manifest_filepath + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_filepath + '.tmp', manifest_filepath)
+
+
+# This method will cut the training files back to the sizes in the manifest, dropping anything an interrupted
+# incremental run appended after it
+def rollback_to_manifest(manifest: dict, cleansed_input_filepath='./cleansed_data/') -> None:
+    for filename, size in manifest['file_sizes'].items():
+        filepath = cleansed_input_filepath + filename
+        if os.path.isfile(filepath) and os.path.getsize(filepath) > size:
+            my_logger.warning('  ROLLING BACK ' + filename + ' to ' + str(size) + ' bytes (interrupted run)')
+            os.truncate(filepath, size)
+
+    if manifest['store_admits'] is not None:
+        notes_store.truncate_store(cleansed_input_filepath, manifest['store_admits'])
+
+
+# This method will append the training records of new admits to the training files, and to the train / test (or fold)
+# files by the same hash assignment split_inputs uses. The common codes are the ones the files were first written with,
+# so every row of the common file is labelled against the same top codes
+def append_training_files(notes_df, diagnoses_df, new_admit_list, manifest: dict,
+                          cleansed_input_filepath='./cleansed_data/') -> None:
+    split_settings = manifest['split']
+    records = list(iter_training_records(notes_df, diagnoses_df, new_admit_list, manifest['common_codes']))
+
+    if split_settings['use_store']:
+        notes_store.write_store(cleansed_input_filepath, records, training_variants, append=True)
+
+    with contextlib.ExitStack() as stack:
+        split_files = {variant: [stack.enter_context(open(filepath, 'a', encoding='utf8'))
+                                 for filepath in split_output_filepaths(cleansed_input_filepath + variant,
+                                                                        split_settings['folds'])]
+                       for variant in split_variants(split_settings['use_store'])}
+        text_files = {} if split_settings['use_store'] else {
+            variant: stack.enter_context(open(cleansed_input_filepath + variant + '.txt', 'a', encoding='utf8'))
+            for variant in training_variants}
+
+        counts = dict.fromkeys(training_variants, 0)
+        for _, note, labels_by_variant in records:
+            for variant, labels in labels_by_variant.items():
+                if labels is None:
+                    continue
+                line = labels + note + '\n'
+                if variant in text_files:
+                    text_files[variant].write(line)
+                if variant in split_files:
+                    bucket = split_bucket(line, split_settings['test_fraction'], split_settings['seed'],
+                                          split_settings['folds'])
+                    split_files[variant][bucket].write(line)
+                counts[variant] = counts[variant] + 1
+
+    for variant, count in counts.items():
+        my_logger.info("  " + variant + ": " + str(count) + " rows appended")
+
+
+# This method will run the incremental mode - only the admits that aren't in the manifest are cleansed, and their
+# records are appended to the training files that are already there. Admits that were processed before are not looked
+# at again, even if their diagnoses changed - run a full cleanse for that
+# Stratified splits can't be extended row by row, new rows are assigned by hash instead
+def ingest_new_admits(manifest: dict, unique_subject_list, unique_admit_list, diagnoses_df,
+                      cleansed_input_filepath='./cleansed_data/', **notes_options) -> dict:
+    my_logger.info("Incremental run ... " + str(len(manifest['admits'])) + " admits already processed")
+    if manifest['split']['stratify']:
+        my_logger.warning("  The training files were split with --stratify, new rows are split by hash")
+
+    rollback_to_manifest(manifest, cleansed_input_filepath)
+
+    unique_admit_list = np.asarray(unique_admit_list)
+    new_admit_list = unique_admit_list[~np.isin(unique_admit_list, np.asarray(manifest['admits'], dtype=np.int64))]
+    my_logger.info("  NUMBER OF NEW ADMITS: " + str(len(new_admit_list)))
+
+    if len(new_admit_list) == 0:
+        return manifest
+
+    # the new admits are only cleansed once, their entry is replaced by the next incremental run's
+    notes_df = cleanse_notes(unique_subject_list, new_admit_list, cache_slot='notes_incremental', **notes_options)
+    append_training_files(notes_df, diagnoses_df, new_admit_list, manifest, cleansed_input_filepath)
+
+    manifest = build_manifest(manifest['admits'] + new_admit_list.tolist(), manifest['common_codes'],
+                              manifest['split'], cleansed_input_filepath)
+    save_manifest(manifest, cleansed_input_filepath)
+
+    return manifest
+
+
+# This method will assign subjects to one of shards shards by a hash of their SUBJECT_ID, the same on every machine
+def subject_shards(subject_ids, shards: int) -> np.ndarray:
+    return np.array([int.from_bytes(hashlib.blake2b(str(int(subject_id)).encode('utf8'), digest_size=8).digest(),
+                                    'big') % shards for subject_id in np.asarray(subject_ids).tolist()], dtype=np.int64)
+
+
+# This method will return the directory the partial outputs of one shard are written to
+def shard_dirpath(shard: int, shards: int, cleansed_input_filepath='./cleansed_data/') -> str:
+    return cleansed_input_filepath + shards_dirname + str(shards) + '_shards/shard_' + str(shard) + '/'
+
+
+# This method will cleanse one shard - the patients whose SUBJECT_ID hashes to it - into partial training files
+#   <variant>.part -> the shard's lines of each training file, in the order of the full admit list
+#   <variant>.positions.npy -> position in the full admit list of every line of the .part file, the merge key
+#   shard.json -> written last, marks the shard as done: admits (position, HADM_ID), the shard's code counts and the
+#                 digests of the input files
+# The common codes are only known once every shard is counted, so the common variant is written with every code that
+# could be common, merge_shards drops the ones that aren't. Only the shard's notes are ever held in memory, the notes
+# file is still read (and decompressed) in full by every shard
+def cleanse_shard(shard: int, shards: int, unique_subject_list, unique_admit_list, diagnoses_df,
+                  cleansed_input_filepath='./cleansed_data/', **notes_options) -> dict:
+    shard_filepath = shard_dirpath(shard, shards, cleansed_input_filepath)
+    os.makedirs(shard_filepath, exist_ok=True)
+    # a shard that's being rewritten is not done
+    if os.path.isfile(shard_filepath + shard_marker_filename):
+        os.remove(shard_filepath + shard_marker_filename)
+
+    subject_list = np.asarray(unique_subject_list)
+    shard_subjects = subject_list[subject_shards(subject_list, shards) == shard]
+
+    admit_list = np.asarray(unique_admit_list)
+    admit_subjects = diagnoses_df.drop_duplicates('HADM_ID').set_index('HADM_ID')['SUBJECT_ID']
+    admit_positions = np.flatnonzero(np.isin(admit_subjects.reindex(admit_list).to_numpy(), shard_subjects))
+    shard_admits = admit_list[admit_positions]
+
+    my_logger.info("Cleansing shard " + str(shard) + " of " + str(shards) + " ... " + str(len(shard_subjects)) +
+                   " patients, " + str(len(shard_admits)) + " admits")
+
+    notes_df = cleanse_notes(shard_subjects, shard_admits, cache_slot='notes_shard' + str(shard) + 'of' + str(shards),
+                             **notes_options)
+    shard_diagnoses = diagnoses_df[diagnoses_df['SUBJECT_ID'].isin(shard_subjects)]
+
+    # every rolled code that count_common_codes could pick
+    rolled_codes = shard_diagnoses['ICD9_CODE_ROLLED'].astype(str).unique().tolist()
+    candidate_codes = {code: 0 for code in rolled_codes if code != '250' and 'V' not in code}
+    records = iter_training_records(notes_df, shard_diagnoses, shard_admits, candidate_codes)
+
+    position_of = dict(zip(shard_admits.tolist(), admit_positions.tolist()))
+    line_positions = {variant: [] for variant in training_variants}
+    with contextlib.ExitStack() as stack:
+        output_files = {variant: stack.enter_context(open(shard_filepath + variant + '.part', 'w', encoding='utf8'))
+                        for variant in training_variants}
+
+        for hadm_id, note, labels_by_variant in records:
+            for variant, labels in labels_by_variant.items():
+                if labels is not None:
+                    output_files[variant].write(labels + note + '\n')
+                    line_positions[variant].append(position_of[hadm_id])
+
+    for variant in training_variants:
+        np.save(shard_filepath + variant + '.positions.npy', np.array(line_positions[variant], dtype=np.int64))
+
+    code_counts = count_admit_codes(shard_diagnoses, shard_admits, admit_positions)
+    marker = {
+        'shard': shard,
+        'shards': shards,
+        'input_digests': [file_digest('./data/' + diag_file), file_digest('./data/' + noteevents_file)],
+        'admits': np.stack([admit_positions, shard_admits]).T.tolist(),
+        'lines': {variant: len(positions) for variant, positions in line_positions.items()},
+        'code_counts': [[code] + [int(value) for value in row] for code, row in
+                        zip(code_counts.index, code_counts[['count', 'first_position', 'first_row']].to_numpy())],
+    }
+    with open(shard_filepath + shard_marker_filename + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(marker, f)
+    os.replace(shard_filepath + shard_marker_filename + '.tmp', shard_filepath + shard_marker_filename)
+
+    my_logger.info("Shard " + str(shard) + " of " + str(shards) + " written into " + shard_filepath)
+
+    return marker
+
+
+# This method will keep only the common code labels of a line of the common variant as a shard writes it, None when
+# none of them are common. The labels of those lines are single spaced and the note text starts with a space
+def filter_common_labels(line: str, common_codes: dict):
+    labels, _ = fasttext_reader.split_labels(line)
+    note = line[len(' '.join(labels)):]
+    kept = [label for label in labels if label[len(fasttext_reader.label_prefix):] in common_codes]
+
+    return ' '.join(kept) + note if kept else None
+
+
+# This method will merge the partial outputs of all shards into the training files, byte for byte what a single
+# process run writes: the shard code counts are summed into the global top N common codes, and the lines of every
+# variant are k-way merged on their position in the full admit list, so only one line per shard is held at a time
+# Returns (admits in full admit list order, common codes)
+def merge_shards(shards: int, cleansed_input_filepath='./cleansed_data/', top_n=10):
+    my_logger.info("Merging " + str(shards) + " shards ...")
+
+    markers = []
+    missing = []
+    for shard in range(shards):
+        marker_filepath = shard_dirpath(shard, shards, cleansed_input_filepath) + shard_marker_filename
+        if not os.path.isfile(marker_filepath):
+            missing.append(str(shard))
+            continue
+        with open(marker_filepath, 'r', encoding='utf8') as f:
+            markers.append(json.load(f))
+
+    if missing:
+        raise ValueError('shard(s) ' + ', '.join(missing) + ' of ' + str(shards) + ' are not done, run clean_data.py '
+                         '--shards ' + str(shards) + ' --shard <i> for them first')
+    if len({tuple(marker['input_digests']) for marker in markers}) > 1:
+        raise ValueError('the shards were cleansed from different input files, rerun the stale ones')
+
+    # the earliest first sighting of a code across the shards is its first sighting in the full admit list
+    code_counts = pd.DataFrame([row for marker in markers for row in marker['code_counts']],
+                               columns=['code', 'count', 'first_position', 'first_row'])
+    code_counts = code_counts.sort_values(['first_position', 'first_row'], kind='stable').groupby('code', sort=False)
+    code_counts = code_counts.agg(count=('count', 'sum')).sort_values('count', ascending=False, kind='stable')[:top_n]
+    common_codes = dict(zip(code_counts.index, code_counts['count'].tolist()))
+
+    # the merged text files replace any store an earlier --notes-store run left behind
+    notes_store.remove_store(cleansed_input_filepath, training_variants)
+    for variant in training_variants:
+        with contextlib.ExitStack() as stack:
+            shard_lines = [zip(np.load(shard_dirpath(shard, shards, cleansed_input_filepath) + variant +
+                                       '.positions.npy').tolist(),
+                               stack.enter_context(open(shard_dirpath(shard, shards, cleansed_input_filepath) +
+                                                        variant + '.part', 'r', encoding='utf8')))
+                           for shard in range(shards)]
+            output_filepath = cleansed_input_filepath + variant + '.txt'
+            with open(output_filepath + '.tmp', 'w', encoding='utf8') as f:
+                for _, line in heapq.merge(*shard_lines, key=itemgetter(0)):
+                    if variant == 'rolled_common_input':
+                        line = filter_common_labels(line, common_codes)
+                    if line is not None:
+                        f.write(line)
+        os.replace(output_filepath + '.tmp', output_filepath)
+
+    admits = sorted(admit for marker in markers for admit in marker['admits'])
+
+    # Print statistics for the common codes - will not include rolled code 250
+    my_logger.info("Statistics for top 10 common ICD9 Rolled codes occurrences")
+    my_logger.info(common_codes)
+
+    return [hadm_id for _, hadm_id in admits], common_codes
+
+
+# This method will run every shard on this machine, each in a process of its own, then they can be merged
+# shard_args -> the command line options passed on to every shard, shard_processes -> shards running at once
+def run_local_shards(shards: int, shard_args: list, shard_processes=None, cleansed_input_filepath='./cleansed_data/'):
+    def run_shard(shard):
+        log_filepath = shard_dirpath(shard, shards, cleansed_input_filepath) + 'cleanse.log'
+        os.makedirs(os.path.dirname(log_filepath), exist_ok=True)
+        with open(log_filepath, 'w', encoding='utf8') as log_file:
+            result = subprocess.run([sys.executable, os.path.abspath(__file__), '--shards', str(shards), '--shard',
+                                     str(shard)] + shard_args, stdout=log_file, stderr=subprocess.STDOUT)
+        return shard, result.returncode, log_filepath
+
+    my_logger.info("Running " + str(shards) + " shards, " + str(shard_processes or shards) + " at a time ...")
+    with ThreadPoolExecutor(max_workers=shard_processes or shards) as executor:
+        results = list(executor.map(run_shard, range(shards)))
+
+    failed = [(shard, log_filepath) for shard, return_code, log_filepath in results if return_code != 0]
+    for shard, log_filepath in failed:
+        my_logger.error("  shard " + str(shard) + " FAILED, see " + log_filepath)
+    if failed:
+        raise RuntimeError(str(len(failed)) + ' of ' + str(shards) + ' shards failed')
+
+
+# This method will return a seeded 64 bit hash of a line, taken over the note text so the regular / rolled / common
+# versions of the same admit hash the same. Lines with no note text are hashed whole
+def record_hash(line: str, seed=0) -> int:
+    _, text = fasttext_reader.parse_line(line)
+    key = (text or line).encode('utf8')
+    digest = hashlib.blake2b(key, digest_size=8, key=str(seed).encode('utf8')).digest()
+
+    return int.from_bytes(digest, 'big')
 
-    my_logger.info("Input files split.")
 
 # Main method - python will automatically run this
 if __name__ == '__main__':
-    unique_subject_list, unique_admit_list, diagnoses_df = cleanse_diagnoses()
-    notes_df = cleanse_notes(unique_subject_list, unique_admit_list)
+    parser = argparse.ArgumentParser(description='Cleanse the MIMIC-III diagnoses and notes into training files')
+    parser.add_argument('--compare-writers', action='store_true',
+                        help='time the grouped training file writer against the original per admit scan writer')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes used for note normalization (default: all cores, 1 runs inline)')
+    parser.add_argument('--chunk-size', type=int, default=5000,
+                        help='number of NOTEEVENTS rows read per chunk, chunks are shrunk to fit --memory-budget-mb')
+    parser.add_argument('--memory-budget-mb', type=int, default=256,
+                        help='memory budget for reading NOTEEVENTS: half for the raw chunk, half for the chunks '
+                             'waiting on the workers (the cleansed notes that are kept are not counted)')
+    parser.add_argument('--rebuild-cache', action='store_true',
+                        help='ignore the cached diagnoses / notes and rebuild them from the input files')
+    parser.add_argument('--test-fraction', type=float, default=.1,
+                        help='fraction of each input file that goes to the .test file')
+    parser.add_argument('--split-seed', type=int, default=0,
+                        help='seed for the hash based train / test assignment')
+    parser.add_argument('--stratify', action='store_true',
+                        help='split within each label set instead of over the whole file')
+    parser.add_argument('--folds', type=int, default=None,
+                        help='write this many fold partitions instead of the .train / .test files')
+    parser.add_argument('--notes-store', action='store_true',
+                        help='store the notes once with a label file per variant, instead of three full text files')
+    parser.add_argument('--no-split', action='store_true',
+                        help="write the training files, but don't split them (see --split-only)")
+    parser.add_argument('--split-only', action='store_true',
+                        help='only split the training files that are already in cleansed_data')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only cleanse admits that are not in the manifest of processed admits, and append them '
+                             'to the existing training files (the split options of the first run are kept)')
+    parser.add_argument('--metrics-dir', default='./metrics',
+                        help='directory the per stage metrics (json per run, csv across runs) are written to')
+    parser.add_argument('--profile', nargs='+', default=[],
+                        help="run these stages under cProfile ('all' for every stage), e.g. cleanse_notes")
+    parser.add_argument('--shards', type=int, default=None,
+                        help='cleanse the patients in this many shards (by a hash of SUBJECT_ID), each in a process '
+                             'of its own, and merge their partial outputs')
+    parser.add_argument('--shard', type=int, default=None,
+                        help='only cleanse this shard (0 based) of --shards, e.g. one machine of several sharing the '
+                             'filesystem - run --merge once every shard is done')
+    parser.add_argument('--merge', action='store_true',
+                        help='only merge the partial outputs of --shards shards into the training files')
+    parser.add_argument('--shard-processes', type=int, default=None,
+                        help='shards run at once on this machine (default: all of them)')
+    args = parser.parse_args()
+
+    if args.shards is not None:
+        if args.shards < 1 or (args.shard is not None and not 0 <= args.shard < args.shards):
+            parser.error('--shard has to be between 0 and --shards - 1')
+        if args.notes_store or args.incremental or args.compare_writers:
+            parser.error('--shards writes the text training files, it can\'t be combined with --notes-store, '
+                         '--incremental or --compare-writers')
+    elif args.shard is not None or args.merge:
+        parser.error('--shard / --merge need --shards')
+    if not args.folds and not 0 < args.test_fraction < 1:
+        parser.error('--test-fraction has to be between 0 and 1')
+
+    split_settings = {'test_fraction': args.test_fraction, 'seed': args.split_seed, 'stratify': args.stratify,
+                      'folds': args.folds, 'use_store': args.notes_store}
+    run_metrics = RunMetrics('clean_data', args.metrics_dir, args.profile)
+    cleansed_filepath = './cleansed_data/'
+    split_files = [cleansed_filepath + os.path.basename(filepath) for variant in split_variants(args.notes_store)
+                   for filepath in split_output_filepaths(variant, args.folds)]
+    written_files = [cleansed_filepath + filename for filename in training_output_files(args.notes_store, args.folds)
+                     if cleansed_filepath + filename not in split_files]
+
+    if args.split_only:
+        with run_metrics.stage('split', bytes_read=file_bytes(*written_files)) as record:
+            split_inputs(test_fraction=args.test_fraction, seed=args.split_seed, stratify=args.stratify,
+                         folds=args.folds, use_store=args.notes_store)
+            record['bytes_written'] = file_bytes(*split_files)
+
+        # the manifest has to match the new split files, or an incremental run would roll them back
+        manifest = load_manifest()
+        if manifest is not None:
+            save_manifest(build_manifest(manifest['admits'], manifest['common_codes'], split_settings))
+        run_metrics.write()
+        my_logger.info("SPLIT COMPLETE")
+        sys.exit(0)
+
+    if args.shards is not None and args.shard is not None:
+        # One shard only - the patients of every other shard are skipped
+        run_metrics = RunMetrics('clean_data_shard' + str(args.shard), args.metrics_dir, args.profile)
+        with run_metrics.stage('cleanse_diagnoses', bytes_read=file_bytes('./data/' + diag_file)) as record:
+            unique_subject_list, unique_admit_list, diagnoses_df = cleanse_diagnoses(rebuild_cache=args.rebuild_cache)
+            record['rows'] = len(diagnoses_df)
+
+        with run_metrics.stage('cleanse_shard', bytes_read=file_bytes('./data/' + noteevents_file)) as record:
+            shard_marker = cleanse_shard(args.shard, args.shards, unique_subject_list, unique_admit_list,
+                                         diagnoses_df, workers=args.workers, chunk_size=args.chunk_size,
+                                         memory_budget_mb=args.memory_budget_mb, rebuild_cache=args.rebuild_cache)
+            record['rows'] = len(shard_marker['admits'])
+        run_metrics.write()
+        my_logger.info("SHARD CLEANSING COMPLETE")
+        sys.exit(0)
+
+    if args.shards is not None:
+        if not args.merge:
+            # the diagnoses are cached once up front, instead of by every shard at once
+            if not args.rebuild_cache:
+                with run_metrics.stage('cleanse_diagnoses', bytes_read=file_bytes('./data/' + diag_file)):
+                    cleanse_diagnoses()
+
+            shard_args = ['--chunk-size', str(args.chunk_size), '--memory-budget-mb', str(args.memory_budget_mb),
+                          '--metrics-dir', args.metrics_dir, '--workers',
+                          str(max(1, (args.workers or os.cpu_count() or 1) // (args.shard_processes or args.shards)))]
+            shard_args = shard_args + (['--rebuild-cache'] if args.rebuild_cache else []) + \
+                (['--profile'] + args.profile if args.profile else [])
+            with run_metrics.stage('cleanse_shards', bytes_read=file_bytes('./data/' + noteevents_file)):
+                run_local_shards(args.shards, shard_args, args.shard_processes)
+
+        with run_metrics.stage('merge_shards') as record:
+            unique_admit_list, common_codes = merge_shards(args.shards)
+            record['rows'] = len(unique_admit_list)
+            record['bytes_written'] = file_bytes(*written_files)
+
+        if not args.no_split:
+            with run_metrics.stage('split', bytes_read=file_bytes(*written_files)) as record:
+                split_inputs(test_fraction=args.test_fraction, seed=args.split_seed, stratify=args.stratify,
+                             folds=args.folds)
+                record['bytes_written'] = file_bytes(*split_files)
+
+        save_manifest(build_manifest(unique_admit_list, common_codes, split_settings))
+        run_metrics.write()
+        my_logger.info("SHARDED CLEANSING COMPLETE")
+        sys.exit(0)
+
+    manifest = load_manifest() if args.incremental else None
+    if args.incremental and manifest is None:
+        my_logger.warning("No manifest of processed admits found, running a full cleanse")
+
+    with run_metrics.stage('cleanse_diagnoses', bytes_read=file_bytes('./data/' + diag_file)) as record:
+        unique_subject_list, unique_admit_list, diagnoses_df = cleanse_diagnoses(rebuild_cache=args.rebuild_cache)
+        record['rows'] = len(diagnoses_df)
+
+    if manifest is not None:
+        with run_metrics.stage('ingest_new_admits', bytes_read=file_bytes('./data/' + noteevents_file)) as record:
+            bytes_before = file_bytes(*written_files, *split_files)
+            admits_before = len(manifest['admits'])
+            manifest = ingest_new_admits(manifest, unique_subject_list, unique_admit_list, diagnoses_df,
+                                         workers=args.workers, chunk_size=args.chunk_size,
+                                         memory_budget_mb=args.memory_budget_mb, rebuild_cache=args.rebuild_cache)
+            record['rows'] = len(manifest['admits']) - admits_before
+            record['bytes_written'] = file_bytes(*written_files, *split_files) - bytes_before
+        run_metrics.write()
+        my_logger.info("INCREMENTAL CLEANSING COMPLETE")
+        sys.exit(0)
+
+    with run_metrics.stage('cleanse_notes', bytes_read=file_bytes('./data/' + noteevents_file)) as record:
+        notes_df = cleanse_notes(unique_subject_list, unique_admit_list, workers=args.workers,
+                                 chunk_size=args.chunk_size, memory_budget_mb=args.memory_budget_mb,
+                                 rebuild_cache=args.rebuild_cache)
+        record['rows'] = len(notes_df)
 
     # Debug only
     #my_logger.info(notes_df['CATEGORY'].unique())
     #my_logger.info(notes_df[notes_df['HADM_ID'] == 140784])
     #my_logger.info(diagnoses_df[diagnoses_df['HADM_ID'] == 140784])
 
-    save_training_files(notes_df, diagnoses_df, unique_admit_list)
-    split_inputs()
+    if args.compare_writers:
+        with run_metrics.stage('compare_writers'):
+            compare_training_writers(notes_df, diagnoses_df, unique_admit_list)
+
+    with run_metrics.stage('write_training_files', rows=len(unique_admit_list)) as record:
+        common_codes = save_training_files(notes_df, diagnoses_df, unique_admit_list, use_store=args.notes_store)
+        record['bytes_written'] = file_bytes(*written_files)
+
+    if not args.no_split:
+        with run_metrics.stage('split', bytes_read=file_bytes(*written_files)) as record:
+            split_inputs(test_fraction=args.test_fraction, seed=args.split_seed, stratify=args.stratify,
+                         folds=args.folds, use_store=args.notes_store)
+            record['bytes_written'] = file_bytes(*split_files)
+
+    # Record what was written, so a later --incremental run only has to process the new admits
+    save_manifest(build_manifest(unique_admit_list, common_codes, split_settings))
+    run_metrics.write()
 
     my_logger.info("CLEANSING COMPLETE")
@@ -0,0 +1,87 @@
+# This will build a compressed version of a trained BOT model, and compare it against the full model
+# Compression uses fastText's quantize - vocabulary pruning (cutoff), product quantization (dsub) and optionally
+# retraining after the pruning - and can start from a model trained with fewer dims. The report covers file size, load
+# time, per note prediction latency and the precision / recall deltas against the full model
+import logging
+import os
+import time
+
+import fasttext
+import numpy as np
+
+from fasttext_reader import parse_line
+
+my_logger = logging.getLogger('classifier_project')
+
+
+# This method will profile a saved model on the test file - file size, load time, per note latency, precision / recall
+# Latency is measured one note at a time, as a scoring worker would see it, over the first latency_notes notes
+def profile_model(model_filepath, test_filepath, latency_notes=1000) -> dict:
+    start = time.perf_counter()
+    model = fasttext.load_model(model_filepath)
+    load_seconds = time.perf_counter() - start
+
+    texts = []
+    with open(test_filepath, 'r', encoding='utf8') as f:
+        for line in f:
+            texts.append(parse_line(line)[1])
+            if len(texts) >= latency_notes:
+                break
+
+    latencies = []
+    for text in texts:
+        start = time.perf_counter()
+        model.predict(text)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies = np.array(latencies) if latencies else np.zeros(1)
+
+    _, precision, recall = model.test(test_filepath)
+
+    return {
+        'model': os.path.basename(model_filepath),
+        'size_mb': round(os.path.getsize(model_filepath) / 1024 / 1024, 2),
+        'load_seconds': round(load_seconds, 3),
+        'latency_ms_p50': round(float(np.percentile(latencies, 50)), 3),
+        'latency_ms_p99': round(float(np.percentile(latencies, 99)), 3),
+        'precision': round(precision, 6),
+        'recall': round(recall, 6),
+    }
+
+
+# This method will build the compressed model, save it, and log the comparison against the full model
+# compressed_dim -> train a fresh model with this many dims (and the rest of train_params) before quantizing it,
+#    otherwise the full model is quantized as is
+def compress_model(full_model_filepath, compressed_model_filepath, train_filepath, test_filepath, train_params: dict,
+                   cutoff=100000, dsub=2, qnorm=True, retrain=True, compressed_dim=None) -> dict:
+    my_logger.info("Building the compressed model ...")
+
+    if compressed_dim is not None:
+        my_logger.info("  Training a " + str(compressed_dim) + " dim model to compress ...")
+        model = fasttext.train_supervised(input=train_filepath, **dict(train_params, dim=compressed_dim))
+    else:
+        model = fasttext.load_model(full_model_filepath)
+
+    # retrain fine tunes the embeddings that survive the cutoff, so it needs the training parameters again
+    quantize_params = {name: value for name, value in train_params.items() if name in ('epoch', 'lr', 'thread')}
+    model.quantize(input=train_filepath, cutoff=cutoff, dsub=dsub, qnorm=qnorm, retrain=retrain, **quantize_params)
+    model.save_model(compressed_model_filepath)
+    my_logger.info("Compressed model saved into " + compressed_model_filepath)
+
+    full = profile_model(full_model_filepath, test_filepath)
+    compressed = profile_model(compressed_model_filepath, test_filepath)
+    report = {
+        'full': full,
+        'compressed': compressed,
+        'size_ratio': round(compressed['size_mb'] / max(full['size_mb'], 1e-9), 4),
+        'precision_delta': round(compressed['precision'] - full['precision'], 6),
+        'recall_delta': round(compressed['recall'] - full['recall'], 6),
+    }
+
+    my_logger.info("Compression report (cutoff " + str(cutoff) + ", dsub " + str(dsub) + ", dim " +
+                   str(compressed_dim or 'unchanged') + "):")
+    for name in ['size_mb', 'load_seconds', 'latency_ms_p50', 'latency_ms_p99', 'precision', 'recall']:
+        my_logger.info(f"  {name:>15}: full {full[name]:>10}  compressed {compressed[name]:>10}")
+    my_logger.info("  size ratio: " + str(report['size_ratio']) + ", precision delta: " +
+                   str(report['precision_delta']) + ", recall delta: " + str(report['recall_delta']))
+
+    return report
@@ -1,6 +1,25 @@
 # This will evaluate the models!
+# Batch scoring of new discharge summaries with the saved fastText models. Notes are read from a NOTEEVENTS style csv
+# (gzip is fine), normalized the same way as clean_data.cleanse_notes, and predicted in batches across a pool of worker
+# processes - each worker loads the models once. The top k labels per note and model are written out to a csv
+# With --evaluate, the input is a cleansed fastText format test file instead, and the BOT / CNN models are compared
+# with the multi label metrics in multilabel_metrics.py - see evaluate_models
+import argparse
+import csv
+import json
 import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import fasttext
+import numpy as np
+import pandas as pd
+
+import multilabel_metrics
+from clean_data import normalize_text
+from fasttext_reader import parse_line
 
 # Set Logging -- basic configuration
 logging.basicConfig(format='%(asctime)s -- %(levelname)s: %(message)s',
@@ -8,3 +27,268 @@ logging.basicConfig(format='%(asctime)s -- %(levelname)s: %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
 my_logger = logging.getLogger('classifier_project')
 
+# Models scored by default, as saved by the BOT training scripts
+default_models = ['./models/model_rolled_common_BINARY_BOT.bin', './models/model_rolled_common_MULTI_BOT.bin']
+
+# Saved by train_common_rolled_BINARY_CNN.py
+default_keras_model = './models/model_rolled_common_CNN.keras'
+default_keras_labels = './models/model_rolled_common_CNN_labels.json'
+
+# Models loaded into this process by load_worker_models - each worker process has its own copy
+worker_models = {}
+
+
+# This method will load the models into the current process, it's the initializer for the worker processes
+def load_worker_models(model_filepaths: list) -> None:
+    for model_filepath in model_filepaths:
+        worker_models[os.path.basename(model_filepath)] = fasttext.load_model(model_filepath)
+
+
+# This method will normalize and predict one batch of notes with every loaded model
+# Returns the output rows (id, model, rank, label, probability), the number of notes and the time taken for the batch
+def predict_batch(ids: list, texts: list, k=3, threshold=0.0):
+    start = time.perf_counter()
+    normalized = [normalize_text(str(text)) for text in texts]
+
+    rows = []
+    for model_name, model in worker_models.items():
+        labels, probabilities = model.predict(normalized, k=k, threshold=threshold)
+        for note_id, note_labels, note_probabilities in zip(ids, labels, probabilities):
+            for rank, (label, probability) in enumerate(zip(note_labels, note_probabilities), start=1):
+                rows.append((note_id, model_name, rank, label.replace('__label__', ''), round(float(probability), 6)))
+
+    return rows, len(texts), time.perf_counter() - start
+
+
+# This method will yield (ids, texts) batches of notes from a NOTEEVENTS style csv, only reading the needed columns
+# category -> only score notes of this CATEGORY, e.g. 'Discharge summary'. None scores every note
+def iter_note_batches(input_filepath, id_column='HADM_ID', batch_size=256, category=None):
+    columns = [id_column, 'TEXT'] + (['CATEGORY'] if category is not None else [])
+
+    # ids are kept as text, so a blank HADM_ID doesn't turn the whole column into floats
+    with pd.read_csv(input_filepath, header=0, sep=',', quotechar='"', usecols=columns, dtype={id_column: str},
+                     chunksize=batch_size) as reader:
+        for chunk in reader:
+            if category is not None:
+                chunk = chunk[chunk['CATEGORY'] == category]
+            chunk = chunk.dropna(subset=['TEXT'])
+
+            if len(chunk) > 0:
+                yield chunk[id_column].fillna('').tolist(), chunk['TEXT'].tolist()
+
+
+# This method will score every note of input_filepath with the models, and write the top k labels to output_filepath
+# workers=1 runs everything inline. Returns the throughput / latency report, which is also logged
+def score_notes(input_filepath, output_filepath, model_filepaths=None, k=3, threshold=0.0, batch_size=256,
+                workers=None, id_column='HADM_ID', category=None) -> dict:
+    model_filepaths = model_filepaths or default_models
+    workers = workers or os.cpu_count() or 1
+
+    my_logger.info("Scoring notes from " + input_filepath + " with " + str(len(model_filepaths)) + " model(s) ...")
+    my_logger.info("  WORKERS: " + str(workers) + ", BATCH SIZE: " + str(batch_size) + ", TOP K: " + str(k))
+
+    start = time.perf_counter()
+    note_count = 0
+    batch_latencies = []
+    pending = deque()
+    executor = None
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=load_worker_models,
+                                       initargs=(model_filepaths,))
+    else:
+        load_worker_models(model_filepaths)
+
+    # collects a finished batch and writes it out - batches are written in the order they were read
+    def write_batch(result):
+        nonlocal note_count
+        rows, batch_notes, latency = result
+        writer.writerows(rows)
+        note_count = note_count + batch_notes
+        batch_latencies.append(latency)
+
+    try:
+        with open(output_filepath, 'w', encoding='utf8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow([id_column, 'MODEL', 'RANK', 'LABEL', 'PROBABILITY'])
+
+            for ids, texts in iter_note_batches(input_filepath, id_column, batch_size, category):
+                if executor is None:
+                    write_batch(predict_batch(ids, texts, k, threshold))
+                    continue
+
+                pending.append(executor.submit(predict_batch, ids, texts, k, threshold))
+
+                # Keep a bounded number of batches in flight, so the reader doesn't run away from the workers
+                while len(pending) > workers * 2:
+                    write_batch(pending.popleft().result())
+
+            while pending:
+                write_batch(pending.popleft().result())
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    elapsed = time.perf_counter() - start
+    report = throughput_report(note_count, elapsed, batch_latencies, batch_size, workers)
+    log_report("Scoring report", report)
+
+    return report
+
+
+# This method will load the Keras model saved by the CNN script, and its label vocabulary
+def load_keras_model(keras_model_filepath, keras_labels_filepath):
+    # tensorflow is slow to import and only needed for this model
+    from tensorflow import keras
+
+    with open(keras_labels_filepath, 'r') as f:
+        labels = json.load(f)
+
+    return keras.models.load_model(keras_model_filepath), labels
+
+
+# This method will read a cleansed fastText format file into the label list (without __label__) and text of each note
+def read_test_file(test_filepath):
+    label_lists = []
+    texts = []
+    with open(test_filepath, 'r', encoding='utf8') as f:
+        for line in f:
+            labels, text = parse_line(line)
+            label_lists.append([label.replace('__label__', '') for label in labels])
+            texts.append(text)
+
+    return label_lists, texts
+
+
+# This method will build the (notes x labels) probability matrix of a fastText model, every label is predicted
+def fasttext_probability_matrix(model, texts: list, labels: list) -> np.ndarray:
+    positions = {label: position for position, label in enumerate(labels)}
+    probabilities = np.zeros((len(texts), len(labels)), dtype=np.float32)
+
+    predicted_labels, predicted_probabilities = model.predict(texts, k=-1, threshold=0.0)
+    for row, (note_labels, note_probabilities) in enumerate(zip(predicted_labels, predicted_probabilities)):
+        columns = [positions.get(label.replace('__label__', ''), -1) for label in note_labels]
+        for column, probability in zip(columns, note_probabilities):
+            if column >= 0:
+                probabilities[row, column] = probability
+
+    return probabilities
+
+
+# This method will build the (notes x labels) probability matrix of the Keras model, in batches
+def keras_probability_matrix(model, model_labels: list, texts: list, labels: list, batch_size=256) -> np.ndarray:
+    model_probabilities = model.predict(np.array(texts, dtype=object)[:, None], batch_size=batch_size, verbose=0)
+
+    # Reorder the model's output columns to the evaluation label order, labels the model doesn't know stay at 0
+    model_positions = {label.replace('__label__', ''): position for position, label in enumerate(model_labels)}
+    probabilities = np.zeros((len(texts), len(labels)), dtype=np.float32)
+    for column, label in enumerate(labels):
+        if label in model_positions:
+            probabilities[:, column] = model_probabilities[:, model_positions[label]]
+
+    return probabilities
+
+
+# This method will evaluate every model on the same test file, building each probability matrix once
+# Returns {model name: report}, see multilabel_metrics.evaluation_report. A summary table is logged
+def evaluate_models(test_filepath, model_filepaths=None, keras_model_filepath=None, keras_labels_filepath=None,
+                    threshold=.5) -> dict:
+    model_filepaths = default_models if model_filepaths is None else model_filepaths
+
+    my_logger.info("Evaluating models on " + test_filepath + " ...")
+    label_lists, texts = read_test_file(test_filepath)
+
+    # Every model is scored over the same label columns - the labels seen in the test file
+    labels = sorted({label for note_labels in label_lists for label in note_labels})
+    y_true = multilabel_metrics.label_matrix(label_lists, labels)
+
+    probability_matrices = {}
+    for model_filepath in model_filepaths:
+        probability_matrices[os.path.basename(model_filepath)] = fasttext_probability_matrix(
+            fasttext.load_model(model_filepath), texts, labels)
+
+    if keras_model_filepath is not None and os.path.exists(keras_model_filepath):
+        keras_model, keras_labels = load_keras_model(keras_model_filepath, keras_labels_filepath)
+        probability_matrices[os.path.basename(keras_model_filepath)] = keras_probability_matrix(
+            keras_model, keras_labels, texts, labels)
+
+    reports = {}
+    for model_name, probabilities in probability_matrices.items():
+        reports[model_name] = multilabel_metrics.evaluation_report(y_true, probabilities, labels, threshold)
+
+    my_logger.info("  NOTES: " + str(len(texts)) + ", LABELS: " + str(len(labels)) + ", THRESHOLD: " + str(threshold))
+    for model_name, report in reports.items():
+        my_logger.info("  " + model_name + ":")
+        my_logger.info(f"    @{threshold}: micro P/R/F1 {report['micro_precision']:.4f} / {report['micro_recall']:.4f} / "
+                       f"{report['micro_f1']:.4f}, macro F1 {report['macro_f1']:.4f}")
+        my_logger.info(f"    P@1 {report['precision_at_k']['1']:.4f}, R@1 {report['recall_at_k']['1']:.4f}, "
+                       f"P@3 {report['precision_at_k']['3']:.4f}, R@3 {report['recall_at_k']['3']:.4f}")
+        my_logger.info(f"    best threshold {report['best_threshold']:.2f}: micro P/R/F1 "
+                       f"{report['best_micro_precision']:.4f} / {report['best_micro_recall']:.4f} / "
+                       f"{report['best_micro_f1']:.4f}")
+
+    return reports
+
+
+# This method will build the throughput / latency report for a scoring run. Latencies are per batch, in milliseconds
+def throughput_report(note_count, elapsed, batch_latencies: list, batch_size, workers) -> dict:
+    latencies = np.array(batch_latencies) * 1000 if batch_latencies else np.zeros(1)
+
+    return {
+        'notes': note_count,
+        'batches': len(batch_latencies),
+        'batch_size': batch_size,
+        'workers': workers,
+        'elapsed_seconds': round(elapsed, 3),
+        'notes_per_second': round(note_count / max(elapsed, 1e-9), 1),
+        'batch_latency_ms_p50': round(float(np.percentile(latencies, 50)), 2),
+        'batch_latency_ms_p95': round(float(np.percentile(latencies, 95)), 2),
+        'batch_latency_ms_p99': round(float(np.percentile(latencies, 99)), 2),
+        'note_latency_ms_mean': round(float(latencies.sum() / max(note_count, 1)), 3),
+    }
+
+
+# This method will log a report one line per entry
+def log_report(title, report: dict) -> None:
+    my_logger.info(title + ":")
+    for name, value in report.items():
+        my_logger.info("  " + name + ": " + str(value))
+
+
+# Main method - python will automatically run this
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score notes with the saved fastText models')
+    parser.add_argument('input', help='NOTEEVENTS style csv (or csv.gz) with a TEXT column, or with --evaluate a '
+                                      'cleansed fastText format test file')
+    parser.add_argument('--evaluate', action='store_true',
+                        help='compare the models on a labelled test file instead of scoring notes')
+    parser.add_argument('--keras-model', default=default_keras_model,
+                        help='Keras model saved by the CNN script, evaluated if it exists')
+    parser.add_argument('--keras-labels', default=default_keras_labels, help='label vocabulary of the Keras model')
+    parser.add_argument('--eval-threshold', type=float, default=.5,
+                        help='threshold the --evaluate scores are reported at, next to the full sweep')
+    parser.add_argument('--output', default='./cleansed_data/predictions.csv',
+                        help='csv the top k labels are written to')
+    parser.add_argument('--models', nargs='+', default=default_models, help='fastText models to score with')
+    parser.add_argument('--k', type=int, default=3, help='number of labels returned per note and model')
+    parser.add_argument('--threshold', type=float, default=0.0, help='only return labels above this probability')
+    parser.add_argument('--batch-size', type=int, default=256, help='number of notes predicted per batch')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: all cores, 1 runs inline)')
+    parser.add_argument('--id-column', default='HADM_ID', help='column written out to identify each note')
+    parser.add_argument('--category', default=None, help="only score notes of this CATEGORY, e.g. 'Discharge summary'")
+    parser.add_argument('--report', default=None, help='also write the throughput / latency (or evaluation) report to '
+                                                       'this json file')
+    args = parser.parse_args()
+
+    if args.evaluate:
+        scoring_report = evaluate_models(args.input, args.models, args.keras_model, args.keras_labels,
+                                         args.eval_threshold)
+    else:
+        scoring_report = score_notes(args.input, args.output, args.models, k=args.k, threshold=args.threshold,
+                                     batch_size=args.batch_size, workers=args.workers, id_column=args.id_column,
+                                     category=args.category)
+
+    if args.report is not None:
+        with open(args.report, 'w', encoding='utf8') as f:
+            json.dump(scoring_report, f, indent=2)
@@ -0,0 +1,109 @@
+# This module holds a streaming reader for the cleansed fastText format files ("__label__A __label__B note text ...")
+# It's the one parser of that format in the project - the cleanse, the split and the evaluation scripts all use it
+# Lines are read and parsed one at a time, so a file is never held in memory as a whole:
+#   parse_line -> the label tokens and note text of one line
+#   read_labels -> one pass over the labels only, the note text is never split
+#   iter_records -> lazily yields (label id array, text) records, optionally only for some lines
+#   text_dataset -> the note texts as a tf.data pipeline
+# Labels are mapped to ids through a label index ({label: id}), which grows as new labels are seen unless grow=False
+# Every reader takes a file path, or a function returning the lines to read (clean_data's read_lines), e.g. a variant
+# streamed out of the notes store with notes_store.iter_variant_lines
+import contextlib
+
+import numpy as np
+
+label_prefix = '__label__'
+
+
+# This method will return the label tokens at the start of a line, and the position the note text starts at
+# Only the label tokens are looked at, the rest of the line is left alone
+def split_labels(line: str):
+    labels = []
+    position = len(line) - len(line.lstrip(' '))
+    while line.startswith(label_prefix, position):
+        end = line.find(' ', position)
+        if end == -1:
+            labels.append(line[position:].rstrip())
+            return labels, len(line)
+        labels.append(line[position:end])
+        position = end + 1
+        while line.startswith(' ', position):
+            position = position + 1
+
+    return labels, position
+
+
+# This method will return the label tokens and the note text of a line, the text with its whitespace collapsed to
+# single spaces (the split hashes this text, an admit with an empty note has double spaces in its line)
+def parse_line(line: str):
+    labels, position = split_labels(line)
+    return labels, ' '.join(line[position:].split())
+
+
+# This method will map label tokens to an int32 id array, adding unseen labels to the label index when grow is set
+# Unseen labels are dropped when it isn't
+def label_ids(labels: list, label_index: dict, grow=True) -> np.ndarray:
+    ids = []
+    for label in labels:
+        label_id = label_index.get(label)
+        if label_id is None and grow:
+            label_id = label_index[label] = len(label_index)
+        if label_id is not None:
+            ids.append(label_id)
+
+    return np.array(ids, dtype=np.int32)
+
+
+# This method will open the lines of a file path or a read_lines function, closing them when the with block ends
+def open_lines(source):
+    return contextlib.closing(source()) if callable(source) else open(source, 'r', encoding='utf8')
+
+
+# This method will parse one line into a (label id array, text) record
+def parse_record(line: str, label_index: dict, grow=True):
+    labels, text = parse_line(line)
+    return label_ids(labels, label_index, grow), text
+
+
+# This method will read the labels of every line, returning the list of label id arrays and the label index
+def read_labels(source, label_index=None, grow=True):
+    label_index = {} if label_index is None else label_index
+    records = []
+    with open_lines(source) as f:
+        for line in f:
+            records.append(label_ids(split_labels(line)[0], label_index, grow))
+
+    return records, label_index
+
+
+# This method will lazily yield the (label id array, text) records of a file
+# rows -> bool mask over the lines of the file, only the lines it selects are parsed and yielded
+def iter_records(source, label_index=None, grow=True, rows=None):
+    label_index = {} if label_index is None else label_index
+    with open_lines(source) as f:
+        for line_number, line in enumerate(f):
+            if rows is not None and (line_number >= len(rows) or not rows[line_number]):
+                continue
+            yield parse_record(line, label_index, grow)
+
+
+# This method will build the (records x labels) multi hot matrix of a list of label id arrays
+# columns -> optional array mapping every label id to its column, default is column = label id
+def multi_hot(records: list, label_count: int, columns=None) -> np.ndarray:
+    matrix = np.zeros((len(records), label_count), dtype=np.float32)
+    lengths = np.array([len(ids) for ids in records], dtype=np.int64)
+    if lengths.sum():
+        ids = np.concatenate(records)
+        matrix[np.repeat(np.arange(len(records)), lengths), ids if columns is None else np.asarray(columns)[ids]] = 1.0
+
+    return matrix
+
+
+# This method will stream the note texts of a file as a tf.data dataset of strings
+def text_dataset(source, rows=None):
+    import tensorflow as tf
+
+    return tf.data.Dataset.from_generator(
+        lambda: (text for _, text in iter_records(source, {}, grow=True, rows=rows)),
+        output_signature=tf.TensorSpec(shape=(), dtype=tf.string))
+
@@ -0,0 +1,313 @@
+# This is a local inference server for ICD9 suggestions
+# The BOT models (and the Keras model, if it's been saved by the CNN script) are loaded once and kept warm. Notes are
+# accepted over HTTP (tcp or a unix socket), and concurrent requests are coalesced into micro batches - a batch is run
+# as soon as it's full, or max_wait_ms after its first note arrived, whichever comes first
+#   POST /predict  {"text": "...", "k": 3} or {"notes": ["...", "..."], "k": 3}
+#   GET /metrics   latency percentiles, queue depth and batch statistics
+#   GET /health
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import time
+from collections import deque
+
+import fasttext
+import numpy as np
+
+from clean_data import normalize_text
+from evaluate_models import default_keras_labels, default_keras_model, default_models, load_keras_model
+
+# Set Logging -- basic configuration
+logging.basicConfig(format='%(asctime)s -- %(levelname)s: %(message)s',
+                    level=logging.NOTSET,
+                    datefmt='%Y-%m-%d %H:%M:%S')
+my_logger = logging.getLogger('classifier_project')
+
+# Model name -> predict function taking (normalized texts, k), see load_models
+served_models = {}
+
+# Largest k a request can ask for - the notes of a micro batch are all predicted with the largest k in it
+max_k = 100
+
+# Server metrics, latencies / batch sizes are kept for the most recent requests / batches only
+server_metrics = {
+    'started': time.time(),
+    'requests': 0,
+    'notes': 0,
+    'errors': 0,
+    'batches': 0,
+    'latencies_ms': deque(maxlen=10000),
+    'batch_sizes': deque(maxlen=1000),
+    'batch_ms': deque(maxlen=1000),
+}
+
+
+# This method will load the BOT models, and the Keras model if it exists, into served_models
+def load_models(bot_model_filepaths: list, keras_model_filepath=None, keras_labels_filepath=None) -> None:
+    for model_filepath in bot_model_filepaths:
+        my_logger.info("Loading " + model_filepath + " ...")
+        served_models[os.path.basename(model_filepath)] = functools.partial(
+            predict_fasttext, fasttext.load_model(model_filepath))
+
+    if keras_model_filepath is not None and os.path.exists(keras_model_filepath):
+        my_logger.info("Loading " + keras_model_filepath + " ...")
+        keras_model, labels = load_keras_model(keras_model_filepath, keras_labels_filepath)
+        served_models[os.path.basename(keras_model_filepath)] = functools.partial(predict_keras, keras_model, labels)
+    elif keras_model_filepath is not None:
+        my_logger.warning("Keras model " + keras_model_filepath + " not found, it will not be served")
+
+
+# This method will return the top k (label, probability) of each text with a fastText model
+def predict_fasttext(model, texts: list, k: int) -> list:
+    labels, probabilities = model.predict(texts, k=k)
+    return [[(label.replace('__label__', ''), round(float(probability), 6))
+             for label, probability in zip(note_labels, note_probabilities)]
+            for note_labels, note_probabilities in zip(labels, probabilities)]
+
+
+# This method will return the top k (label, probability) of each text with the Keras multi label model
+def predict_keras(model, labels: list, texts: list, k: int) -> list:
+    probabilities = model.predict(np.array(texts, dtype=object)[:, None], verbose=0)
+    results = []
+    for note_probabilities in probabilities:
+        # the lookup vocabulary starts with the [UNK] token, it's never a suggestion
+        top = [index for index in np.argsort(-note_probabilities) if labels[index] != '[UNK]'][:k]
+        results.append([(labels[index].replace('__label__', ''), round(float(note_probabilities[index]), 6))
+                        for index in top])
+
+    return results
+
+
+# This method will normalize and predict a batch of notes with every served model, it runs in a worker thread
+# Returns one {model: [(label, probability), ...]} per note
+def predict_all(texts: list, k: int) -> list:
+    normalized = [normalize_text(text) for text in texts]
+    results = [{} for _ in texts]
+    for model_name, predict in served_models.items():
+        for result, prediction in zip(results, predict(normalized, k)):
+            result[model_name] = prediction
+
+    return results
+
+
+# This method will take notes off of the queue and run them as micro batches, forever
+# Each queue item is (text, k, future) - the future gets the note's predictions, trimmed to its own k
+async def batch_worker(queue: asyncio.Queue, max_batch_size: int, max_wait_ms: float) -> None:
+    loop = asyncio.get_running_loop()
+
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + max_wait_ms / 1000
+
+        while len(batch) < max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        texts = [text for text, _, _ in batch]
+        k = max(note_k for _, note_k, _ in batch)
+        start = time.perf_counter()
+
+        try:
+            results = await loop.run_in_executor(None, predict_all, texts, k)
+        except Exception as e:
+            my_logger.exception("Batch prediction failed")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+
+        for (_, note_k, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result({model_name: prediction[:note_k] for model_name, prediction in result.items()})
+
+        server_metrics['batches'] = server_metrics['batches'] + 1
+        server_metrics['batch_sizes'].append(len(batch))
+        server_metrics['batch_ms'].append((time.perf_counter() - start) * 1000)
+
+
+# This method will check a /predict payload before any of its notes are queued. Returns (notes, k), raises ValueError
+# for anything but a non empty list of strings (or one string as "text") and an integer k between 1 and max_k
+def parse_predict_request(payload) -> tuple:
+    if not isinstance(payload, dict):
+        raise ValueError('the request body has to be a json object')
+
+    if 'notes' in payload:
+        notes = payload['notes']
+        if not isinstance(notes, list) or not notes or not all(isinstance(note, str) for note in notes):
+            raise ValueError('"notes" has to be a non empty list of strings')
+    elif 'text' in payload:
+        if not isinstance(payload['text'], str):
+            raise ValueError('"text" has to be a string')
+        notes = [payload['text']]
+    else:
+        raise ValueError('the request needs "notes" or "text"')
+
+    k = payload.get('k', 3)
+    # bool is an int subclass, but {"k": true} is not a k
+    if not isinstance(k, int) or isinstance(k, bool) or not 1 <= k <= max_k:
+        raise ValueError('"k" has to be an integer between 1 and ' + str(max_k))
+
+    return notes, k
+
+
+# This method will queue the notes of one request and wait for all of their predictions
+async def predict_notes(queue: asyncio.Queue, notes: list, k: int) -> list:
+    loop = asyncio.get_running_loop()
+    futures = []
+    for note in notes:
+        future = loop.create_future()
+        await queue.put((note, k, future))
+        futures.append(future)
+
+    return list(await asyncio.gather(*futures))
+
+
+# This method will build the /metrics response
+def metrics_report(queue: asyncio.Queue) -> dict:
+    latencies = np.array(server_metrics['latencies_ms']) if server_metrics['latencies_ms'] else np.zeros(1)
+    batch_sizes = np.array(server_metrics['batch_sizes']) if server_metrics['batch_sizes'] else np.zeros(1)
+    batch_ms = np.array(server_metrics['batch_ms']) if server_metrics['batch_ms'] else np.zeros(1)
+
+    return {
+        'uptime_seconds': round(time.time() - server_metrics['started'], 1),
+        'models': list(served_models),
+        'requests': server_metrics['requests'],
+        'notes': server_metrics['notes'],
+        'errors': server_metrics['errors'],
+        'batches': server_metrics['batches'],
+        'queue_depth': queue.qsize(),
+        'latency_ms_p50': round(float(np.percentile(latencies, 50)), 2),
+        'latency_ms_p99': round(float(np.percentile(latencies, 99)), 2),
+        'batch_size_mean': round(float(batch_sizes.mean()), 2),
+        'batch_ms_p50': round(float(np.percentile(batch_ms, 50)), 2),
+        'batch_ms_p99': round(float(np.percentile(batch_ms, 99)), 2),
+    }
+
+
+# This method will read one HTTP request off of a connection. Returns (method, path, headers, body), None at EOF
+async def read_request(reader: asyncio.StreamReader):
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+
+    method, path, _ = request_line.decode('latin1').split(' ', 2)
+
+    headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+        name, _, value = line.decode('latin1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+    return method, path, headers, body
+
+
+# This method will write a json HTTP response
+async def write_response(writer: asyncio.StreamWriter, status: str, payload: dict, keep_alive: bool) -> None:
+    body = json.dumps(payload).encode('utf8')
+    writer.write(('HTTP/1.1 ' + status + '\r\n'
+                  'Content-Type: application/json\r\n'
+                  'Content-Length: ' + str(len(body)) + '\r\n'
+                  'Connection: ' + ('keep-alive' if keep_alive else 'close') + '\r\n\r\n').encode('latin1') + body)
+    await writer.drain()
+
+
+# This method will answer one /predict body, returns (status, payload). Bad requests are answered with a 400 before
+# anything is queued
+async def predict_response(queue: asyncio.Queue, body: bytes) -> tuple:
+    start = time.perf_counter()
+    try:
+        notes, k = parse_predict_request(json.loads(body or b'{}'))
+    except ValueError as e:
+        server_metrics['errors'] = server_metrics['errors'] + 1
+        return '400 Bad Request', {'error': 'bad request: ' + str(e)}
+
+    try:
+        predictions = await predict_notes(queue, notes, k)
+    except Exception as e:
+        server_metrics['errors'] = server_metrics['errors'] + 1
+        return '500 Internal Server Error', {'error': str(e)}
+
+    server_metrics['requests'] = server_metrics['requests'] + 1
+    server_metrics['notes'] = server_metrics['notes'] + len(notes)
+    server_metrics['latencies_ms'].append((time.perf_counter() - start) * 1000)
+
+    return '200 OK', {'predictions': predictions}
+
+
+# This method will serve one client connection, which can send any number of requests (keep-alive)
+async def handle_connection(queue: asyncio.Queue, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        while (request := await read_request(reader)) is not None:
+            method, path, headers, body = request
+            keep_alive = headers.get('connection', '').lower() != 'close'
+
+            if method == 'POST' and path == '/predict':
+                status, payload = await predict_response(queue, body)
+                await write_response(writer, status, payload, keep_alive)
+            elif method == 'GET' and path == '/metrics':
+                await write_response(writer, '200 OK', metrics_report(queue), keep_alive)
+            elif method == 'GET' and path == '/health':
+                await write_response(writer, '200 OK', {'status': 'ok', 'models': list(served_models)}, keep_alive)
+            else:
+                await write_response(writer, '404 Not Found', {'error': 'unknown endpoint ' + path}, keep_alive)
+
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+# This method will start the batch worker and the server, and serve until cancelled
+async def serve(host='127.0.0.1', port=8598, unix_socket=None, max_batch_size=64, max_wait_ms=10.0) -> None:
+    queue = asyncio.Queue()
+    worker = asyncio.create_task(batch_worker(queue, max_batch_size, max_wait_ms))
+    handler = functools.partial(handle_connection, queue)
+
+    if unix_socket is not None:
+        server = await asyncio.start_unix_server(handler, path=unix_socket)
+        my_logger.info("Serving on unix socket " + unix_socket)
+    else:
+        server = await asyncio.start_server(handler, host=host, port=port)
+        my_logger.info("Serving on http://" + host + ":" + str(port))
+
+    my_logger.info("  MAX BATCH SIZE: " + str(max_batch_size) + ", MAX WAIT: " + str(max_wait_ms) + "ms")
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        worker.cancel()
+
+
+# Main method - python will automatically run this
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve ICD9 suggestions from the trained models')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8598, help='port to listen on')
+    parser.add_argument('--unix-socket', default=None, help='listen on this unix socket instead of tcp')
+    parser.add_argument('--models', nargs='+', default=default_models, help='fastText models to serve')
+    parser.add_argument('--keras-model', default=default_keras_model,
+                        help='Keras model saved by the CNN script, served if it exists')
+    parser.add_argument('--keras-labels', default=default_keras_labels, help='label vocabulary of the Keras model')
+    parser.add_argument('--max-batch-size', type=int, default=64, help='most notes predicted in one micro batch')
+    parser.add_argument('--max-wait-ms', type=float, default=10.0,
+                        help='longest a note waits for its micro batch to fill up')
+    args = parser.parse_args()
+
+    load_models(args.models, args.keras_model, args.keras_labels)
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix_socket, args.max_batch_size, args.max_wait_ms))
+    except KeyboardInterrupt:
+        my_logger.info("Server stopped")
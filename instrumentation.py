@@ -0,0 +1,141 @@
+# This module holds the instrumentation used by clean_data.py and the training scripts
+# Each run collects one record per stage - wall and CPU time, rows and rows/sec, bytes read / written and the peak RSS
+# so far - and writes them out as machine readable metrics:
+#   <metrics_dir>/<run>_<timestamp>.json -> every stage of this run
+#   <metrics_dir>/<run>.csv -> one row per stage, appended by every run, for comparing runs / catching regressions
+# Stages can also be run under cProfile, the stats go to <metrics_dir>/<run>_<timestamp>_<stage>.prof
+import contextlib
+import cProfile
+import csv
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import time
+
+my_logger = logging.getLogger('classifier_project')
+
+metric_fields = ['run', 'timestamp', 'stage', 'wall_seconds', 'cpu_seconds', 'rows', 'rows_per_second', 'bytes_read',
+                 'bytes_written', 'peak_rss_mb', 'profile']
+
+
+# This method will return the peak resident memory of this process (or of its largest finished child) in MB
+# resource is not available on windows, in which case None is returned
+def peak_rss_mb(children=False):
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # ru_maxrss is in kilobytes on linux, bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+
+    return resource.getrusage(who).ru_maxrss * scale / 1024 / 1024
+
+
+# This method will return the peak resident memory of this process (and its finished workers) as a printable string
+def format_peak_rss() -> str:
+    self_peak = peak_rss_mb()
+    if self_peak is None:
+        return 'unavailable'
+
+    return f"{self_peak:.0f}MB (largest worker: {peak_rss_mb(children=True):.0f}MB)"
+
+
+# This method will return the total size in bytes of the files that exist out of filepaths
+def file_bytes(*filepaths) -> int:
+    return sum(os.path.getsize(filepath) for filepath in filepaths if os.path.isfile(filepath))
+
+
+# This method will return the number of lines of a file, counted in binary blocks
+def line_count(filepath) -> int:
+    count = 0
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            count = count + block.count(b'\n')
+
+    return count
+
+
+# This method will return the CPU seconds used so far by this process and its finished children (e.g. pool workers)
+def cpu_seconds() -> float:
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+# This class will collect the stage metrics of one run, see the top of the file
+# profile_stages -> names of the stages to run under cProfile, 'all' for every stage
+class RunMetrics:
+    def __init__(self, run_name, metrics_dir='./metrics', profile_stages=()):
+        self.run_name = run_name
+        self.metrics_dir = metrics_dir
+        self.profile_stages = set(profile_stages or ())
+        self.timestamp = time.strftime('%Y%m%d_%H%M%S')
+        self.records = []
+
+    # This method will measure one stage. The record it yields can be filled in by the stage - rows, bytes_read and
+    # bytes_written - the timings, rows/sec and peak RSS are added when the stage ends (even if it raised)
+    @contextlib.contextmanager
+    def stage(self, name, rows=None, bytes_read=None, bytes_written=None):
+        record = {'run': self.run_name, 'timestamp': self.timestamp, 'stage': name, 'rows': rows,
+                  'bytes_read': bytes_read, 'bytes_written': bytes_written, 'profile': None}
+        profiler = cProfile.Profile() if 'all' in self.profile_stages or name in self.profile_stages else None
+
+        start_wall = time.perf_counter()
+        start_cpu = cpu_seconds()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                record['profile'] = self.save_profile(name, profiler)
+
+            record['wall_seconds'] = round(time.perf_counter() - start_wall, 3)
+            record['cpu_seconds'] = round(cpu_seconds() - start_cpu, 3)
+            record['rows_per_second'] = round(record['rows'] / max(record['wall_seconds'], 1e-9), 1) \
+                if record['rows'] is not None else None
+            peak = peak_rss_mb()
+            record['peak_rss_mb'] = round(peak, 1) if peak is not None else None
+            self.records.append(record)
+
+            my_logger.info("  METRICS " + name + ": " + f"{record['wall_seconds']:.2f}s wall, " +
+                           f"{record['cpu_seconds']:.2f}s cpu" +
+                           (f", {record['rows_per_second']:.0f} rows/sec" if record['rows'] is not None else '') +
+                           ", peak RSS " + str(record['peak_rss_mb']) + "MB")
+
+    # This method will dump a stage's profile, and log its top functions by cumulative time
+    def save_profile(self, name, profiler: cProfile.Profile) -> str:
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        profile_filepath = os.path.join(self.metrics_dir, self.run_name + '_' + self.timestamp + '_' + name + '.prof')
+        profiler.dump_stats(profile_filepath)
+
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(15)
+        my_logger.info("  PROFILE " + name + " (top 15 by cumulative time, full stats in " + profile_filepath + "):\n" +
+                       summary.getvalue())
+
+        return profile_filepath
+
+    # This method will write the run's records to its json file, and append them to the run's csv
+    def write(self) -> str:
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        json_filepath = os.path.join(self.metrics_dir, self.run_name + '_' + self.timestamp + '.json')
+        with open(json_filepath, 'w', encoding='utf8') as f:
+            json.dump(self.records, f, indent=2)
+
+        csv_filepath = os.path.join(self.metrics_dir, self.run_name + '.csv')
+        new_file = not os.path.isfile(csv_filepath)
+        with open(csv_filepath, 'a', encoding='utf8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=metric_fields)
+            if new_file:
+                writer.writeheader()
+            writer.writerows(self.records)
+
+        my_logger.info("Metrics saved into " + json_filepath + " and " + csv_filepath)
+
+        return json_filepath
@@ -0,0 +1,143 @@
+# This will generate load against inference_server.py, to characterize its throughput and latency
+# Notes are taken from a cleansed fastText format file (the labels are stripped off), and sent by a number of
+# concurrent clients, each over its own keep-alive connection. Client side latency and throughput are reported,
+# along with the server's own /metrics at the end of the run
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import time
+
+import numpy as np
+
+from fasttext_reader import parse_line
+
+# Set Logging -- basic configuration
+logging.basicConfig(format='%(asctime)s -- %(levelname)s: %(message)s',
+                    level=logging.NOTSET,
+                    datefmt='%Y-%m-%d %H:%M:%S')
+my_logger = logging.getLogger('classifier_project')
+
+
+# This method will read up to max_notes note texts out of a cleansed fastText format file
+def read_notes(input_filepath, max_notes=1000) -> list:
+    notes = []
+    with open(input_filepath, 'r', encoding='utf8') as f:
+        for line in f:
+            _, text = parse_line(line)
+            if text:
+                notes.append(text)
+            if len(notes) >= max_notes:
+                break
+
+    return notes
+
+
+# This method will open a connection to the server, over tcp or a unix socket
+async def open_connection(host, port, unix_socket=None):
+    if unix_socket is not None:
+        return await asyncio.open_unix_connection(unix_socket)
+    return await asyncio.open_connection(host, port)
+
+
+# This method will send one HTTP request on an open connection and return the (status, json payload) of the response
+async def send_request(reader, writer, method, path, payload=None):
+    body = json.dumps(payload).encode('utf8') if payload is not None else b''
+    writer.write((method + ' ' + path + ' HTTP/1.1\r\n'
+                  'Host: localhost\r\n'
+                  'Content-Type: application/json\r\n'
+                  'Content-Length: ' + str(len(body)) + '\r\n\r\n').encode('latin1') + body)
+    await writer.drain()
+
+    status = int((await reader.readline()).decode('latin1').split(' ')[1])
+    headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+        name, _, value = line.decode('latin1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    response = await reader.readexactly(int(headers.get('content-length', 0)))
+
+    return status, json.loads(response)
+
+
+# This method will run one client, sending notes from the shared iterator until it runs out
+async def run_client(notes_iter, latencies: list, errors: list, host, port, unix_socket, k) -> None:
+    reader, writer = await open_connection(host, port, unix_socket)
+    try:
+        for note in notes_iter:
+            start = time.perf_counter()
+            status, _ = await send_request(reader, writer, 'POST', '/predict', {'text': note, 'k': k})
+            if status == 200:
+                latencies.append((time.perf_counter() - start) * 1000)
+            else:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+# This method will send total_requests notes with the given concurrency, and return the load report
+async def generate_load(notes: list, total_requests=1000, concurrency=16, host='127.0.0.1', port=8598,
+                        unix_socket=None, k=3) -> dict:
+    # every client pulls from the same iterator, so the requests are shared out as clients free up
+    notes_iter = itertools.islice(itertools.cycle(notes), total_requests)
+    latencies = []
+    errors = []
+
+    start = time.perf_counter()
+    await asyncio.gather(*[run_client(notes_iter, latencies, errors, host, port, unix_socket, k)
+                           for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await open_connection(host, port, unix_socket)
+    try:
+        _, server_report = await send_request(reader, writer, 'GET', '/metrics')
+    finally:
+        writer.close()
+
+    latencies = np.array(latencies) if latencies else np.zeros(1)
+
+    return {
+        'requests': total_requests,
+        'concurrency': concurrency,
+        'errors': len(errors),
+        'elapsed_seconds': round(elapsed, 3),
+        'requests_per_second': round(total_requests / max(elapsed, 1e-9), 1),
+        'latency_ms_p50': round(float(np.percentile(latencies, 50)), 2),
+        'latency_ms_p95': round(float(np.percentile(latencies, 95)), 2),
+        'latency_ms_p99': round(float(np.percentile(latencies, 99)), 2),
+        'server': server_report,
+    }
+
+
+# Main method - python will automatically run this
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate load against the inference server')
+    parser.add_argument('--input', default='./cleansed_data/rolled_common_input.test',
+                        help='cleansed fastText format file the notes are taken from')
+    parser.add_argument('--requests', type=int, default=1000, help='total number of requests to send')
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 16, 64],
+                        help='number of concurrent clients, one run per value')
+    parser.add_argument('--host', default='127.0.0.1', help='server address')
+    parser.add_argument('--port', type=int, default=8598, help='server port')
+    parser.add_argument('--unix-socket', default=None, help='connect over this unix socket instead of tcp')
+    parser.add_argument('--k', type=int, default=3, help='number of labels requested per note')
+    parser.add_argument('--report', default=None, help='also write the load reports to this json file')
+    args = parser.parse_args()
+
+    load_notes = read_notes(args.input, max_notes=args.requests)
+    my_logger.info("Loaded " + str(len(load_notes)) + " notes from " + args.input)
+
+    reports = []
+    for clients in args.concurrency:
+        my_logger.info("Running " + str(args.requests) + " requests with " + str(clients) + " concurrent clients ...")
+        report = asyncio.run(generate_load(load_notes, args.requests, clients, args.host, args.port,
+                                           args.unix_socket, args.k))
+        reports.append(report)
+        my_logger.info("  " + str(report['requests_per_second']) + " requests/sec, p50 " +
+                       str(report['latency_ms_p50']) + "ms, p99 " + str(report['latency_ms_p99']) + "ms, mean batch " +
+                       str(report['server']['batch_size_mean']))
+
+    if args.report is not None:
+        with open(args.report, 'w', encoding='utf8') as f:
+            json.dump(reports, f, indent=2)
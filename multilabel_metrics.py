@@ -0,0 +1,156 @@
+# This module holds the multi label metrics used to compare the models
+# Everything works off of two arrays built once per model:
+#   y_true -> (notes x labels) bool matrix of the true labels
+#   probabilities -> (notes x labels) float matrix of the predicted probability of every label
+# so per label / micro / macro scores, P@k and a full threshold sweep are all plain array math
+import numpy as np
+
+
+# This method will build the (notes x labels) bool matrix of true labels from a list of label lists per note
+# Labels that aren't in the vocabulary are ignored
+def label_matrix(label_lists: list, vocabulary: list) -> np.ndarray:
+    positions = {label: position for position, label in enumerate(vocabulary)}
+    y_true = np.zeros((len(label_lists), len(vocabulary)), dtype=bool)
+
+    rows = [row for row, labels in enumerate(label_lists) for label in labels if label in positions]
+    columns = [positions[label] for labels in label_lists for label in labels if label in positions]
+    y_true[rows, columns] = True
+
+    return y_true
+
+
+# This method will return precision / recall / F1, guarding the divisions for labels that are never predicted / seen
+def precision_recall_f1(tp, fp, fn):
+    tp, fp, fn = np.asarray(tp, dtype=float), np.asarray(fp, dtype=float), np.asarray(fn, dtype=float)
+    precision = np.divide(tp, tp + fp, out=np.zeros_like(tp), where=(tp + fp) > 0)
+    recall = np.divide(tp, tp + fn, out=np.zeros_like(tp), where=(tp + fn) > 0)
+    f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros_like(tp), where=(precision + recall) > 0)
+
+    return precision, recall, f1
+
+
+# This method will score the predictions at one threshold - a label is predicted when its probability >= threshold
+# Returns per label arrays (precision, recall, f1, support) plus the micro and macro averages
+def threshold_metrics(y_true: np.ndarray, probabilities: np.ndarray, threshold=.5) -> dict:
+    predicted = probabilities >= threshold
+
+    tp = (predicted & y_true).sum(axis=0)
+    fp = (predicted & ~y_true).sum(axis=0)
+    fn = (~predicted & y_true).sum(axis=0)
+
+    precision, recall, f1 = precision_recall_f1(tp, fp, fn)
+    micro_precision, micro_recall, micro_f1 = precision_recall_f1(tp.sum(), fp.sum(), fn.sum())
+
+    return {
+        'threshold': threshold,
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+        'support': y_true.sum(axis=0),
+        'micro_precision': float(micro_precision),
+        'micro_recall': float(micro_recall),
+        'micro_f1': float(micro_f1),
+        'macro_precision': float(precision.mean()) if len(precision) else 0.0,
+        'macro_recall': float(recall.mean()) if len(recall) else 0.0,
+        'macro_f1': float(f1.mean()) if len(f1) else 0.0,
+    }
+
+
+# This method will return precision@k and recall@k, taking the k most probable labels of every note
+# This is what fastText's model.test reports, with k=1 by default
+def precision_recall_at_k(y_true: np.ndarray, probabilities: np.ndarray, k=1):
+    k = min(k, probabilities.shape[1])
+    top_k = np.argpartition(-probabilities, k - 1, axis=1)[:, :k]
+    hits = np.take_along_axis(y_true, top_k, axis=1).sum()
+
+    precision = hits / max(len(y_true) * k, 1)
+    recall = hits / max(y_true.sum(), 1)
+
+    return float(precision), float(recall)
+
+
+# This method will score every threshold at once - each label's column is sorted once, and the number of
+# predictions / true positives at each threshold is looked up from the cumulative counts
+# Returns the thresholds, per threshold micro / macro scores, and the per label (thresholds x labels) scores
+def threshold_sweep(y_true: np.ndarray, probabilities: np.ndarray, thresholds=None) -> dict:
+    thresholds = np.linspace(0, 1, 101) if thresholds is None else np.asarray(thresholds, dtype=float)
+    note_count, label_count = probabilities.shape
+
+    # Sort each column by descending probability, and count the true positives from the top down
+    order = np.argsort(-probabilities, axis=0, kind='stable')
+    sorted_probabilities = np.take_along_axis(probabilities, order, axis=0)
+    true_positives = np.vstack([np.zeros((1, label_count), dtype=np.int64),
+                                np.cumsum(np.take_along_axis(y_true, order, axis=0), axis=0)])
+
+    # Number of notes with probability >= threshold, per (threshold, label) - a binary search of each sorted column.
+    # thresholds are compared at the precision of the probabilities, the same as probabilities >= threshold does
+    ascending = sorted_probabilities[::-1]
+    column_thresholds = thresholds.astype(probabilities.dtype)
+    predicted_count = note_count - np.stack([np.searchsorted(ascending[:, column], column_thresholds, side='left')
+                                             for column in range(label_count)], axis=1)
+
+    tp = np.take_along_axis(true_positives, predicted_count, axis=0)
+    fp = predicted_count - tp
+    fn = y_true.sum(axis=0)[None, :] - tp
+
+    precision, recall, f1 = precision_recall_f1(tp, fp, fn)
+    micro_precision, micro_recall, micro_f1 = precision_recall_f1(tp.sum(axis=1), fp.sum(axis=1), fn.sum(axis=1))
+
+    return {
+        'thresholds': thresholds,
+        'micro_precision': micro_precision,
+        'micro_recall': micro_recall,
+        'micro_f1': micro_f1,
+        'macro_f1': f1.mean(axis=1),
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+    }
+
+
+# This method will build the full report for one model - scores at the given threshold, P@k / R@k, the sweep, the best
+# global threshold for micro F1 and the best threshold per label. Arrays are converted to lists, so it's json ready
+def evaluation_report(y_true: np.ndarray, probabilities: np.ndarray, labels: list, threshold=.5, top_k=(1, 3, 5),
+                      thresholds=None) -> dict:
+    at_threshold = threshold_metrics(y_true, probabilities, threshold)
+    sweep = threshold_sweep(y_true, probabilities, thresholds)
+
+    best = int(np.argmax(sweep['micro_f1']))
+    best_per_label = np.argmax(sweep['f1'], axis=0)
+    at_k = {k: precision_recall_at_k(y_true, probabilities, k) for k in top_k}
+
+    return {
+        'notes': int(len(y_true)),
+        'labels': int(len(labels)),
+        'threshold': threshold,
+        'micro_precision': at_threshold['micro_precision'],
+        'micro_recall': at_threshold['micro_recall'],
+        'micro_f1': at_threshold['micro_f1'],
+        'macro_precision': at_threshold['macro_precision'],
+        'macro_recall': at_threshold['macro_recall'],
+        'macro_f1': at_threshold['macro_f1'],
+        'precision_at_k': {str(k): precision for k, (precision, _) in at_k.items()},
+        'recall_at_k': {str(k): recall for k, (_, recall) in at_k.items()},
+        'best_threshold': float(sweep['thresholds'][best]),
+        'best_micro_precision': float(sweep['micro_precision'][best]),
+        'best_micro_recall': float(sweep['micro_recall'][best]),
+        'best_micro_f1': float(sweep['micro_f1'][best]),
+        'per_label': {
+            label: {
+                'support': int(at_threshold['support'][column]),
+                'precision': float(at_threshold['precision'][column]),
+                'recall': float(at_threshold['recall'][column]),
+                'f1': float(at_threshold['f1'][column]),
+                'best_threshold': float(sweep['thresholds'][best_per_label[column]]),
+                'best_f1': float(sweep['f1'][best_per_label[column], column]),
+            }
+            for column, label in enumerate(labels)
+        },
+        'sweep': {
+            'thresholds': sweep['thresholds'].tolist(),
+            'micro_precision': sweep['micro_precision'].tolist(),
+            'micro_recall': sweep['micro_recall'].tolist(),
+            'micro_f1': sweep['micro_f1'].tolist(),
+            'macro_f1': sweep['macro_f1'].tolist(),
+        },
+    }
@@ -0,0 +1,98 @@
+# This module will store the cleansed notes ONCE, with a small label file per training variant
+#   notes.bin -> every admit's note text, utf8, back to back
+#   notes_index.npy -> one (HADM_ID, offset, length) row per admit into notes.bin, memory mappable
+#   <variant>.labels -> one "HADM_ID<tab>labels" line per row of that variant, in the order the rows are written
+# fastText format lines (labels + note) are only built when a variant is read back, see iter_variant_lines
+import mmap
+import os
+
+import numpy as np
+
+notes_filename = 'notes.bin'
+index_filename = 'notes_index.npy'
+labels_suffix = '.labels'
+
+
+# This method will write the notes store and label files from an iterable of (HADM_ID, note, {variant: labels})
+# A variant's labels can be None, in which case that admit is left out of the variant
+# append -> add the records to the end of an existing store instead of replacing it. The index is rewritten under a
+#    temp name once everything else is written, so it never points past the end of notes.bin
+def write_store(store_filepath, records, variants: list, append=False) -> int:
+    os.makedirs(store_filepath, exist_ok=True)
+    append = append and store_exists(store_filepath)
+
+    index_rows = []
+    offset = os.path.getsize(os.path.join(store_filepath, notes_filename)) if append else 0
+
+    with open(os.path.join(store_filepath, notes_filename), 'ab' if append else 'wb') as f_notes:
+        label_files = {variant: open(os.path.join(store_filepath, variant + labels_suffix), 'a' if append else 'w',
+                                     encoding='utf8')
+                       for variant in variants}
+        try:
+            for hadm_id, note, labels_by_variant in records:
+                encoded = note.encode('utf8')
+                f_notes.write(encoded)
+                index_rows.append((hadm_id, offset, len(encoded)))
+                offset = offset + len(encoded)
+
+                for variant, labels in labels_by_variant.items():
+                    if labels is not None:
+                        label_files[variant].write(str(hadm_id) + '\t' + labels + '\n')
+        finally:
+            for f in label_files.values():
+                f.close()
+
+    index = np.array(index_rows, dtype=np.int64).reshape(-1, 3)
+    if append:
+        index = np.concatenate([np.load(os.path.join(store_filepath, index_filename)), index])
+
+    with open(os.path.join(store_filepath, index_filename + '.tmp'), 'wb') as f_index:
+        np.save(f_index, index)
+    os.replace(os.path.join(store_filepath, index_filename + '.tmp'), os.path.join(store_filepath, index_filename))
+
+    return len(index_rows)
+
+
+# This method will cut a store back to its first admit_count admits, dropping whatever was appended after them
+def truncate_store(store_filepath, admit_count: int) -> None:
+    index = np.load(os.path.join(store_filepath, index_filename))
+    if len(index) <= admit_count:
+        return
+
+    with open(os.path.join(store_filepath, index_filename + '.tmp'), 'wb') as f_index:
+        np.save(f_index, index[:admit_count])
+    os.replace(os.path.join(store_filepath, index_filename + '.tmp'), os.path.join(store_filepath, index_filename))
+
+
+# This method will yield the fastText format lines of one variant, reading the notes straight out of the mapped store
+def iter_variant_lines(store_filepath, variant):
+    index = np.load(os.path.join(store_filepath, index_filename), mmap_mode='r')
+    positions = {int(hadm_id): (int(offset), int(length)) for hadm_id, offset, length in index}
+
+    with open(os.path.join(store_filepath, notes_filename), 'rb') as f_notes, \
+            open(os.path.join(store_filepath, variant + labels_suffix), 'r', encoding='utf8') as f_labels:
+        # mmap can't map an empty file
+        notes = mmap.mmap(f_notes.fileno(), 0, access=mmap.ACCESS_READ) if positions and index[:, 2].any() else b''
+        try:
+            for line in f_labels:
+                hadm_id, labels = line.rstrip('\n').split('\t', 1)
+                offset, length = positions[int(hadm_id)]
+                yield labels + notes[offset:offset + length].decode('utf8') + '\n'
+        finally:
+            if isinstance(notes, mmap.mmap):
+                notes.close()
+
+
+# This method will remove a store and the label files of its variants, e.g. once the text training files are written
+# instead - a stale store would be picked up by the scripts that fall back to it
+def remove_store(store_filepath, variants: list) -> None:
+    for filename in [notes_filename, index_filename] + [variant + labels_suffix for variant in variants]:
+        filepath = os.path.join(store_filepath, filename)
+        if os.path.isfile(filepath):
+            os.remove(filepath)
+
+
+# This method will check if a notes store exists in a directory
+def store_exists(store_filepath) -> bool:
+    return os.path.isfile(os.path.join(store_filepath, notes_filename)) and \
+        os.path.isfile(os.path.join(store_filepath, index_filename))
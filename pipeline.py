@@ -0,0 +1,335 @@
+# This will run the whole project as a DAG of stages:
+#   cleanse (cleanse + write the training files) -> split -> train BINARY_BOT / MULTI_BOT / CNN -> evaluate
+# Every stage is a run of one of the project scripts. A stage is skipped when the hash of its inputs (file contents,
+# the code it runs) and its parameters is the same as on its last successful run and its outputs are all still there -
+# downstream stages see the new contents of their inputs, so a change anywhere only reruns what depends on it
+# Stages whose dependencies are done run concurrently, as long as the cores they're given fit in the CPU budget. The
+# training stages only read the split files, so they all run side by side, each with its share of the budget
+# With --folds the BOT training and evaluate stages are left out, they train / test on the .train / .test files
+import argparse
+import ast
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import notes_store
+from clean_data import diag_file, file_digest, noteevents_file, split_output_filepaths, split_variants, \
+    training_output_files
+
+# Set Logging -- basic configuration
+logging.basicConfig(format='%(asctime)s -- %(levelname)s: %(message)s',
+                    level=logging.NOTSET,
+                    datefmt='%Y-%m-%d %H:%M:%S')
+my_logger = logging.getLogger('classifier_project')
+
+# Hash of every stage's last successful run, and the digests of the files seen (reused while size / mtime match)
+state_filepath = './cleansed_data/pipeline_state.json'
+cleansed_filepath = './cleansed_data/'
+
+# Command line options that only set how many cores a stage uses, not what it writes - they're left out of the stage
+# hash, so a different --cpu-budget doesn't rerun everything
+core_options = ['--workers', '--threads']
+
+
+# This method will return a script and every project module it imports, directly or through other project modules
+# (imports inside functions included) - an edit to any of them can change what the stage writes
+def module_closure(script) -> list:
+    modules = set()
+    pending = [script]
+    while pending:
+        filepath = pending.pop()
+        if filepath in modules:
+            continue
+        modules.add(filepath)
+
+        with open(filepath, 'r', encoding='utf8') as f:
+            tree = ast.parse(f.read(), filepath)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module is not None:
+                names = [node.module]
+            else:
+                continue
+            # only the modules of the project itself, the installed packages aren't hashed
+            pending.extend(name.split('.')[0] + '.py' for name in names if os.path.isfile(name.split('.')[0] + '.py'))
+
+    return sorted(modules)
+
+
+# This method will return the files the split writes, and the training files the cleanse writes before it, the same
+# way clean_data.py lists them - the .txt files or the notes store, and the .train / .test files or the folds
+# Returns (training files, split files)
+def pipeline_files(use_store=False, folds=None) -> tuple:
+    split_files = [cleansed_filepath + os.path.basename(filepath) for variant in split_variants(use_store)
+                   for filepath in split_output_filepaths(variant, folds)]
+    training_files = [cleansed_filepath + filename for filename in training_output_files(use_store, folds)
+                      if cleansed_filepath + filename not in split_files]
+
+    return training_files, split_files
+
+
+# This method will build the stages of the pipeline, in dependency order
+# Each stage: name, deps (stage names), inputs / outputs (file paths), params, cpus (cores it's given), command
+# use_store / folds are passed on to clean_data.py (--notes-store / --folds)
+def build_stages(cpu_budget: int, epochs=20, use_store=False, folds=None) -> list:
+    # the three training stages share the budget
+    train_cpus = max(1, cpu_budget // 3)
+
+    training_files, split_files = pipeline_files(use_store, folds)
+    clean_options = (['--notes-store'] if use_store else []) + (['--folds', str(folds)] if folds else [])
+    # the CNN reads the rolled common notes out of the store when there's no .txt file
+    cnn_files = [cleansed_filepath + notes_store.notes_filename,
+                 cleansed_filepath + 'rolled_common_input' + notes_store.labels_suffix] if use_store else \
+        [cleansed_filepath + 'rolled_common_input.txt']
+
+    stages = [
+        {
+            'name': 'cleanse',
+            'deps': [],
+            'inputs': ['./data/' + diag_file, './data/' + noteevents_file] + module_closure('clean_data.py'),
+            'outputs': training_files,
+            'params': {},
+            'cpus': cpu_budget,
+            'command': ['clean_data.py', '--no-split', '--workers', str(cpu_budget)] + clean_options,
+        },
+        {
+            'name': 'split',
+            'deps': ['cleanse'],
+            'inputs': training_files + module_closure('clean_data.py'),
+            'outputs': split_files,
+            'params': {},
+            'cpus': 1,
+            'command': ['clean_data.py', '--split-only'] + clean_options,
+        },
+        {
+            'name': 'train_cnn',
+            'deps': ['cleanse'],
+            'inputs': cnn_files + module_closure('train_common_rolled_BINARY_CNN.py'),
+            'outputs': ['./models/model_rolled_common_CNN.keras', './models/model_rolled_common_CNN_labels.json'],
+            'params': {'epochs': epochs},
+            'cpus': train_cpus,
+            'command': ['train_common_rolled_BINARY_CNN.py', '--epochs', str(epochs), '--threads', str(train_cpus)],
+        },
+    ]
+    if folds:
+        return stages
+
+    return stages + [
+        {
+            'name': 'train_binary_bot',
+            'deps': ['split'],
+            'inputs': ['./cleansed_data/rolled_common_input.train', './cleansed_data/rolled_common_input.test'] +
+            module_closure('train_common_rolled_BINARY_BOT.py'),
+            'outputs': ['./models/model_rolled_common_BINARY_BOT.bin'],
+            'params': {},
+            'cpus': train_cpus,
+            'command': ['train_common_rolled_BINARY_BOT.py', '--threads', str(train_cpus)],
+        },
+        {
+            'name': 'train_multi_bot',
+            'deps': ['split'],
+            'inputs': ['./cleansed_data/rolled_common_input.train', './cleansed_data/rolled_common_input.test'] +
+            module_closure('train_common_rolled_MULTI_BOT.py'),
+            'outputs': ['./models/model_rolled_common_MULTI_BOT.bin'],
+            'params': {},
+            'cpus': train_cpus,
+            'command': ['train_common_rolled_MULTI_BOT.py', '--threads', str(train_cpus)],
+        },
+        {
+            'name': 'evaluate',
+            'deps': ['train_binary_bot', 'train_multi_bot', 'train_cnn'],
+            'inputs': ['./cleansed_data/rolled_common_input.test', './models/model_rolled_common_BINARY_BOT.bin',
+                       './models/model_rolled_common_MULTI_BOT.bin', './models/model_rolled_common_CNN.keras'] +
+            module_closure('evaluate_models.py'),
+            'outputs': ['./models/evaluation_report.json'],
+            'params': {},
+            'cpus': 1,
+            'command': ['evaluate_models.py', './cleansed_data/rolled_common_input.test', '--evaluate', '--report',
+                        './models/evaluation_report.json'],
+        },
+    ]
+
+
+# This method will load the pipeline state, empty if there isn't one yet
+def load_state() -> dict:
+    if not os.path.isfile(state_filepath):
+        return {'stages': {}, 'digests': {}}
+
+    with open(state_filepath, 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+# This method will save the pipeline state, under a temp name and then renamed
+def save_state(state: dict) -> None:
+    os.makedirs(os.path.dirname(state_filepath), exist_ok=True)
+    with open(state_filepath + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(state_filepath + '.tmp', state_filepath)
+
+
+# This method will return the digest of a file, reusing the digest in the state while its size and mtime are unchanged
+# Missing files digest to 'missing'
+def cached_digest(filepath, state: dict) -> str:
+    if not os.path.isfile(filepath):
+        return 'missing'
+
+    stat = os.stat(filepath)
+    known = state['digests'].get(filepath)
+    if known is not None and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+        return known['digest']
+
+    digest = file_digest(filepath)
+    state['digests'][filepath] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest}
+
+    return digest
+
+
+# This method will hash a stage - its command line (without the core_options), parameters and the contents of its
+# inputs
+def stage_hash(stage: dict, state: dict) -> str:
+    command = [argument for argument, previous in zip(stage['command'], [None] + stage['command'][:-1])
+               if argument not in core_options and previous not in core_options]
+    digest = hashlib.sha256(json.dumps([command, stage['params']], sort_keys=True).encode())
+    for filepath in stage['inputs']:
+        digest.update((filepath + cached_digest(filepath, state)).encode())
+
+    return digest.hexdigest()
+
+
+# This method will check whether a stage can be skipped - same hash as its last successful run, and outputs in place
+def is_up_to_date(stage: dict, state: dict) -> bool:
+    last_run = state['stages'].get(stage['name'])
+    return last_run is not None and last_run['hash'] == stage_hash(stage, state) and \
+        all(os.path.isfile(filepath) for filepath in stage['outputs'])
+
+
+# This method will run one stage's command, it runs in a worker thread. Returns (return code, seconds)
+def run_stage(stage: dict, log_dir) -> tuple:
+    start = time.perf_counter()
+    with open(os.path.join(log_dir, stage['name'] + '.log'), 'w', encoding='utf8') as log_file:
+        result = subprocess.run([sys.executable] + stage['command'], stdout=log_file, stderr=subprocess.STDOUT)
+
+    return result.returncode, time.perf_counter() - start
+
+
+# This method will run the pipeline. targets -> only run these stages and what they depend on, force -> run these
+# stages even if they're up to date ('all' for every stage). Returns {stage: 'skipped' / 'ran' / 'failed' / 'blocked'},
+# or 'would run' in a dry run
+def run_pipeline(stages: list, cpu_budget: int, targets=None, force=(), dry_run=False, log_dir='./logs') -> dict:
+    by_name = {stage['name']: stage for stage in stages}
+
+    # the targets and everything they depend on
+    wanted = set()
+    pending_names = list(targets or by_name)
+    while pending_names:
+        name = pending_names.pop()
+        if name not in by_name:
+            raise ValueError('unknown stage ' + name + ', stages are: ' + ', '.join(by_name))
+        if name not in wanted:
+            wanted.add(name)
+            pending_names.extend(by_name[name]['deps'])
+
+    state = load_state()
+    os.makedirs(log_dir, exist_ok=True)
+    status = {}
+    running = {}
+    cpus_in_use = 0
+
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        while True:
+            # start every stage whose dependencies are done, while its cores fit in the budget. A stage that wants
+            # more than the whole budget still runs, on its own
+            for stage in stages:
+                name = stage['name']
+                if name not in wanted or name in status or name in running.values():
+                    continue
+
+                dep_status = [status.get(dep) for dep in stage['deps'] if dep in wanted]
+                if any(dep in ('failed', 'blocked') for dep in dep_status):
+                    status[name] = 'blocked'
+                    continue
+                if any(dep is None for dep in dep_status):
+                    continue
+
+                # a dependency that ran changed the inputs, so the hash has to be taken after it finished
+                will_change = 'would run' in dep_status
+                if not will_change and 'all' not in force and name not in force and is_up_to_date(stage, state):
+                    my_logger.info("  " + name + ": up to date, skipped")
+                    status[name] = 'skipped'
+                    continue
+
+                if dry_run:
+                    my_logger.info("  " + name + ": would run - " + ' '.join(stage['command']))
+                    status[name] = 'would run'
+                    continue
+
+                cpus = min(stage['cpus'], cpu_budget)
+                if running and cpus_in_use + cpus > cpu_budget:
+                    continue
+
+                my_logger.info("  " + name + ": running on " + str(cpus) + " core(s) - " + ' '.join(stage['command']))
+                running[executor.submit(run_stage, stage, log_dir)] = name
+                cpus_in_use = cpus_in_use + cpus
+
+            # stages are in dependency order, so with nothing running every wanted stage has been dealt with
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                stage = by_name[name]
+                cpus_in_use = cpus_in_use - min(stage['cpus'], cpu_budget)
+                return_code, seconds = future.result()
+
+                if return_code == 0:
+                    status[name] = 'ran'
+                    state['stages'][name] = {'hash': stage_hash(stage, state), 'seconds': round(seconds, 1),
+                                             'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+                    save_state(state)
+                    my_logger.info("  " + name + ": done in " + f"{seconds:.1f}s")
+                else:
+                    status[name] = 'failed'
+                    my_logger.error("  " + name + ": FAILED (exit code " + str(return_code) + "), see " +
+                                    os.path.join(log_dir, name + '.log'))
+
+    save_state(state)
+
+    return status
+
+
+# Main method - python will automatically run this
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the cleanse -> split -> train -> evaluate pipeline')
+    parser.add_argument('targets', nargs='*', help='stages to run, with everything they depend on (default: all)')
+    parser.add_argument('--cpu-budget', type=int, default=None, help='cores the pipeline may use (default: all)')
+    parser.add_argument('--force', nargs='+', default=[],
+                        help="run these stages even if they're up to date, 'all' for every stage")
+    parser.add_argument('--epochs', type=int, default=20, help='CNN training epochs')
+    parser.add_argument('--notes-store', action='store_true',
+                        help='have clean_data.py write the notes store instead of the .txt training files')
+    parser.add_argument('--folds', type=int, default=None,
+                        help='have clean_data.py write this many folds instead of the .train / .test files - the BOT '
+                             'training and evaluate stages are left out')
+    parser.add_argument('--dry-run', action='store_true', help='only show which stages would run')
+    parser.add_argument('--log-dir', default='./logs', help='directory the output of every stage is written to')
+    args = parser.parse_args()
+
+    budget = args.cpu_budget or os.cpu_count() or 1
+    pipeline_stages = build_stages(budget, args.epochs, args.notes_store, args.folds)
+
+    my_logger.info("Running the pipeline (" + str(budget) + " core budget) ...")
+    pipeline_status = run_pipeline(pipeline_stages, budget, args.targets, args.force, args.dry_run, args.log_dir)
+
+    my_logger.info("Pipeline summary:")
+    for stage_name, stage_status in pipeline_status.items():
+        my_logger.info(f"  {stage_name:>16}: {stage_status}")
+
+    if any(stage_status in ('failed', 'blocked') for stage_status in pipeline_status.values()):
+        sys.exit(1)
@@ -0,0 +1,301 @@
+# This will run a hyperparameter sweep for the fastText BOT models
+# Trials are scheduled across a process pool, and the core budget is split between them - each trial trains with
+# (cores / parallel trials) fastText threads, so the box is never oversubscribed. Every result is cached on disk, keyed
+# by the parameters and the hash of the training / validation data, so a rerun only trains the new configurations
+#   grid -> every combination of the parameter grid
+#   random -> n_trials combinations sampled from the grid
+#   halving -> successive halving: n_trials sampled combinations trained for a few epochs, the best 1/eta of them are
+#              trained again with eta times the epochs, and so on up to the largest epoch in the grid
+# The leaderboard (time, model size, precision, recall, F1) is logged and written to a csv
+# Trials are scored on a validation split carved out of the training file, the .test file is kept for the final scores
+# of the training scripts / evaluate_models.py
+import argparse
+import csv
+import functools
+import hashlib
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import fasttext
+
+from clean_data import file_digest, split_input_file, split_output_filepaths
+
+# Set Logging -- basic configuration
+logging.basicConfig(format='%(asctime)s -- %(levelname)s: %(message)s',
+                    level=logging.NOTSET,
+                    datefmt='%Y-%m-%d %H:%M:%S')
+my_logger = logging.getLogger('classifier_project')
+
+# The configurations the BINARY_BOT / MULTI_BOT training scripts use, they are always part of the default grid
+baseline_params = [
+    {'dim': 300, 'epoch': 50, 'lr': .1, 'minCount': 5, 'loss': 'ns'},
+    {'dim': 300, 'epoch': 25, 'lr': .05, 'minCount': 5, 'loss': 'ova'},
+]
+
+default_grid = {
+    'dim': [100, 300],
+    'epoch': [25, 50],
+    'lr': [.05, .1, .5],
+    'minCount': [5],
+    'loss': ['ns', 'ova'],
+    'wordNgrams': [1, 2],
+}
+
+cache_filepath = './models/sweep_cache/'
+validation_filepath = './cleansed_data/sweep/'
+
+
+# This method will expand a parameter grid ({name: [values]}) into the list of every combination
+def expand_grid(grid: dict) -> list:
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+# This method will split the training file into the part the trials train on and the part they're scored on, with the
+# same hash split clean_data.py uses. The seed has to differ from the one the .train / .test split was made with, every
+# line of the .train file hashes onto the train side with that one
+# Returns (fit file, validation file)
+def validation_split(train_filepath, valid_fraction=.1, seed=1, split_filepath=validation_filepath):
+    os.makedirs(split_filepath, exist_ok=True)
+    stem = split_filepath + os.path.splitext(os.path.basename(train_filepath))[0]
+    split_input_file(stem, valid_fraction, seed, read_lines=functools.partial(open, train_filepath, 'r',
+                                                                              encoding='utf8'))
+
+    fit_filepath, valid_filepath = split_output_filepaths(stem)
+    return fit_filepath, valid_filepath
+
+
+# This method will drop repeated configurations, keeping the first of each
+def unique_params(param_list: list) -> list:
+    seen = set()
+    unique = []
+    for params in param_list:
+        key = json.dumps(params, sort_keys=True)
+        if key not in seen:
+            seen.add(key)
+            unique.append(params)
+
+    return unique
+
+
+# This method will build the cache key of a trial from its parameters and the digest of its data
+def trial_key(params: dict, data_digest: str) -> str:
+    return hashlib.sha256((json.dumps(params, sort_keys=True) + data_digest).encode()).hexdigest()[:16]
+
+
+# This method will load a cached trial result, None if the trial hasn't been run
+def load_trial(key):
+    result_filepath = cache_filepath + key + '.json'
+    if not os.path.isfile(result_filepath):
+        return None
+
+    with open(result_filepath, 'r') as f:
+        return json.load(f)
+
+
+# This method will save a trial result to the cache
+def save_trial(key, result: dict) -> None:
+    os.makedirs(cache_filepath, exist_ok=True)
+    with open(cache_filepath + key + '.json.tmp', 'w') as f:
+        json.dump(result, f, indent=2)
+    os.replace(cache_filepath + key + '.json.tmp', cache_filepath + key + '.json')
+
+
+# This method will train and test one configuration, it runs in the worker processes
+# The model is saved to a temp file to measure its size, then thrown away
+def run_trial(params: dict, train_filepath, valid_filepath, threads: int) -> dict:
+    start = time.perf_counter()
+    model = fasttext.train_supervised(input=train_filepath, thread=threads, verbose=0, **params)
+    train_seconds = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        model_filepath = os.path.join(model_dir, 'model.bin')
+        model.save_model(model_filepath)
+        model_bytes = os.path.getsize(model_filepath)
+
+    note_count, precision, recall = model.test(valid_filepath)
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+
+    return {
+        'params': params,
+        'threads': threads,
+        'train_seconds': round(train_seconds, 2),
+        'model_mb': round(model_bytes / 1024 / 1024, 2),
+        'notes': note_count,
+        'precision': round(precision, 6),
+        'recall': round(recall, 6),
+        'f1': round(f1, 6),
+    }
+
+
+# This method will run a list of configurations, taking cached results where they exist
+# cpu_budget cores are split between parallel trials, each trial getting threads_per_trial fastText threads
+def run_trials(param_list: list, train_filepath, valid_filepath, data_digest, cpu_budget=None,
+               threads_per_trial=None) -> list:
+    cpu_budget = cpu_budget or os.cpu_count() or 1
+    threads_per_trial = max(1, min(threads_per_trial or 4, cpu_budget))
+    workers = max(1, cpu_budget // threads_per_trial)
+
+    results = []
+    to_run = []
+    # the same configuration twice would train twice, and race on its cache file
+    param_list = unique_params(param_list)
+    for params in param_list:
+        key = trial_key(params, data_digest)
+        cached = load_trial(key)
+        if cached is not None:
+            results.append(dict(cached, cached=True))
+        else:
+            to_run.append((key, params))
+
+    my_logger.info("  " + str(len(param_list)) + " trial(s): " + str(len(results)) + " cached, " + str(len(to_run)) +
+                   " to train - " + str(workers) + " parallel x " + str(threads_per_trial) + " threads")
+
+    if not to_run:
+        return results
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_trial, params, train_filepath, valid_filepath, threads_per_trial): key
+                   for key, params in to_run}
+        for future in as_completed(futures):
+            result = future.result()
+            save_trial(futures[future], result)
+            results.append(dict(result, cached=False))
+            my_logger.info("    " + json.dumps(result['params'], sort_keys=True) + " -> P " + str(result['precision']) +
+                           ", R " + str(result['recall']) + " in " + str(result['train_seconds']) + "s")
+
+    return results
+
+
+# This method will run successive halving over the sampled configurations, see the top of the file
+# Every result is labelled with its rung (0 first), the last rung is always trained at max_epoch
+def successive_halving(param_list: list, train_filepath, valid_filepath, data_digest, eta=3, min_epoch=5,
+                       max_epoch=50, **run_options) -> list:
+    all_results = []
+    remaining = param_list
+    epoch = min(min_epoch, max_epoch)
+    rung = 0
+
+    while remaining:
+        my_logger.info("  HALVING RUNG: " + str(len(remaining)) + " configuration(s) at " + str(epoch) + " epochs")
+        rung_results = run_trials([dict(params, epoch=epoch) for params in remaining], train_filepath,
+                                  valid_filepath, data_digest, **run_options)
+        all_results.extend(dict(result, rung=rung) for result in rung_results)
+
+        if epoch >= max_epoch:
+            break
+
+        # keep the best 1/eta of this rung, by F1 - a single survivor goes straight to max_epoch
+        rung_results.sort(key=lambda result: result['f1'], reverse=True)
+        keep = max(1, math.ceil(len(remaining) / eta))
+        remaining = unique_params([{name: value for name, value in result['params'].items() if name != 'epoch'}
+                                   for result in rung_results[:keep]])
+        epoch = max_epoch if len(remaining) == 1 else min(epoch * eta, max_epoch)
+        rung = rung + 1
+
+    return all_results
+
+
+# This method will run the sweep and return the leaderboard, best F1 first - for halving the last rung comes first, the
+# lower epoch rungs aren't comparable to it
+def run_sweep(train_filepath, valid_filepath, grid=None, search='grid', n_trials=20, seed=0, eta=3, min_epoch=5,
+              cpu_budget=None, threads_per_trial=None) -> list:
+    grid = grid or default_grid
+    param_list = expand_grid(grid)
+    if grid is default_grid:
+        param_list = param_list + [params for params in baseline_params if params not in param_list]
+
+    # halving sets the epochs itself, configurations that only differ in epoch are the same configuration to it
+    if search == 'halving':
+        param_list = unique_params([{name: value for name, value in params.items() if name != 'epoch'}
+                                    for params in param_list])
+
+    if search in ('random', 'halving') and n_trials < len(param_list):
+        param_list = random.Random(seed).sample(param_list, n_trials)
+
+    # the training data and the validation data both go into the cache key
+    data_digest = file_digest(train_filepath) + file_digest(valid_filepath)
+
+    my_logger.info("Running " + search + " sweep over " + str(len(param_list)) + " configuration(s) ...")
+    run_options = {'cpu_budget': cpu_budget, 'threads_per_trial': threads_per_trial}
+
+    if search == 'halving':
+        max_epoch = max(grid.get('epoch', [min_epoch]))
+        results = successive_halving(param_list, train_filepath, valid_filepath, data_digest, eta, min_epoch,
+                                     max_epoch, **run_options)
+    else:
+        results = run_trials(param_list, train_filepath, valid_filepath, data_digest, **run_options)
+
+    return sorted(results, key=lambda result: (result.get('rung', 0), result['f1']), reverse=True)
+
+
+# This method will log the leaderboard, and write it to a csv
+def write_leaderboard(leaderboard: list, leaderboard_filepath) -> None:
+    my_logger.info("LEADERBOARD (" + str(len(leaderboard)) + " trials, last rung then best F1 first):")
+    for rank, result in enumerate(leaderboard[:20], start=1):
+        my_logger.info(f"  {rank:>3}. rung {result.get('rung', 0)}  F1 {result['f1']:.4f}  "
+                       f"P {result['precision']:.4f}  R {result['recall']:.4f}  "
+                       f"{result['train_seconds']:>7.1f}s  {result['model_mb']:>8.1f}MB  "
+                       f"{json.dumps(result['params'], sort_keys=True)}")
+
+    param_names = sorted({name for result in leaderboard for name in result['params']})
+    with open(leaderboard_filepath, 'w', encoding='utf8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['rank', 'rung', 'f1', 'precision', 'recall', 'train_seconds', 'model_mb', 'threads',
+                         'cached'] + param_names)
+        for rank, result in enumerate(leaderboard, start=1):
+            writer.writerow([rank, result.get('rung', 0), result['f1'], result['precision'], result['recall'],
+                             result['train_seconds'], result['model_mb'], result['threads'], result['cached']] +
+                            [result['params'].get(name, '') for name in param_names])
+
+    my_logger.info("Leaderboard saved into " + leaderboard_filepath)
+
+
+# Main method - python will automatically run this
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep for the fastText BOT models')
+    parser.add_argument('--train', default='./cleansed_data/rolled_common_input.train', help='training file')
+    parser.add_argument('--valid', default=None,
+                        help='file the trials are scored on (default: a validation split of --train, trials train on '
+                             'the rest - keep the .test file for the final scores)')
+    parser.add_argument('--valid-fraction', type=float, default=.1,
+                        help='fraction of --train held out for validation when --valid is not given')
+    parser.add_argument('--valid-seed', type=int, default=1,
+                        help="seed of the validation split, not the one the .train / .test split was made with")
+    parser.add_argument('--grid', default=None,
+                        help='parameter grid as json, e.g. \'{"dim": [100, 300], "loss": ["ns", "ova"]}\', or the '
+                             'path of a json file. Defaults to a grid around the BINARY / MULTI BOT configurations')
+    parser.add_argument('--search', choices=['grid', 'random', 'halving'], default='grid', help='search strategy')
+    parser.add_argument('--trials', type=int, default=20, help='configurations sampled for random / halving search')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the random / halving sampling')
+    parser.add_argument('--eta', type=int, default=3, help='halving rate for successive halving')
+    parser.add_argument('--min-epoch', type=int, default=5, help='epochs of the first successive halving rung')
+    parser.add_argument('--cpu-budget', type=int, default=None, help='cores the sweep may use (default: all)')
+    parser.add_argument('--threads-per-trial', type=int, default=None,
+                        help='fastText threads per trial (default: 4), parallel trials = cpu budget / this')
+    parser.add_argument('--leaderboard', default='./models/sweep_leaderboard.csv', help='csv the leaderboard goes to')
+    args = parser.parse_args()
+
+    sweep_grid = None
+    if args.grid is not None:
+        if os.path.isfile(args.grid):
+            with open(args.grid, 'r') as grid_file:
+                sweep_grid = json.load(grid_file)
+        else:
+            sweep_grid = json.loads(args.grid)
+
+    fit_file, valid_file = args.train, args.valid
+    if valid_file is None:
+        fit_file, valid_file = validation_split(args.train, args.valid_fraction, args.valid_seed)
+        my_logger.info("Trials train on " + fit_file + " and are scored on " + valid_file)
+
+    sweep_leaderboard = run_sweep(fit_file, valid_file, sweep_grid, args.search, args.trials, args.seed, args.eta,
+                                  args.min_epoch, args.cpu_budget, args.threads_per_trial)
+    write_leaderboard(sweep_leaderboard, args.leaderboard)
@@ -0,0 +1,258 @@
+# This will generate synthetic MIMIC-III shaped input files, for running / benchmarking the pipeline without the
+# credentialed PhysioNet data:
+#   DIAGNOSES_ICD.csv.gz -> ROW_ID, SUBJECT_ID, HADM_ID, SEQ_NUM, ICD9_CODE
+#   NOTEEVENTS.csv.gz -> ROW_ID, SUBJECT_ID, HADM_ID, CHARTDATE, CHARTTIME, STORETIME, CATEGORY, DESCRIPTION, CGID,
+#                        ISERROR, TEXT
+# The shapes follow MIMIC-III - admits per patient, codes per admit (drawn from a skewed code frequency, with 250.x
+# diabetes codes for about a quarter of the patients and V codes mixed in), the note category mix and note lengths.
+# Discharge summaries mention words tied to the admit's codes, so the trained models have some signal to learn
+# Output is deterministic for a seed, and written a block of patients at a time so any scale fits in memory
+import argparse
+import gzip
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from clean_data import diag_file, noteevents_file, normalize_text
+
+# Set Logging -- basic configuration
+logging.basicConfig(format='%(asctime)s -- %(levelname)s: %(message)s',
+                    level=logging.NOTSET,
+                    datefmt='%Y-%m-%d %H:%M:%S')
+my_logger = logging.getLogger('classifier_project')
+
+diagnoses_columns = ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'SEQ_NUM', 'ICD9_CODE']
+notes_columns = ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'CHARTDATE', 'CHARTTIME', 'STORETIME', 'CATEGORY', 'DESCRIPTION',
+                 'CGID', 'ISERROR', 'TEXT']
+
+# Frequent MIMIC-III codes, most frequent first - codes are drawn with a zipf like weight by rank
+common_codes = ['4019', '4280', '42731', '41401', '5849', '2724', '51881', '5990', '53081', '2720', 'V053', 'V290',
+                '2859', '2449', '486', '2851', '2762', '496', 'V3000', '99592', 'V5861', '0389', '5070', 'V3001',
+                '5856', '40390', '3051', 'V1582', '2761', 'V4581', '412', '4240', '311', '2875', 'V5867', '4589',
+                '2767', '2768', '5119', 'V4501', '4168', '42789', 'V1251', '5859', 'E8782', '4271', 'V103', '3572',
+                '2809', 'V433']
+# 250.x - diabetes mellitus, type / complication / control status in the 4th and 5th digits
+diabetes_codes = ['25000', '25001', '25002', '25003', '25040', '25041', '25042', '25050', '25051', '25060', '25061',
+                  '25062', '25070', '25080', '25081', '25092', '25013', '25012', '25011', '25010']
+diabetic_fraction = .25
+code_letters = str.maketrans('0123456789', 'abcdefghij')
+
+# Note category mix of MIMIC-III (share of all NOTEEVENTS rows), and the median / spread of the words per note
+note_categories = {
+    'Nursing/other': (.394, 220, .6),
+    'Radiology': (.251, 180, .7),
+    'Nursing': (.107, 350, .6),
+    'ECG': (.100, 25, .4),
+    'Physician ': (.068, 900, .5),
+    'Discharge summary': (.029, 1400, .5),
+    'Echo': (.022, 300, .3),
+    'Respiratory ': (.015, 120, .5),
+    'Nutrition': (.004, 300, .5),
+    'General': (.004, 200, .6),
+    'Rehab Services': (.003, 400, .5),
+    'Social Work': (.002, 250, .5),
+    'Case Management ': (.001, 150, .5),
+}
+# share of notes written outside of an admission (no HADM_ID), mostly outpatient ECG / radiology
+no_admit_fraction = .08
+
+# Section headers, as they appear in discharge summaries
+sections = ['Admission Date:', 'Discharge Date:', 'Date of Birth:', 'Service: MEDICINE', 'Allergies:',
+            'Chief Complaint:', 'History of Present Illness:', 'Past Medical History:', 'Social History:',
+            'Family History:', 'Physical Exam:', 'Pertinent Results:', 'Brief Hospital Course:',
+            'Medications on Admission:', 'Discharge Medications:', 'Discharge Disposition:', 'Discharge Diagnosis:',
+            'Discharge Condition:', 'Discharge Instructions:', 'Followup Instructions:']
+clinical_words = ('patient admitted with history of presented to the ed chest pain shortness breath denies '
+                  'fever chills nausea vomiting abdominal pain cough was noted on exam blood pressure heart '
+                  'rate normal sinus rhythm insulin glucose metformin lasix aspirin lisinopril metoprolol given '
+                  'iv fluids transferred to micu intubated extubated stable discharged home with services '
+                  'follow up pcp in weeks labs wbc hct plt creatinine bun sodium potassium chest xray ct scan '
+                  'echo ef mild moderate severe left right bilateral edema wound culture negative positive '
+                  'started on antibiotics for pneumonia uti sepsis').split()
+
+
+# This method will build the word list notes are drawn from - the clinical words, then made up words, in frequency
+# order - and the cumulative zipf weights to draw them with
+# The made up words spell their index in letters, the cleanse turns every digit into 'd' and would fold them together
+def build_vocabulary(size=30000):
+    words = np.array(clinical_words + ['tok' + str(i).translate(code_letters)
+                                       for i in range(max(size - len(clinical_words), 0))])
+    assert len(set(normalize_text(' '.join(words)).split())) >= .99 * len(words), \
+        'the vocabulary does not survive the cleanse'
+    weights = 1 / np.arange(1, len(words) + 1) ** 1.1
+    return words, np.cumsum(weights / weights.sum())
+
+
+# This method will return the words tied to a code, which discharge summaries of admits with that code mention
+# Digits are spelled as letters, the cleanse would turn them all into 'd'
+def code_words(code) -> list:
+    spelled = code.lower().translate(code_letters)
+    return ['dx' + spelled, 'dx' + spelled[:3] + 'x']
+
+
+# This method will draw n word indices with the cumulative weights
+def draw_words(rng: np.random.Generator, cumulative_weights: np.ndarray, n: int) -> np.ndarray:
+    return np.minimum(np.searchsorted(cumulative_weights, rng.random(n)), len(cumulative_weights) - 1)
+
+
+# This method will build a pool of vitals / labs / de-identified dates, so the digit and punctuation rules of the
+# cleanse have something to do
+def build_measurements(rng: np.random.Generator, size=5000) -> np.ndarray:
+    kinds = rng.integers(0, 5, size)
+    return np.array([['bp ' + str(rng.integers(90, 180)) + '/' + str(rng.integers(50, 100)),
+                      '[**2150-' + str(rng.integers(1, 13)) + '-' + str(rng.integers(1, 29)) + '**]',
+                      str(round(rng.uniform(0, 20), 1)) + 'mg,', 'hr ' + str(rng.integers(50, 130)) + '.',
+                      '#' + str(rng.integers(1, 9)) + ':'][kind] for kind in kinds], dtype=object)
+
+
+# This method will build the text of one note - drawn words with a measurement every 25 words or so, and (for discharge
+# summaries) section headers and the words tied to the admit's codes
+def make_note_text(rng, words, cumulative_weights, measurements, word_count: int, category: str, codes=()) -> str:
+    tokens = words[draw_words(rng, cumulative_weights, word_count)].astype(object)
+    measurement_count = max(1, word_count // 25)
+    tokens[rng.integers(0, word_count, measurement_count)] = \
+        measurements[rng.integers(0, len(measurements), measurement_count)]
+
+    if category == 'Discharge summary':
+        headers = ['\n\n' + section for section in sections]
+        mentions = [word for code in codes for word in code_words(code)]
+        tokens = np.insert(tokens, np.concatenate([np.linspace(0, word_count, len(headers), endpoint=False).astype(int),
+                                                   rng.integers(0, word_count + 1, len(mentions))]),
+                           np.array(headers + mentions, dtype=object))
+
+    return ' '.join(tokens)
+
+
+# This method will generate the admits, diagnoses and notes of one block of patients, as two dataframes
+# first_subject / first_admit -> ids to start the block at, row ids are filled in by the caller
+def generate_block(rng, words, cumulative_weights, measurements, first_subject: int, subject_count: int,
+                   first_admit: int, notes_per_admit: float):
+    code_pool = np.array(common_codes)
+    code_weights = 1 / np.arange(1, len(code_pool) + 1) ** 1.3
+    code_weights = code_weights / code_weights.sum()
+    category_names = list(note_categories)
+    category_weights = np.array([share for share, _, _ in note_categories.values()])
+    category_weights = category_weights / category_weights.sum()
+
+    diagnoses_rows = []
+    notes_rows = []
+    admit_id = first_admit
+    for subject_id in range(first_subject, first_subject + subject_count):
+        is_diabetic = rng.random() < diabetic_fraction
+        # most patients have one admit, a few have many
+        for _ in range(min(int(rng.geometric(.75)), 20)):
+            admit_id = admit_id + 1
+
+            # about 11 codes per admit, primary code first. Diabetic patients carry a 250.x code on most admits
+            codes = list(dict.fromkeys(rng.choice(code_pool, size=max(1, int(rng.poisson(10))), p=code_weights)))
+            if is_diabetic and rng.random() < .85:
+                codes.insert(int(rng.integers(0, min(len(codes), 4) + 1)), rng.choice(diabetes_codes))
+            for seq_num, code in enumerate(codes, 1):
+                diagnoses_rows.append((subject_id, admit_id, seq_num, code))
+            # a handful of MIMIC rows have no code
+            if rng.random() < .001:
+                diagnoses_rows.append((subject_id, admit_id, len(codes) + 1, None))
+
+            categories = rng.choice(category_names, size=int(rng.poisson(notes_per_admit)), p=category_weights)
+            # nearly every admit has a discharge summary, some have an addendum
+            categories = np.append(categories, ['Discharge summary'] * (1 + (rng.random() < .2)))
+            for category in categories:
+                _, median_words, spread = note_categories[category]
+                word_count = max(3, int(rng.lognormal(np.log(median_words), spread)))
+                has_admit = category == 'Discharge summary' or rng.random() >= no_admit_fraction
+                notes_rows.append((subject_id, admit_id if has_admit else None,
+                                   '2150-' + str(rng.integers(1, 13)).zfill(2) + '-' +
+                                   str(rng.integers(1, 29)).zfill(2),
+                                   category, 'Report',
+                                   make_note_text(rng, words, cumulative_weights, measurements, word_count, category,
+                                                  codes)))
+
+    diagnoses_df = pd.DataFrame(diagnoses_rows, columns=['SUBJECT_ID', 'HADM_ID', 'SEQ_NUM', 'ICD9_CODE'])
+    notes_df = pd.DataFrame(notes_rows,
+                            columns=['SUBJECT_ID', 'HADM_ID', 'CHARTDATE', 'CATEGORY', 'DESCRIPTION', 'TEXT'])
+    notes_df['HADM_ID'] = notes_df['HADM_ID'].astype('Int64')
+
+    return diagnoses_df, notes_df, admit_id
+
+
+# This method will write the synthetic DIAGNOSES_ICD / NOTEEVENTS files for subject_count patients into data_filepath
+# The default directory is kept apart from ./data, and files already there are only replaced with force - pointed at
+# ./data it would otherwise replace the real MIMIC-III files
+# notes_per_admit -> mean notes per admit besides the discharge summary (MIMIC-III has about 35), fewer keeps big scales
+#    quick to generate while keeping the discharge summaries the pipeline trains on
+# Returns {'subjects', 'admits', 'diagnoses', 'notes'} row counts
+def generate_dataset(subject_count: int, data_filepath='./synthetic_data/', seed=0, notes_per_admit=35.0,
+                     block_size=500, vocabulary_size=30000, force=False) -> dict:
+    existing = [filename for filename in [diag_file, noteevents_file]
+                if os.path.exists(os.path.join(data_filepath, filename))]
+    if existing and not force:
+        raise FileExistsError(', '.join(existing) + ' already in ' + data_filepath + ', pass force (--force) to '
+                              'replace them')
+
+    os.makedirs(data_filepath, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    words, cumulative_weights = build_vocabulary(vocabulary_size)
+    measurements = build_measurements(rng)
+    counts = {'subjects': subject_count, 'admits': 0, 'diagnoses': 0, 'notes': 0}
+
+    diag_filepath = os.path.join(data_filepath, diag_file)
+    notes_filepath = os.path.join(data_filepath, noteevents_file)
+    # written under temp names and then renamed, so an interrupted run never leaves a truncated input behind. The
+    # fastest gzip level keeps generation quick, reading the files back costs about the same at any level
+    with gzip.open(diag_filepath + '.tmp', 'wt', compresslevel=1, encoding='utf8', newline='') as f_diag, \
+            gzip.open(notes_filepath + '.tmp', 'wt', compresslevel=1, encoding='utf8', newline='') as f_notes:
+        admit_id = 100000
+        for first_subject in range(0, subject_count, block_size):
+            first_admit = admit_id
+            diagnoses_df, notes_df, admit_id = generate_block(rng, words, cumulative_weights, measurements,
+                                                              10000 + first_subject,
+                                                              min(block_size, subject_count - first_subject),
+                                                              first_admit, notes_per_admit)
+
+            diagnoses_df.insert(0, 'ROW_ID', counts['diagnoses'] + np.arange(len(diagnoses_df)) + 1)
+            notes_df.insert(0, 'ROW_ID', counts['notes'] + np.arange(len(notes_df)) + 1)
+            for column in ['CHARTTIME', 'STORETIME', 'CGID', 'ISERROR']:
+                notes_df[column] = None
+
+            diagnoses_df[diagnoses_columns].to_csv(f_diag, header=first_subject == 0, index=False)
+            notes_df[notes_columns].to_csv(f_notes, header=first_subject == 0, index=False)
+
+            counts['admits'] = counts['admits'] + admit_id - first_admit
+            counts['diagnoses'] = counts['diagnoses'] + len(diagnoses_df)
+            counts['notes'] = counts['notes'] + len(notes_df)
+            my_logger.info("  " + str(min(first_subject + block_size, subject_count)) + " / " + str(subject_count) +
+                           " patients generated")
+
+    os.replace(diag_filepath + '.tmp', diag_filepath)
+    os.replace(notes_filepath + '.tmp', notes_filepath)
+
+    return counts
+
+
+# Main method - python will automatically run this
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic MIMIC-III shaped DIAGNOSES_ICD / NOTEEVENTS files')
+    parser.add_argument('--subjects', type=int, default=2000, help='number of patients (MIMIC-III has about 46000)')
+    parser.add_argument('--notes-per-admit', type=float, default=35.0,
+                        help='mean notes per admit besides the discharge summary')
+    parser.add_argument('--seed', type=int, default=0, help='random seed, the same seed writes the same files')
+    parser.add_argument('--output-dir', default='./synthetic_data/',
+                        help='directory the .csv.gz files are written to (copy them into ./data to run the pipeline)')
+    parser.add_argument('--force', action='store_true', help='replace input files already in --output-dir')
+    parser.add_argument('--summary', default=None, help='also write the generated row counts to this json file')
+    args = parser.parse_args()
+
+    my_logger.info("Generating synthetic data for " + str(args.subjects) + " patients into " + args.output_dir + " ...")
+    try:
+        generated = generate_dataset(args.subjects, args.output_dir, args.seed, args.notes_per_admit,
+                                     force=args.force)
+    except FileExistsError as error:
+        parser.error(str(error))
+    my_logger.info("Generated " + ', '.join(str(count) + ' ' + name for name, count in generated.items()))
+
+    if args.summary is not None:
+        with open(args.summary, 'w', encoding='utf8') as f:
+            json.dump(generated, f, indent=2)
@@ -0,0 +1,41 @@
+# Shared fixtures for the tests - a small synthetic MIMIC-III shaped dataset (see synthetic_data.py), cleansed once per
+# session. The scripts read and write ./data, ./cleansed_data and ./models, so the session runs in a temp directory
+import os
+
+import pytest
+
+import clean_data
+import synthetic_data
+
+
+@pytest.fixture(scope='session')
+def workdir(tmp_path_factory):
+    path = tmp_path_factory.mktemp('work')
+    synthetic_data.generate_dataset(60, data_filepath=str(path / 'data'), seed=0, notes_per_admit=4.0,
+                                    vocabulary_size=2000)
+    os.makedirs(path / 'cleansed_data')
+    os.makedirs(path / 'models')
+
+    cwd = os.getcwd()
+    os.chdir(path)
+    yield path
+    os.chdir(cwd)
+
+
+# (notes_df, diagnoses_df, unique_admit_list) of the synthetic dataset, the way clean_data.py's main builds them
+@pytest.fixture(scope='session')
+def cleansed_frames(workdir):
+    unique_subject_list, unique_admit_list, diagnoses_df = clean_data.cleanse_diagnoses(rebuild_cache=True)
+    notes_df = clean_data.cleanse_notes(unique_subject_list, unique_admit_list, workers=1, rebuild_cache=True)
+
+    return notes_df, diagnoses_df, unique_admit_list
+
+
+# the lines of rolled_common_input.txt written from the synthetic dataset
+@pytest.fixture(scope='session')
+def common_lines(cleansed_frames):
+    notes_df, diagnoses_df, unique_admit_list = cleansed_frames
+    clean_data.save_training_files(notes_df, diagnoses_df, unique_admit_list)
+
+    with open('./cleansed_data/rolled_common_input.txt', 'r', encoding='utf8') as f:
+        return f.readlines()
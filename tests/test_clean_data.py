@@ -0,0 +1,88 @@
+# Tests for the training file writers of clean_data.py, run against the synthetic dataset (see conftest.py)
+import clean_data
+import fasttext_reader
+
+
+# the grouped writer has to write the same bytes as the original per admit scan writer, from the compact diagnoses
+def test_writers_byte_identical(cleansed_frames):
+    notes_df, diagnoses_df, unique_admit_list = cleansed_frames
+    _, _, identical = clean_data.compare_training_writers(notes_df, diagnoses_df, unique_admit_list)
+
+    assert identical
+
+
+def test_training_files_not_empty(common_lines):
+    assert len(common_lines) > 10
+    assert all(line.startswith('__label__') and line.endswith('\n') for line in common_lines)
+
+
+# This method will split lines written to <tmp_path>/<name>.txt, returns the lines of each output file
+def split_lines(tmp_path, name, lines, **split_settings) -> list:
+    stem = str(tmp_path / name)
+    with open(stem + '.txt', 'w', encoding='utf8') as f:
+        f.writelines(lines)
+
+    clean_data.split_input_file(stem, **split_settings)
+
+    return [open(filepath, 'r', encoding='utf8').readlines()
+            for filepath in clean_data.split_output_filepaths(stem, split_settings.get('folds'))]
+
+
+def test_split_does_not_depend_on_line_order(tmp_path, common_lines):
+    train, test = split_lines(tmp_path, 'ordered', common_lines)
+    shuffled_train, shuffled_test = split_lines(tmp_path, 'shuffled', common_lines[::-1])
+
+    assert sorted(train) == sorted(shuffled_train) and sorted(test) == sorted(shuffled_test)
+    assert sorted(train + test) == sorted(common_lines)
+
+
+def test_split_is_seeded(tmp_path, common_lines):
+    assert split_lines(tmp_path, 'first', common_lines, seed=1) == split_lines(tmp_path, 'again', common_lines, seed=1)
+    assert split_lines(tmp_path, 'first', common_lines, seed=1) != split_lines(tmp_path, 'other', common_lines, seed=2)
+
+
+# the hash only looks at the note, so whitespace differences don't move a record to the other side
+def test_split_bucket_ignores_whitespace(common_lines):
+    for line in common_lines:
+        labels, position = fasttext_reader.split_labels(line)
+        respaced = ' '.join(labels) + '  ' + line[position:].strip().replace(' ', '   ') + '\n'
+        assert clean_data.split_bucket(line, .5, 3) == clean_data.split_bucket(respaced, .5, 3)
+
+
+def test_split_fraction():
+    lines = ['__label__a note number ' + str(i) + '\n' for i in range(20000)]
+    test_count = sum(clean_data.split_bucket(line, .1) for line in lines)
+
+    assert abs(test_count / len(lines) - .1) < .01
+
+
+def test_stratified_split_within_label_sets(tmp_path, common_lines):
+    train, test = split_lines(tmp_path, 'stratified', common_lines, test_fraction=.3, stratify=True)
+
+    for label_set, members in label_sets(common_lines).items():
+        test_count = sum(1 for line in test if line_label_set(line) == label_set)
+        assert int(members * .3) <= test_count <= int(members * .3) + 1
+
+    assert sorted(train + test) == sorted(common_lines)
+
+
+def test_stratified_folds_within_label_sets(tmp_path, common_lines):
+    folds = split_lines(tmp_path, 'folds', common_lines, stratify=True, folds=3)
+
+    for label_set in label_sets(common_lines):
+        fold_counts = [sum(1 for line in fold if line_label_set(line) == label_set) for fold in folds]
+        assert max(fold_counts) - min(fold_counts) <= 1
+
+
+def line_label_set(line) -> str:
+    labels, _ = fasttext_reader.split_labels(line)
+    return ' '.join(sorted(set(labels)))
+
+
+# This method will count the lines of each label set
+def label_sets(lines) -> dict:
+    counts = {}
+    for line in lines:
+        counts[line_label_set(line)] = counts.get(line_label_set(line), 0) + 1
+
+    return counts
@@ -0,0 +1,91 @@
+# Tests for the request validation of inference_server.py - bad /predict bodies get a 400 and nothing is queued
+import asyncio
+import functools
+import json
+
+import pytest
+
+import inference_server
+
+
+@pytest.fixture(scope='module')
+def notes(common_lines):
+    return [line.split('__label__')[-1].split(' ', 1)[1] for line in common_lines[:5]]
+
+
+def test_parse_notes_and_text(notes):
+    assert inference_server.parse_predict_request({'notes': notes, 'k': 5}) == (notes, 5)
+    assert inference_server.parse_predict_request({'text': notes[0]}) == ([notes[0]], 3)
+    assert inference_server.parse_predict_request({'text': notes[0], 'k': inference_server.max_k})[1] == \
+        inference_server.max_k
+
+
+@pytest.mark.parametrize('payload', [
+    [],
+    'note',
+    {},
+    {'notes': []},
+    {'notes': 'note'},
+    {'notes': ['note', 3]},
+    {'notes': [None]},
+    {'text': ['note']},
+    {'text': 'note', 'k': 0},
+    {'text': 'note', 'k': -1},
+    {'text': 'note', 'k': 1.5},
+    {'text': 'note', 'k': '3'},
+    {'text': 'note', 'k': True},
+    {'text': 'note', 'k': inference_server.max_k + 1},
+])
+def test_parse_rejects(payload):
+    with pytest.raises(ValueError):
+        inference_server.parse_predict_request(payload)
+
+
+# This method will send one POST /predict to a server with a stub batch worker, which answers every queued note with
+# its own note and k. Returns (status code, response body, number of notes queued)
+async def post_predict(body: bytes) -> tuple:
+    queue = asyncio.Queue()
+    queued = []
+
+    async def answer():
+        while True:
+            note, k, future = await queue.get()
+            queued.append(note)
+            future.set_result({'note': note, 'k': k})
+
+    worker = asyncio.create_task(answer())
+    server = await asyncio.start_server(functools.partial(inference_server.handle_connection, queue), '127.0.0.1', 0)
+    try:
+        reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+        writer.write(b'POST /predict HTTP/1.1\r\nContent-Length: ' + str(len(body)).encode() +
+                     b'\r\nConnection: close\r\n\r\n' + body)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+        worker.cancel()
+
+    head, _, response_body = response.partition(b'\r\n\r\n')
+    return int(head.split(b' ')[1]), json.loads(response_body), len(queued)
+
+
+@pytest.mark.parametrize('body', [
+    b'not json',
+    b'{"notes": [1, 2]}',
+    b'{"notes": ["note"], "k": "all"}',
+    b'{"text": "note", "k": 100000}',
+])
+def test_bad_request_not_queued(body):
+    status, response, queued = asyncio.run(post_predict(body))
+
+    assert status == 400 and response['error'].startswith('bad request')
+    assert queued == 0
+
+
+def test_good_request_queued(notes):
+    status, response, queued = asyncio.run(post_predict(json.dumps({'notes': notes, 'k': 2}).encode()))
+
+    assert status == 200 and queued == len(notes)
+    assert response['predictions'] == [{'note': note, 'k': 2} for note in notes]
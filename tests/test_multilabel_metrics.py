@@ -0,0 +1,72 @@
+# Tests for multilabel_metrics.py, scored on the labels of the synthetic dataset against seeded random probabilities
+import numpy as np
+import pytest
+from sklearn.metrics import precision_recall_fscore_support
+
+import fasttext_reader
+import multilabel_metrics
+
+
+@pytest.fixture(scope='module')
+def scored(common_lines):
+    label_lists = [fasttext_reader.split_labels(line)[0] for line in common_lines]
+    vocabulary = sorted({label for labels in label_lists for label in labels})
+    y_true = multilabel_metrics.label_matrix(label_lists, vocabulary)
+
+    # probabilities that lean towards the true labels, so every threshold has a mix of hits and misses
+    rng = np.random.default_rng(0)
+    probabilities = np.clip(rng.random(y_true.shape) * .7 + y_true * .3, 0, 1).astype(np.float32)
+
+    return y_true, probabilities
+
+
+def test_label_matrix(common_lines):
+    label_lists = [fasttext_reader.split_labels(line)[0] for line in common_lines]
+    vocabulary = sorted({label for labels in label_lists for label in labels})
+    y_true = multilabel_metrics.label_matrix(label_lists, vocabulary[1:])
+
+    assert y_true.shape == (len(label_lists), len(vocabulary) - 1)
+    assert y_true.sum() == sum(1 for labels in label_lists for label in set(labels) if label != vocabulary[0])
+
+
+def test_threshold_metrics_match_sklearn(scored):
+    y_true, probabilities = scored
+    metrics = multilabel_metrics.threshold_metrics(y_true, probabilities, .5)
+    predicted = probabilities >= .5
+
+    precision, recall, f1, support = precision_recall_fscore_support(y_true, predicted, average=None, zero_division=0)
+    np.testing.assert_allclose(metrics['precision'], precision)
+    np.testing.assert_allclose(metrics['recall'], recall)
+    np.testing.assert_allclose(metrics['f1'], f1)
+    np.testing.assert_array_equal(metrics['support'], support)
+
+    for average in ['micro', 'macro']:
+        precision, recall, f1, _ = precision_recall_fscore_support(y_true, predicted, average=average, zero_division=0)
+        assert metrics[average + '_precision'] == pytest.approx(precision)
+        assert metrics[average + '_recall'] == pytest.approx(recall)
+        assert metrics[average + '_f1'] == pytest.approx(f1)
+
+
+# the sweep has to score every threshold exactly the way threshold_metrics does, ties and the 0 / 1 ends included
+def test_threshold_sweep_matches_threshold_metrics(scored):
+    y_true, probabilities = scored
+    probabilities = np.round(probabilities, 1)
+    sweep = multilabel_metrics.threshold_sweep(y_true, probabilities)
+
+    for position, threshold in enumerate(sweep['thresholds']):
+        metrics = multilabel_metrics.threshold_metrics(y_true, probabilities, threshold)
+        assert sweep['micro_f1'][position] == pytest.approx(metrics['micro_f1'])
+        assert sweep['macro_f1'][position] == pytest.approx(metrics['macro_f1'])
+        np.testing.assert_allclose(sweep['precision'][position], metrics['precision'])
+        np.testing.assert_allclose(sweep['recall'][position], metrics['recall'])
+
+
+def test_precision_recall_at_k(scored):
+    y_true, probabilities = scored
+
+    for k in [1, 3]:
+        hits = sum(y_true[row, np.argsort(-probabilities[row], kind='stable')[:k]].sum() for row in range(len(y_true)))
+        precision, recall = multilabel_metrics.precision_recall_at_k(y_true, probabilities, k)
+
+        assert precision == pytest.approx(hits / (len(y_true) * k))
+        assert recall == pytest.approx(hits / y_true.sum())
@@ -0,0 +1,92 @@
+# Tests for the stage skipping of pipeline.py - a stage is skipped when its hash (command, parameters, contents of its
+# inputs) matches its last successful run and its outputs are in place
+import os
+import shutil
+
+import pytest
+
+import pipeline
+
+
+@pytest.fixture
+def stage(workdir):
+    shutil.copy('./data/' + pipeline.noteevents_file, './data/stage_input.csv.gz')
+    with open('./models/stage_output.txt', 'w', encoding='utf8') as f:
+        f.write('output\n')
+
+    yield {
+        'name': 'cleanse',
+        'inputs': ['./data/' + pipeline.diag_file, './data/stage_input.csv.gz'],
+        'outputs': ['./models/stage_output.txt'],
+        'params': {'epochs': 5},
+        'command': ['clean_data.py', '--no-split', '--workers', '4'],
+    }
+
+    os.remove('./data/stage_input.csv.gz')
+
+
+# This method will record a successful run of the stage in a fresh state, the way run_pipeline does
+def ran_state(stage) -> dict:
+    state = {'stages': {}, 'digests': {}}
+    state['stages'][stage['name']] = {'hash': pipeline.stage_hash(stage, state)}
+
+    return state
+
+
+def test_stage_skipped_after_a_run(stage):
+    assert not pipeline.is_up_to_date(stage, {'stages': {}, 'digests': {}})
+    assert pipeline.is_up_to_date(stage, ran_state(stage))
+
+
+def test_core_options_do_not_rerun(stage):
+    state = ran_state(stage)
+    stage['command'] = ['clean_data.py', '--no-split', '--workers', '8', '--threads', '2']
+
+    assert pipeline.is_up_to_date(stage, state)
+
+
+@pytest.mark.parametrize('change', [
+    lambda stage: stage['command'].append('--notes-store'),
+    lambda stage: stage['command'].__setitem__(1, '--split-only'),
+    lambda stage: stage['params'].__setitem__('epochs', 6),
+])
+def test_command_or_params_change_reruns(stage, change):
+    state = ran_state(stage)
+    change(stage)
+
+    assert not pipeline.is_up_to_date(stage, state)
+
+
+def test_input_change_reruns(stage):
+    state = ran_state(stage)
+    with open('./data/stage_input.csv.gz', 'ab') as f:
+        f.write(b'\n')
+
+    assert not pipeline.is_up_to_date(stage, state)
+
+
+# a touched input with the same contents is hashed again, but doesn't rerun the stage
+def test_touched_input_does_not_rerun(stage):
+    state = ran_state(stage)
+    stat = os.stat('./data/stage_input.csv.gz')
+    os.utime('./data/stage_input.csv.gz', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    assert pipeline.is_up_to_date(stage, state)
+    assert state['digests']['./data/stage_input.csv.gz']['mtime_ns'] == stat.st_mtime_ns + 10 ** 9
+
+
+def test_missing_output_reruns(stage):
+    state = ran_state(stage)
+    os.remove('./models/stage_output.txt')
+
+    assert not pipeline.is_up_to_date(stage, state)
+
+
+def test_module_closure_follows_imports(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'script.py').write_text('import os\nimport first\n')
+    (tmp_path / 'first.py').write_text('def load():\n    from second import value\n    return value\n')
+    (tmp_path / 'second.py').write_text('import first\nvalue = 1\n')
+    (tmp_path / 'unused.py').write_text('value = 2\n')
+
+    assert pipeline.module_closure('script.py') == ['first.py', 'script.py', 'second.py']
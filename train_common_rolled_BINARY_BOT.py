@@ -1,7 +1,13 @@
 # This will train the bot
+import argparse
+import json
 import logging
 import fasttext
 
+from compress_bot import compress_model
+from instrumentation import RunMetrics, file_bytes, line_count
+from warm_start_bot import record_trained_input, warm_start_params
+
 # Set Logging -- basic configuration
 
 logging.basicConfig(format='%(asctime)s -- %(levelname)s: %(message)s',
@@ -9,13 +15,67 @@ logging.basicConfig(format='%(asctime)s -- %(levelname)s: %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
 my_logger = logging.getLogger('classifier_project')
 
+parser = argparse.ArgumentParser(description='Train the rolled common BINARY BOT model')
+parser.add_argument('--compress', action='store_true',
+                    help='also build a compressed (quantized) model, and report it against the full model')
+parser.add_argument('--cutoff', type=int, default=100000, help='words / ngrams kept by the compressed model')
+parser.add_argument('--dsub', type=int, default=2, help='product quantization sub vector size')
+parser.add_argument('--no-qnorm', action='store_true', help="don't quantize the vector norms separately")
+parser.add_argument('--no-retrain', action='store_true', help="don't fine tune the embeddings after the cutoff")
+parser.add_argument('--compressed-dim', type=int, default=None,
+                    help='train the model to compress with this many dims, instead of compressing the full model')
+parser.add_argument('--compress-report', default=None, help='also write the compression report to this json file')
+parser.add_argument('--warm-start', action='store_true',
+                    help='start from the word vectors of the saved model, e.g. after clean_data.py --incremental')
+parser.add_argument('--warm-start-epochs', type=int, default=5, help='training epochs for a warm start')
+parser.add_argument('--replay-lines', type=int, default=10000,
+                    help='older training lines replayed next to the new ones in a warm start')
+parser.add_argument('--threads', type=int, default=None, help='fastText training threads (default: fastText default)')
+parser.add_argument('--metrics-dir', default='./metrics',
+                    help='directory the per stage metrics (json per run, csv across runs) are written to')
+parser.add_argument('--profile', nargs='+', default=[],
+                    help="run these stages under cProfile ('all' for every stage): train, test, compress")
+args = parser.parse_args()
+
+train_params = dict(dim=300, epoch=50, lr=.1, minCount=5, loss='ns')
+if args.threads is not None:
+    train_params['thread'] = args.threads
+run_metrics = RunMetrics('train_common_rolled_BINARY_BOT', args.metrics_dir, args.profile)
+
 # Train the regular model - BOT
 my_logger.info("Training the rolled common BINARY BOT model ...")
-model = fasttext.train_supervised(input="./cleansed_data/rolled_common_input.train", dim=300, epoch=50, lr=.1, minCount=5, loss='ns')
+fit_params, fit_input = train_params, "./cleansed_data/rolled_common_input.train"
+if args.warm_start:
+    fit_params, fit_input = warm_start_params("./models/model_rolled_common_BINARY_BOT.bin",
+                                              "./cleansed_data/rolled_common_input.train", train_params,
+                                              args.warm_start_epochs, args.replay_lines)
+
+# rows are lines x epochs, the lines fastText goes through
+with run_metrics.stage('train', rows=line_count(fit_input) * fit_params['epoch'],
+                       bytes_read=file_bytes(fit_input)) as record:
+    model = fasttext.train_supervised(input=fit_input, **fit_params)
 
-my_logger.info("Model saved into ./models/model_rolled_common_BINARY_BOT.bin")
-model.save_model("./models/model_rolled_common_BINARY_BOT.bin")
+    my_logger.info("Model saved into ./models/model_rolled_common_BINARY_BOT.bin")
+    model.save_model("./models/model_rolled_common_BINARY_BOT.bin")
+    record_trained_input("./models/model_rolled_common_BINARY_BOT.bin", "./cleansed_data/rolled_common_input.train")
+    record['bytes_written'] = file_bytes("./models/model_rolled_common_BINARY_BOT.bin")
 
 my_logger.info("Model Testing Results - BINARY BOT Rolled Common Codes:")
-result = model.test("./cleansed_data/rolled_common_input.test")
-my_logger.info(result)
\ No newline at end of file
+with run_metrics.stage('test', bytes_read=file_bytes("./cleansed_data/rolled_common_input.test")) as record:
+    result = model.test("./cleansed_data/rolled_common_input.test")
+    record['rows'] = result[0]
+my_logger.info(result)
+
+if args.compress:
+    with run_metrics.stage('compress') as record:
+        compress_report = compress_model("./models/model_rolled_common_BINARY_BOT.bin", "./models/model_rolled_common_BINARY_BOT.ftz",
+                                         "./cleansed_data/rolled_common_input.train", "./cleansed_data/rolled_common_input.test",
+                                         train_params, cutoff=args.cutoff, dsub=args.dsub, qnorm=not args.no_qnorm,
+                                         retrain=not args.no_retrain, compressed_dim=args.compressed_dim)
+        record['bytes_written'] = file_bytes("./models/model_rolled_common_BINARY_BOT.ftz")
+
+    if args.compress_report is not None:
+        with open(args.compress_report, 'w') as f:
+            json.dump(compress_report, f, indent=2)
+
+run_metrics.write()
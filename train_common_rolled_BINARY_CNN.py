@@ -1,10 +1,16 @@
 import numpy as np  # linear algebra
 import pandas as pd  # data processing, CSV file I/O (e.g. pd.read_csv)
 import logging
+import json
+import argparse
+import functools
+import subprocess
+import sys
+import tempfile
+import time
 
 from tensorflow import keras
 from sklearn.model_selection import train_test_split
-from ast import literal_eval
 
 import tensorflow as tf
 from keras.models import Sequential
@@ -13,8 +19,18 @@ from keras import metrics
 
 import os
 
+import fasttext_reader
+import notes_store
+import vectorized_cache
+from clean_data import file_digest
+from instrumentation import RunMetrics, file_bytes, peak_rss_mb
+
 # This script will  a multilabel classification task with a keras implementation of a CNN
 # We will be using the rolled common input as this will restrict labeling to 10 labels at most.
+# Two models can be trained:
+#   mlp -> the bag of n-grams model, tf-idf features into two dense layers (input width grows with the vocabulary)
+#   conv -> a Conv1D over token id sequences of at most max_seqlen tokens, with its embeddings initialised from a
+#           trained fastText BOT model. Batches are bucketed by note length, so they carry little padding
 
 # Set Logging -- basic configuration
 logging.basicConfig(format='%(asctime)s -- %(levelname)s: %(message)s',
@@ -22,69 +38,89 @@ logging.basicConfig(format='%(asctime)s -- %(levelname)s: %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
 my_logger = logging.getLogger('classifier_project')
 
+parser = argparse.ArgumentParser(description='Train the rolled common multi label Keras model')
+parser.add_argument('--model', choices=['mlp', 'conv'], default='mlp',
+                    help='bag of n-grams tf-idf model, or sequence CNN over token ids')
+parser.add_argument('--pretrained', default='./models/model_rolled_common_MULTI_BOT.bin',
+                    help='fastText model the conv embeddings are initialised from, random if it does not exist')
+parser.add_argument('--input-mode', choices=['sparse', 'dense'], default='sparse',
+                    help='keep the tf-idf features sparse all the way into the first layer, or densify every batch')
+parser.add_argument('--max-features', type=int, default=None,
+                    help='only keep the top K (most frequent) tf-idf features, default is the full vocabulary')
+parser.add_argument('--epochs', type=int, default=20, help='number of training epochs')
+parser.add_argument('--seed', type=int, default=0,
+                    help='seed of the train / validation / test split and the batch shuffling - every model trained '
+                         'with the same seed is scored on the same rows')
+parser.add_argument('--benchmark', action='store_true',
+                    help='train the dense and sparse input paths, each in its own process, and compare them')
+parser.add_argument('--compare-models', action='store_true',
+                    help='train the mlp and conv models, each in its own process, and compare them')
+parser.add_argument('--rebuild-cache', action='store_true',
+                    help='ignore the vectorized dataset cache, and vectorize the notes again')
+parser.add_argument('--report', default=None,
+                    help='write epoch times, peak memory, precision and recall to this json file')
+parser.add_argument('--threads', type=int, default=None,
+                    help='TensorFlow intra op threads (default: all cores)')
+parser.add_argument('--metrics-dir', default='./metrics',
+                    help='directory the per stage metrics (json per run, csv across runs) are written to')
+parser.add_argument('--profile', nargs='+', default=[],
+                    help="run these stages under cProfile ('all' for every stage): vectorize, train, evaluate, save")
+args = parser.parse_args()
+
+if args.threads is not None:
+    tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+    tf.config.threading.set_inter_op_parallelism_threads(min(args.threads, 2))
+
+# Benchmark mode - run this script once per input mode (or model), so each one gets its own peak memory, and compare
+# the reports
+if args.benchmark or args.compare_models:
+    if args.compare_models:
+        benchmark_runs = {"mlp": ["--model", "mlp", "--input-mode", args.input_mode], "conv": ["--model", "conv"]}
+    else:
+        benchmark_runs = {input_mode: ["--input-mode", input_mode] for input_mode in ["dense", "sparse"]}
+
+    benchmark_reports = {}
+    with tempfile.TemporaryDirectory() as report_dir:
+        for run_name, run_args in benchmark_runs.items():
+            my_logger.info("Benchmarking the " + run_name + " run ...")
+            report_file = os.path.join(report_dir, run_name + ".json")
+            command = [sys.executable, __file__, "--epochs", str(args.epochs), "--pretrained", args.pretrained,
+                       "--seed", str(args.seed), "--report", report_file] + run_args
+            if args.max_features is not None:
+                command = command + ["--max-features", str(args.max_features)]
+            if args.threads is not None:
+                command = command + ["--threads", str(args.threads)]
+            subprocess.run(command, check=True)
+
+            with open(report_file, "r") as f:
+                benchmark_reports[run_name] = json.load(f)
+
+    my_logger.info("Benchmark results (" + str(args.epochs) + " epochs):")
+    for run_name, benchmark_report in benchmark_reports.items():
+        my_logger.info(f"  {run_name:>6}: {benchmark_report['features']} features, "
+                       f"{benchmark_report['parameters']} parameters, "
+                       f"{benchmark_report['mean_epoch_seconds']:.1f}s per epoch, "
+                       f"peak RSS {benchmark_report['peak_rss_mb']}MB, precision {benchmark_report['precision']:.4f}, "
+                       f"recall {benchmark_report['recall']:.4f}")
+
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump(benchmark_reports, f, indent=2)
+    sys.exit(0)
+
 # Define the file path to be using
 input_file = "./cleansed_data/rolled_common_input.txt"
-
-# create DF list
-df_list = []
-
-my_logger.info("Reading input file into memory ... ")
-
-# Read the file into memory
-with open("./cleansed_data/rolled_common_input.txt", "r") as f:
-    # Python 3.10 and up
-    while line := f.readline():
-        labels = []
-        note = ''
-        for item in line.rstrip('\n').split(' '):
-            # not found
-            if item.find('__label__') == -1:
-                note = note + str(item) + ' '
-            else:
-                labels.append(str(item))
-
-        labels.sort()
-        df_list.append([str(labels), note])
-
-# Convert input to dataframe
-mimic_data = pd.DataFrame(df_list, columns=['labels', 'notes'])
-
-my_logger.info(f"Input file loaded ... There are {len(mimic_data)} rows in the cleansed dataset.")
-
-# Remove the lowest occurrence classes for stratification
-# There are some terms with occurrence as low as 1.
-my_logger.info("    Labels with an occurrence of only one: " + str(sum(mimic_data["labels"].value_counts() == 1)))
-
-# Filter out the low occurrence classes
-mimic_data_filtered = mimic_data.groupby("labels").filter(lambda x: len(x) > 1)
-
-# Convert Label literals to lists
-mimic_data_filtered["labels"] = mimic_data_filtered["labels"].apply(lambda x: literal_eval(x))
-
-# Create a Stratified test split
-# Initial train and test split. hold back 10% for test per paper
-train_df, test_df = train_test_split(mimic_data_filtered, test_size=.2, stratify=mimic_data_filtered["labels"].values)
-# further filtering
-val_df = test_df.sample(frac=0.5)
-test_df.drop(val_df.index, inplace=True)
-
-my_logger.info("Validation sets created ...")
-my_logger.info(f"   Number of rows in training set: {len(train_df)}")
-my_logger.info(f"   Number of rows in validation set: {len(val_df)}")
-my_logger.info(f"   Number of rows in test set: {len(test_df)}")
-
-# Preprocess the labels - using multi-label binarization
-labels = tf.ragged.constant(train_df["labels"].values)
-# lookup type, create lookup
-lookup = tf.keras.layers.StringLookup(output_mode="multi_hot")
-lookup.adapt(labels)
-vocab = lookup.get_vocabulary()
-
-# list labels, debug only
-# my_logger.info(vocab)
-# get stats, debug only -- need this for sizing of our params, we set max seq length to the 50% per keras tutorial
-my_logger.info("Cleanse dataset statistics for word tokens ...")
-my_logger.info(train_df["notes"].apply(lambda x: len(x.split(" "))).describe())
+cnn_cache_filepath = "./cleansed_data/cnn_cache/"
+
+# clean_data.py --notes-store doesn't write the full text file, the rows are streamed straight out of the notes store
+# then. input_files are the files the rows come from, for the cache key and the metrics
+if not os.path.isfile(input_file) and notes_store.store_exists("./cleansed_data"):
+    input_source = functools.partial(notes_store.iter_variant_lines, "./cleansed_data", "rolled_common_input")
+    input_files = ["./cleansed_data/" + notes_store.notes_filename,
+                   "./cleansed_data/rolled_common_input" + notes_store.labels_suffix]
+else:
+    input_source = input_file
+    input_files = [input_file]
 
 max_seqlen = 1750
 batch_size = 32  # per report
@@ -92,86 +128,306 @@ padding_token = "<pad>"
 auto = tf.data.AUTOTUNE
 
 
-# helper functions for making a dataset for trainer
-def make_dataset(dataframe, is_train=True):
-    labels = tf.ragged.constant(dataframe["labels"].values)
-    labels_binarized = lookup(labels).numpy()
-    dataset = tf.data.Dataset.from_tensor_slices(
-        (dataframe["notes"].values, labels_binarized)
-    )
-    dataset = dataset.shuffle(batch_size * 10) if is_train else dataset
-    return dataset.batch(batch_size)
+# This method will read the input file, split it, fit the label lookup and the text vectorizer, and write the
+# vectorized splits into cache_dir - only needed when the cache is missing, or stale
+def build_vectorized_cache(cache_dir, cache_settings):
+    my_logger.info("Reading the labels of the input file ... ")
+
+    # Only the labels are read into memory, the note texts are streamed off of the file whenever they're needed
+    label_records, label_index = fasttext_reader.read_labels(input_source)
+    label_sets = pd.Series([str(sorted(ids.tolist())) for ids in label_records])
+
+    my_logger.info(f"Input file scanned ... There are {len(label_records)} rows in the cleansed dataset.")
+
+    # Remove the lowest occurrence classes for stratification
+    # There are some terms with occurrence as low as 1.
+    label_set_counts = label_sets.value_counts()
+    my_logger.info("    Labels with an occurrence of only one: " + str(sum(label_set_counts == 1)))
+
+    # Filter out the low occurrence classes
+    kept_rows = np.flatnonzero(label_sets.map(label_set_counts).values > 1)
+
+    # Create a Stratified test split
+    # Initial train and test split. hold back 10% for test per paper
+    # Seeded, so the mlp and conv caches of the same input hold the same rows in each split
+    train_rows, test_rows = train_test_split(kept_rows, test_size=.2, stratify=label_sets.values[kept_rows],
+                                             random_state=args.seed)
+    # further filtering
+    val_rows = np.random.default_rng(args.seed).permutation(test_rows)[:round(len(test_rows) * .5)]
+    test_rows = np.setdiff1d(test_rows, val_rows)
+
+    # the records are streamed in file order, so each split's rows are kept sorted
+    split_rows = [np.sort(train_rows), np.sort(val_rows), test_rows]
+    split_masks = [np.isin(np.arange(len(label_records)), rows) for rows in split_rows]
+
+    my_logger.info("Validation sets created ...")
+    my_logger.info(f"   Number of rows in training set: {len(train_rows)}")
+    my_logger.info(f"   Number of rows in validation set: {len(val_rows)}")
+    my_logger.info(f"   Number of rows in test set: {len(test_rows)}")
+
+    # Preprocess the labels - using multi-label binarization
+    # Same columns as a StringLookup adapted on the training labels: [UNK] first, then the labels by frequency
+    labels_by_id = list(label_index)
+    label_counts = np.bincount(np.concatenate([label_records[row] for row in train_rows]), minlength=len(labels_by_id))
+    train_label_ids = sorted(np.flatnonzero(label_counts), key=lambda label_id: (-label_counts[label_id],
+                                                                                 labels_by_id[label_id]))
+    vocab = ["[UNK]"] + [labels_by_id[label_id] for label_id in train_label_ids]
+    label_columns = np.zeros(len(labels_by_id), dtype=np.int64)
+    label_columns[train_label_ids] = np.arange(1, len(vocab))
+
+    # list labels, debug only
+    # my_logger.info(vocab)
+    # get stats, debug only -- need this for sizing of our params, we set max seq length to the 50% per keras tutorial
+    # Source: https://stackoverflow.com/a/18937309/7636462
+    vocabulary = set()
+    token_counts = []
+    for _, note in fasttext_reader.iter_records(input_source, rows=split_masks[0]):
+        tokens = note.lower().split()
+        token_counts.append(len(tokens))
+        vocabulary.update(tokens)
+
+    my_logger.info("Cleanse dataset statistics for word tokens ...")
+    my_logger.info(pd.Series(token_counts).describe())
+
+    vocabulary_size = len(vocabulary)
+    my_logger.info("Vocabulary size: " + str(vocabulary_size))
+
+    # Vectorize the notes information
+    # The vectorizer always outputs SparseTensor batches here, only the non zero tf-idf values are written to the cache
+    # For the conv model every note becomes its token ids, cut at max_seqlen - the padding of each batch is dropped
+    max_features = args.max_features or vocabulary_size
+    my_logger.info("Vectorizing the notes ... (" + cache_settings["output_mode"] + ", " + str(max_features) +
+                   " max features)")
+    if args.model == "conv":
+        text_vectorizer = layers.TextVectorization(max_tokens=max_features, output_mode="int")
+
+        def vectorize_sequences(notes):
+            return tf.sparse.from_dense(text_vectorizer(notes)[:, :max_seqlen])
+
+        vectorize = vectorize_sequences
+    else:
+        text_vectorizer = layers.TextVectorization(max_tokens=max_features, ngrams=2, output_mode="tf_idf",
+                                                   sparse=True)
+        vectorize = text_vectorizer
+
+    # `TextVectorization` layer needs to be adapted as per the vocabulary from our
+    # training set.
+    with tf.device("/CPU:0"):
+        text_vectorizer.adapt(fasttext_reader.text_dataset(input_source, rows=split_masks[0]).batch(batch_size))
+
+    # Vectorize every split once, and write the tf-idf rows and the multi hot labels to the cache
+    for split, rows, mask in zip(vectorized_cache.splits, split_rows, split_masks):
+        notes_dataset = fasttext_reader.text_dataset(input_source, rows=mask).batch(batch_size).map(
+            vectorize, num_parallel_calls=auto)
+        sparse_batches = ((batch.indices[:, 0].numpy(), batch.indices[:, 1].numpy(), batch.values.numpy(),
+                           int(batch.dense_shape[0])) for batch in notes_dataset)
+        split_labels = fasttext_reader.multi_hot([label_records[row] for row in rows], len(vocab), label_columns)
+        vectorized_cache.write_split(cache_dir, split, sparse_batches, split_labels,
+                                     np.int32 if args.model == "conv" else np.float32)
+
+    idf_weights = text_vectorizer.get_weights()[0] if args.model == "mlp" else None
+    vectorized_cache.write_metadata(cache_dir, text_vectorizer.get_vocabulary(), idf_weights, vocab, cache_settings)
+
+    my_logger.info("Vectorizing the notes COMPLETE ... cached into " + cache_dir)
+
+
+# The vectorized splits are cached, keyed by the input file and the vectorizer settings - repeated runs skip the text
+# processing entirely, and stream the tf-idf rows straight from the memory mapped cache files
+if args.model == "conv":
+    cache_settings = {"max_features": args.max_features, "output_mode": "int", "max_seqlen": max_seqlen,
+                      "seed": args.seed}
+else:
+    cache_settings = {"max_features": args.max_features, "ngrams": 2, "output_mode": "tf_idf", "seed": args.seed}
+input_digest = ''.join(file_digest(filepath) for filepath in input_files)
+cache_dir = os.path.join(cnn_cache_filepath, vectorized_cache.cache_key(input_digest, **cache_settings))
+run_metrics = RunMetrics("train_common_rolled_BINARY_CNN_" + args.model, args.metrics_dir, args.profile)
+if args.rebuild_cache or not vectorized_cache.cache_exists(cache_dir):
+    with run_metrics.stage("vectorize", bytes_read=file_bytes(*input_files)) as record:
+        build_vectorized_cache(cache_dir, cache_settings)
+        record["bytes_written"] = file_bytes(*[entry.path for entry in os.scandir(cache_dir)])
+else:
+    my_logger.info("Vectorized notes loaded from cache -- " + cache_dir)
+
+cache_metadata, idf_weights = vectorized_cache.load_metadata(cache_dir)
+vocab = cache_metadata["label_vocabulary"]
+
+# The vectorizer is rebuilt from the cached vocabulary / idf weights, it's only needed for the saved inference model
+# In sparse mode it outputs SparseTensor batches, which the first Dense layer multiplies directly - the batch x
+# vocabulary tf-idf matrix is never densified. The conv model cuts the notes at max_seqlen tokens like it was trained on,
+# shorter notes are padded out to it
+if args.model == "conv":
+    text_vectorizer = layers.TextVectorization(output_mode="int", output_sequence_length=max_seqlen,
+                                               vocabulary=cache_metadata["vocabulary"])
+else:
+    text_vectorizer = layers.TextVectorization(ngrams=2, output_mode="tf_idf", vocabulary=cache_metadata["vocabulary"],
+                                               idf_weights=idf_weights, sparse=args.input_mode == "sparse")
+feature_count = len(cache_metadata["vocabulary"])
+
+
+# This method will stream one cached split as (tf-idf batch, multi hot labels) batches
+# The training split is reshuffled every epoch. In dense mode every batch is densified before it reaches the model
+def make_cached_dataset(split, is_train=True):
+    split_arrays = vectorized_cache.load_split(cache_dir, split)
+    rng = np.random.default_rng(args.seed)
+
+    def generate():
+        for row_lengths, indices, data, labels in vectorized_cache.iter_batches(split_arrays, batch_size,
+                                                                              shuffle=is_train, rng=rng):
+            rows = np.repeat(np.arange(len(row_lengths)), row_lengths)
+            yield (np.stack([rows, indices], axis=1).astype(np.int64), data, len(row_lengths)), labels
+
+    dataset = tf.data.Dataset.from_generator(generate, output_signature=(
+        (tf.TensorSpec(shape=(None, 2), dtype=tf.int64), tf.TensorSpec(shape=(None,), dtype=tf.float32),
+         tf.TensorSpec(shape=(), dtype=tf.int64)),
+        tf.TensorSpec(shape=(None, len(vocab)), dtype=tf.float32)))
+
+    def to_features(coordinates, labels):
+        indices, values, row_count = coordinates
+        features = tf.SparseTensor(indices, values, tf.stack([row_count, feature_count]))
+        return (features if args.input_mode == "sparse" else tf.sparse.to_dense(features)), labels
+
+    return dataset.map(to_features, num_parallel_calls=auto).prefetch(auto)
+
+
+# This method will stream one cached split of token id sequences as (padded token ids, multi hot labels) batches
+# Batches are bucketed by note length, and only padded out to their longest note
+def make_sequence_dataset(split, is_train=True):
+    split_arrays = vectorized_cache.load_split(cache_dir, split)
+    rng = np.random.default_rng(args.seed)
+
+    def generate():
+        for row_lengths, positions, token_ids, labels in vectorized_cache.iter_bucketed_batches(
+                split_arrays, batch_size, shuffle=is_train, rng=rng):
+            sequences = np.zeros((len(row_lengths), max(int(row_lengths.max()), 1)), dtype=np.int32)
+            sequences[np.repeat(np.arange(len(row_lengths)), row_lengths), positions] = token_ids
+            yield sequences, labels
+
+    dataset = tf.data.Dataset.from_generator(generate, output_signature=(
+        tf.TensorSpec(shape=(None, None), dtype=tf.int32), tf.TensorSpec(shape=(None, len(vocab)), dtype=tf.float32)))
+
+    return dataset.prefetch(auto)
+
+
+make_dataset = make_sequence_dataset if args.model == "conv" else make_cached_dataset
+
+train_dataset = make_dataset("train", is_train=True)
+validation_dataset = make_dataset("validation", is_train=False)
+test_dataset = make_dataset("test", is_train=False)
 
 
-# Taken from KERAS tutorial
-# reverses single multi-hot encoded label to a tuple of vocab terms
-def invert_multi_hot(encoded_labels):
-    hot_indices = np.argwhere(encoded_labels == 1.0)[..., 0]
-    return np.take(vocab, hot_indices)
+# Define the model
+
+def make_model():
+    model_cnn_multi = keras.Sequential(
+        [
+            keras.Input(shape=(feature_count,), sparse=args.input_mode == "sparse"),
+            layers.Dense(512, activation="relu"),
+            layers.Dense(256, activation="relu"),
+            layers.Dense(len(vocab), activation="sigmoid"),
+        ]  # More on why "sigmoid" has been used here in a moment.
+    )
+    return model_cnn_multi
 
 
-# per keras tutorial
-train_dataset = make_dataset(train_df, is_train=True)
-validation_dataset = make_dataset(val_df, is_train=False)
-test_dataset = make_dataset(test_df, is_train=False)
+# This method will return the embedding matrix of the vectorizer vocabulary out of a trained fastText model, None
+# (random initialisation) if the model doesn't exist. The padding row is zeroed
+def pretrained_embeddings(vocabulary: list, pretrained_filepath):
+    if not os.path.isfile(pretrained_filepath):
+        my_logger.warning("fastText model " + pretrained_filepath +
+                          " not found, the embeddings are randomly initialised")
+        return None
 
-# preview - DEBUG ONLY
-"""
-text_batch, label_batch = next(iter(train_dataset))
+    # only the conv model needs fastText, the mlp runs don't import it
+    import fasttext
 
-for i, text in enumerate(text_batch[:1]):
-    label = label_batch[i].numpy()[None, ...]
-    my_logger.info(f"Abstract: {text}")
-    my_logger.info(f"Label(s): {invert_multi_hot(label[0])}")
-"""
+    my_logger.info("Initialising the embeddings from " + pretrained_filepath + " ...")
+    fasttext_model = fasttext.load_model(pretrained_filepath)
+    embeddings = np.stack([fasttext_model.get_word_vector(term) for term in vocabulary])
+    embeddings[0] = 0.0
 
-# Source: https://stackoverflow.com/a/18937309/7636462
-vocabulary = set()
-train_df["notes"].str.lower().str.split().apply(vocabulary.update)
-vocabulary_size = len(vocabulary)
-my_logger.info("Vocabulary size: " + str(vocabulary_size))
+    return embeddings
 
-# Vectorize the notes information
-my_logger.info("Vectorizing the notes ...")
-text_vectorizer = layers.TextVectorization(max_tokens=vocabulary_size, ngrams=2, output_mode="tf_idf")
 
-# `TextVectorization` layer needs to be adapted as per the vocabulary from our
-# training set.
-with tf.device("/CPU:0"):
-    text_vectorizer.adapt(train_dataset.map(lambda text, label: text))
+# Sequence model - the embedding and convolution sizes don't depend on the note length, and only the embedding depends
+# on the vocabulary
+def make_sequence_model(embeddings=None, embedding_dim=300):
+    embedding_dim = embeddings.shape[1] if embeddings is not None else embedding_dim
+    model_cnn_sequence = keras.Sequential(
+        [
+            keras.Input(shape=(None,), dtype="int32"),
+            layers.Embedding(feature_count, embedding_dim),
+            layers.Conv1D(256, 5, activation="relu", padding="same"),
+            layers.GlobalMaxPooling1D(),
+            layers.Dense(256, activation="relu"),
+            layers.Dense(len(vocab), activation="sigmoid"),
+        ]
+    )
+    if embeddings is not None:
+        model_cnn_sequence.layers[0].set_weights([embeddings])
 
-train_dataset = train_dataset.map(lambda text, label: (text_vectorizer(text), label), num_parallel_calls=auto).prefetch(
-    auto)
-validation_dataset = validation_dataset.map(lambda text, label: (text_vectorizer(text), label),
-                                            num_parallel_calls=auto).prefetch(auto)
-test_dataset = test_dataset.map(lambda text, label: (text_vectorizer(text), label), num_parallel_calls=auto).prefetch(
-    auto)
+    return model_cnn_sequence
 
-my_logger.info("Vectorizing the notes COMPLETE ...")
 
+# Records the wall time of every epoch, for the benchmark report
+class EpochTimer(keras.callbacks.Callback):
+    def on_train_begin(self, logs=None):
+        self.epoch_seconds = []
 
-# Define the model
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.perf_counter()
 
-def make_model():
-    model_cnn_multi = keras.Sequential(
-        [
-            layers.Dense(512, activation="relu"),
-            layers.Dense(256, activation="relu"),
-            layers.Dense(lookup.vocabulary_size(), activation="sigmoid"),
-        ]  # More on why "sigmoid" has been used here in a moment.
-    )
-    return model_cnn_multi
+    def on_epoch_end(self, epoch, logs=None):
+        self.epoch_seconds.append(time.perf_counter() - self.epoch_start)
 
 
 # Train the model
-epochs = 20
+epochs = args.epochs
+epoch_timer = EpochTimer()
 
-model = make_model()
+if args.model == "conv":
+    model = make_sequence_model(pretrained_embeddings(cache_metadata["vocabulary"], args.pretrained))
+else:
+    model = make_model()
 model.compile(loss="binary_crossentropy", optimizer="adam", metrics=[metrics.Precision(), metrics.Recall()])
-# history if i want to plot
-history = model.fit(train_dataset, validation_data=validation_dataset, epochs=epochs)
+# rows are the training notes x epochs, the validation passes are counted in the time but not the rows
+train_rows = len(vectorized_cache.load_split(cache_dir, "train")["labels"])
+with run_metrics.stage("train", rows=train_rows * epochs):
+    # history if i want to plot
+    history = model.fit(train_dataset, validation_data=validation_dataset, epochs=epochs, callbacks=[epoch_timer])
 
 # Evaluate the model -- 20 epochs, prec: .701906 recall: .609022
-_, precision, recall = model.evaluate(test_dataset)
+with run_metrics.stage("evaluate", rows=len(vectorized_cache.load_split(cache_dir, "test")["labels"])):
+    _, precision, recall = model.evaluate(test_dataset)
 my_logger.info("Precision: " + str(precision))
 my_logger.info("Recall: " + str(recall))
+my_logger.info("Mean epoch time: " + str(round(float(np.mean(epoch_timer.epoch_seconds)), 2)) + "s, peak RSS: " +
+               str(peak_rss_mb()) + "MB")
+
+if args.report is not None:
+    with open(args.report, "w") as f:
+        json.dump({
+            "model": args.model,
+            "input_mode": args.input_mode,
+            "features": feature_count,
+            "parameters": int(model.count_params()),
+            "epochs": epochs,
+            "epoch_seconds": [round(seconds, 3) for seconds in epoch_timer.epoch_seconds],
+            "mean_epoch_seconds": float(np.mean(epoch_timer.epoch_seconds)),
+            "peak_rss_mb": round(peak_rss_mb(), 1) if peak_rss_mb() is not None else None,
+            "precision": float(precision),
+            "recall": float(recall),
+        }, f, indent=2)
+
+# Save the model for inference, with the text vectorizer in front of it so it takes the cleansed note text directly
+# The label vocabulary (index of each output) is saved next to it. The conv model is saved under its own name, and its
+# vectorizer cuts the notes at max_seqlen tokens
+model_filepath = "./models/model_rolled_common_" + ("SEQ_CNN" if args.model == "conv" else "CNN")
+with run_metrics.stage("save") as record:
+    inference_model = keras.Sequential([keras.Input(shape=(1,), dtype="string"), text_vectorizer, model])
+    inference_model.save(model_filepath + ".keras")
+    with open(model_filepath + "_labels.json", "w") as f:
+        json.dump(vocab, f)
+    record["bytes_written"] = file_bytes(model_filepath + ".keras", model_filepath + "_labels.json")
+
+my_logger.info("Model saved into " + model_filepath + ".keras")
+run_metrics.write()
@@ -0,0 +1,123 @@
+# This module holds the on disk cache of the vectorized CNN dataset
+# The fitted vocabulary / idf weights and the tf-idf rows of the train / validation / test splits are written once, and
+# every later run streams them straight from disk. Each split is stored as memory mappable numpy arrays:
+#   <split>_indptr.npy, <split>_indices.npy, <split>_data.npy -> the tf-idf rows, CSR layout (row i is
+#                                                               indices / data[indptr[i]:indptr[i + 1]])
+#   <split>_labels.npy -> (notes x labels) multi hot labels
+# Token id sequences (for the sequence CNN) use the same layout - the columns are the token positions and the data the
+# token ids, so every row is one note's (truncated) sequence
+# idf_weights.npy holds the idf of every vocabulary term (tf-idf only), metadata.json the vocabularies and the settings.
+# metadata.json is written last, so a cache directory without it is an unfinished build and is ignored
+import hashlib
+import json
+import os
+
+import numpy as np
+
+cache_version = 1
+
+splits = ['train', 'validation', 'test']
+
+
+# This method will build the cache key from the digest of the input file and the vectorizer settings
+def cache_key(input_digest, **settings) -> str:
+    return hashlib.sha256((input_digest + json.dumps(settings, sort_keys=True) + str(cache_version)).encode()
+                          ).hexdigest()[:16]
+
+
+# This method will check whether a finished cache exists in cache_dir
+def cache_exists(cache_dir) -> bool:
+    return os.path.isfile(os.path.join(cache_dir, 'metadata.json'))
+
+
+# This method will write the rows of one split
+# sparse_batches -> iterable of (rows, columns, values, row_count) per batch, the coordinates of a batch's non zero
+#                   values in row major order (the order a SparseTensor keeps them in)
+def write_split(cache_dir, split, sparse_batches, labels: np.ndarray, dtype=np.float32) -> None:
+    os.makedirs(cache_dir, exist_ok=True)
+    row_lengths = []
+    indices = []
+    data = []
+    for rows, columns, values, row_count in sparse_batches:
+        row_lengths.append(np.bincount(rows, minlength=row_count))
+        indices.append(np.asarray(columns, dtype=np.int32))
+        data.append(np.asarray(values, dtype=dtype))
+
+    row_lengths = np.concatenate(row_lengths) if row_lengths else np.zeros(0, dtype=np.int64)
+    indptr = np.concatenate([[0], np.cumsum(row_lengths)]).astype(np.int64)
+    np.save(os.path.join(cache_dir, split + '_indptr.npy'), indptr)
+    np.save(os.path.join(cache_dir, split + '_indices.npy'),
+            np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32))
+    np.save(os.path.join(cache_dir, split + '_data.npy'),
+            np.concatenate(data) if data else np.zeros(0, dtype=dtype))
+    np.save(os.path.join(cache_dir, split + '_labels.npy'), np.asarray(labels, dtype=np.float32))
+
+
+# This method will write the idf weights (None for token id sequences) and the metadata, which marks the cache as
+# finished
+def write_metadata(cache_dir, vocabulary: list, idf_weights, label_vocabulary: list, settings: dict) -> None:
+    os.makedirs(cache_dir, exist_ok=True)
+    if idf_weights is not None:
+        np.save(os.path.join(cache_dir, 'idf_weights.npy'), np.asarray(idf_weights, dtype=np.float32))
+
+    with open(os.path.join(cache_dir, 'metadata.json.tmp'), 'w', encoding='utf8') as f:
+        json.dump({'version': cache_version, 'settings': settings, 'vocabulary': vocabulary,
+                   'label_vocabulary': label_vocabulary}, f)
+    os.replace(os.path.join(cache_dir, 'metadata.json.tmp'), os.path.join(cache_dir, 'metadata.json'))
+
+
+# This method will load the metadata and the idf weights, None if there are none
+def load_metadata(cache_dir):
+    with open(os.path.join(cache_dir, 'metadata.json'), 'r', encoding='utf8') as f:
+        metadata = json.load(f)
+
+    idf_filepath = os.path.join(cache_dir, 'idf_weights.npy')
+    return metadata, np.load(idf_filepath) if os.path.isfile(idf_filepath) else None
+
+
+# This method will open the arrays of one split, memory mapped - nothing is read until a batch needs it
+def load_split(cache_dir, split) -> dict:
+    return {name: np.load(os.path.join(cache_dir, split + '_' + name + '.npy'), mmap_mode='r')
+            for name in ['indptr', 'indices', 'data', 'labels']}
+
+
+# This method will gather some rows out of a loaded split, as (row_lengths, indices, data, labels)
+def gather_rows(split_arrays: dict, rows: np.ndarray):
+    indptr = split_arrays['indptr']
+    starts = np.asarray(indptr[rows])
+    lengths = np.asarray(indptr[rows + 1]) - starts
+
+    # position of every value of the batch in the split arrays, row by row
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    positions = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+    return lengths, split_arrays['indices'][positions], split_arrays['data'][positions], split_arrays['labels'][rows]
+
+
+# This method will yield (row_lengths, indices, data, labels) batches out of a loaded split
+# shuffle -> visit the rows in a random order (rng), the rows of each batch are gathered out of the memory map
+def iter_batches(split_arrays: dict, batch_size: int, shuffle=False, rng=None):
+    row_count = len(split_arrays['labels'])
+    order = (rng or np.random.default_rng()).permutation(row_count) if shuffle else np.arange(row_count)
+
+    for start in range(0, row_count, batch_size):
+        rows = order[start:start + batch_size]
+        yield gather_rows(split_arrays, np.sort(rows) if shuffle else rows)
+
+
+# This method will yield length bucketed batches out of a loaded split, in the same form as iter_batches
+# The rows are taken pool_batches batches at a time and sorted by length within the pool, so every batch holds notes of
+# about the same length and pads little. With shuffle the rows, and the batches of each pool, are visited in a random
+# order - the pools keep the batches random enough to train on
+def iter_bucketed_batches(split_arrays: dict, batch_size: int, shuffle=False, rng=None, pool_batches=50):
+    rng = rng or np.random.default_rng()
+    row_lengths = np.diff(np.asarray(split_arrays['indptr']))
+    order = rng.permutation(len(row_lengths)) if shuffle else np.arange(len(row_lengths))
+    pool_size = batch_size * pool_batches
+
+    for pool_start in range(0, len(order), pool_size):
+        pool = order[pool_start:pool_start + pool_size]
+        pool = pool[np.argsort(row_lengths[pool], kind='stable')]
+        batch_starts = np.arange(0, len(pool), batch_size)
+        for start in (rng.permutation(batch_starts) if shuffle else batch_starts):
+            yield gather_rows(split_arrays, np.sort(pool[start:start + batch_size]))
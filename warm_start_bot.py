@@ -0,0 +1,128 @@
+# This will warm start a BOT model from the one already trained, for refreshes after incremental ingestion
+# fastText can't resume training a saved model, but it can start from pretrained word vectors - the word vectors of the
+# existing model are exported to a .vec file and passed as pretrainedVectors, so the new model starts from what was
+# already learned. It's then trained on what's new only: the lines appended to the training file since the model was
+# last trained (clean_data.py --incremental only ever appends), plus a bounded random replay of the older lines so it
+# doesn't drift off of them - the cost grows with the delta, not with the corpus
+# Every training run records how much of the training file the model has seen in <model>.trained.json
+import json
+import logging
+import os
+import random
+
+import fasttext
+
+my_logger = logging.getLogger('classifier_project')
+
+
+# This method will write the word vectors of a model in the .vec text format fastText reads pretrainedVectors from
+def export_vectors(model, vectors_filepath) -> int:
+    words = model.get_words()
+    with open(vectors_filepath + '.tmp', 'w', encoding='utf8') as f:
+        f.write(str(len(words)) + ' ' + str(model.get_dimension()) + '\n')
+        for word in words:
+            f.write(word + ' ' + ' '.join(f"{value:.5f}" for value in model.get_word_vector(word)) + '\n')
+    os.replace(vectors_filepath + '.tmp', vectors_filepath)
+
+    return len(words)
+
+
+# This method will return the file the training state of a model is kept in
+def trained_state_filepath(model_filepath) -> str:
+    return os.path.splitext(model_filepath)[0] + '.trained.json'
+
+
+# This method will record that a model has been trained on train_filepath as it is now - its size, and the last bytes
+# before that, to tell later whether the file was only appended to
+def record_trained_input(model_filepath, train_filepath) -> None:
+    train_bytes = os.path.getsize(train_filepath)
+    with open(train_filepath, 'rb') as f:
+        f.seek(max(0, train_bytes - 4096))
+        tail = f.read().hex()
+
+    with open(trained_state_filepath(model_filepath), 'w', encoding='utf8') as f:
+        json.dump({'train_filepath': train_filepath, 'train_bytes': train_bytes, 'tail': tail}, f)
+
+
+# This method will return the byte offset the lines a model hasn't seen start at, None if train_filepath is not the
+# file it was trained on with lines appended (no training state, a full re-cleanse, a different file)
+def appended_offset(model_filepath, train_filepath):
+    state_filepath = trained_state_filepath(model_filepath)
+    if not os.path.isfile(state_filepath):
+        return None
+
+    with open(state_filepath, 'r', encoding='utf8') as f:
+        state = json.load(f)
+
+    train_bytes = state['train_bytes']
+    if state['train_filepath'] != train_filepath or os.path.getsize(train_filepath) < train_bytes:
+        return None
+
+    with open(train_filepath, 'rb') as f:
+        f.seek(max(0, train_bytes - 4096))
+        if f.read(train_bytes - f.tell()).hex() != state['tail']:
+            return None
+
+    return train_bytes
+
+
+# This method will write the warm start training file - every line from offset on, plus up to replay_lines lines drawn
+# at random from before it. The replay lines are found by seeking to random offsets, so the old part of the file is
+# never read as a whole. Returns (new lines, replayed lines)
+def write_warm_input(train_filepath, offset: int, warm_filepath, replay_lines=10000, seed=0) -> tuple:
+    rng = random.Random(seed)
+    new_count = 0
+    replayed = set()
+
+    with open(train_filepath, 'rb') as f_train, open(warm_filepath, 'wb') as f_warm:
+        f_train.seek(offset)
+        for line in f_train:
+            f_warm.write(line)
+            new_count = new_count + 1
+
+        for _ in range(replay_lines if offset > 0 else 0):
+            # the line a random byte falls in, skipping the partial line before it
+            position = rng.randrange(offset)
+            f_train.seek(max(position - 1, 0))
+            if position > 0:
+                f_train.readline()
+            line_start = f_train.tell()
+            if line_start >= offset or line_start in replayed:
+                continue
+            replayed.add(line_start)
+            f_warm.write(f_train.readline())
+
+    return new_count, len(replayed)
+
+
+# This method will return the training parameters and training file for a warm start from model_filepath
+# The word vectors are exported next to the model, epoch is replaced by warm_epochs, and the training file is the
+# lines appended since the model was trained plus a replay sample (written to <model>.warm.train). Without a record of
+# what the model was trained on, the whole training file is used. The parameters and training file come back unchanged
+# (a cold start) if there is no model yet, or if its dim doesn't match the one being trained
+def warm_start_params(model_filepath, train_filepath, train_params: dict, warm_epochs=5, replay_lines=10000) -> tuple:
+    if not os.path.isfile(model_filepath):
+        my_logger.warning("No model at " + model_filepath + " to warm start from, training from scratch")
+        return train_params, train_filepath
+
+    model = fasttext.load_model(model_filepath)
+    if model.get_dimension() != train_params.get('dim', 100):
+        my_logger.warning("The model at " + model_filepath + " has " + str(model.get_dimension()) + " dims, not " +
+                          str(train_params.get('dim', 100)) + " - training from scratch")
+        return train_params, train_filepath
+
+    vectors_filepath = os.path.splitext(model_filepath)[0] + '.vec'
+    word_count = export_vectors(model, vectors_filepath)
+    my_logger.info("Warm starting from " + model_filepath + " (" + str(word_count) + " word vectors, " +
+                   str(warm_epochs) + " epochs)")
+
+    fit_filepath = train_filepath
+    offset = appended_offset(model_filepath, train_filepath)
+    if offset is None:
+        my_logger.warning("  No record of an earlier training on " + train_filepath + ", warm starting on all of it")
+    else:
+        fit_filepath = os.path.splitext(model_filepath)[0] + '.warm.train'
+        new_count, replay_count = write_warm_input(train_filepath, offset, fit_filepath, replay_lines)
+        my_logger.info("  " + str(new_count) + " new lines, " + str(replay_count) + " replayed lines")
+
+    return dict(train_params, pretrainedVectors=vectors_filepath, epoch=warm_epochs), fit_filepath